@@ -21,8 +21,9 @@
 # SOFTWARE.
 
 
+from collections import defaultdict
 from heapq import heappush, heappop
-from sys import maxint
+from itertools import chain, izip, repeat
 
 # Shortcuts
 try:
@@ -30,16 +31,286 @@ try:
 except ValueError:
     inf = 1e1000000
 
-# Represent each node as a list, ordering the elements so that a heap of nodes
-# is ordered by f = g + h, with h as a first, greedy tie-breaker and num as a
-# second, definite tie-breaker. Store the redundant g for fast and accurate
-# calculations.
+# Heap entries are ordered by f = g + h, with h as a first, greedy
+# tie-breaker and num as a second, definite tie-breaker. The node lists
+# passed to debug() use these indices.
 
 F, H, NUM, G, POS, OPEN, VALID, PARENT = xrange(8)
 
 
+class SparseArray(defaultdict):
+
+    """A dict that reads as default for missing keys, to stand in for a
+    list of defaults indexed by ids from a large range of which few are
+    used. Keys that were read are kept, until it is cleared."""
+
+    def __init__(self, default):
+        # A factory in C, as it is called for every new key
+        defaultdict.__init__(self, repeat(default).next)
+
+
+class AStarEngine(object):
+
+    """A* over integer node ids.
+
+    The search state of every node (g, h, tie-breaking number, parent and
+    open/closed marks) lives in flat arrays indexed by node id. They are
+    allocated once and reused by later searches: each search gets a new
+    stamp, and array entries carrying an older stamp count as unseen, so
+    nothing has to be cleared between queries. The open set is a binary
+    heap of (f, h, num, id) tuples; an improved node gets a new num and
+    its old heap entry is skipped when popped.
+
+    search_arrays searches a graph stored as adjacency arrays, with the
+    neighbor loop and the heuristic inline. search calls back for the
+    neighbors, goal test and heuristic of every node, for graphs that
+    are made while searching, such as the jumps of gridplan or the
+    positions of astar.
+
+    A sparse engine keeps the state in SparseArrays instead, which any
+    node id can index and which only hold the nodes of the last search,
+    for ids from a range too large to allocate, such as the tiles of a
+    large grid.
+
+    An engine holds the state of one search at a time and is not
+    reentrant: a callback of a search must not start another search on
+    the same engine. Give each caller its own engine.
+    """
+
+    def __init__(self, size=0, sparse=False):
+        self.size = 0
+        self.sparse = sparse
+        if sparse:
+            self.g, self.h = SparseArray(0.0), SparseArray(0.0)
+            self.num, self.parent = SparseArray(0), SparseArray(-1)
+            self.seen, self.closed = SparseArray(0), SparseArray(0)
+        else:
+            self.g = []
+            self.h = []
+            self.num = []
+            self.parent = []
+            self.seen = []
+            self.closed = []
+        self.stamp = 0
+        self.grow(size)
+
+    def grow(self, size):
+        """Make room for node ids up to size - 1. The arrays are extended
+        in place, so a running search keeps working."""
+        if self.sparse:
+            return
+        extra = size - self.size
+        if extra <= 0:
+            return
+        for values, default in ((self.g, 0.0), (self.h, 0.0),
+                                (self.num, 0), (self.parent, -1),
+                                (self.seen, 0), (self.closed, 0)):
+            values.extend([default] * extra)
+        self.size = size
+
+    def search(self, start, expand, is_goal, heuristic, start_g=0,
+               limit=None):
+        """Find the shortest path from start to a goal node.
+
+        Arguments:
+
+          start          - The starting node id.
+          expand(id)     - An iterable of (neighbor id, cost) pairs.
+          is_goal(id)    - True for goal node ids.
+          heuristic(id)  - Estimate of the remaining cost to the goal.
+          start_g        - The starting cost.
+          limit          - The maximum number of node ids to search.
+
+        Returns the node ids of the best path found, excluding the start,
+        its length (inf if it is empty) and the number of node ids seen.
+        If no goal is reached, the path leads to the node with the lowest
+        heuristic, as in astar.
+        """
+        self.stamp += 1
+        stamp = self.stamp
+        g, h, num, parent = self.g, self.h, self.num, self.parent
+        seen, closed = self.seen, self.closed
+        if self.sparse:
+            for values in (g, h, num, parent, seen, closed):
+                values.clear()
+        if limit is None:
+            limit = inf
+
+        start_h = heuristic(start)
+        g[start] = start_g
+        h[start] = start_h
+        num[start] = 0
+        parent[start] = -1
+        seen[start] = stamp
+        closed[start] = 0
+        counter = 0
+        discovered = 1
+        heap = [(start_g + start_h, start_h, 0, start)]
+        best = start
+
+        while heap:
+            current_f, current_h, current_num, current = heappop(heap)
+            if closed[current] == stamp or num[current] != current_num:
+                continue # Outdated heap entry
+            closed[current] = stamp
+
+            if is_goal(current):
+                best = current
+                break
+
+            current_g = g[current]
+            for neighbor, step in expand(current):
+                neighbor_g = current_g + step
+                if seen[neighbor] != stamp:
+                    if discovered >= limit:
+                        continue
+                    discovered += 1
+                    neighbor_h = heuristic(neighbor)
+                    counter += 1
+                    seen[neighbor] = stamp
+                    closed[neighbor] = 0
+                    g[neighbor] = neighbor_g
+                    h[neighbor] = neighbor_h
+                    num[neighbor] = counter
+                    parent[neighbor] = current
+                    heappush(heap, (neighbor_g + neighbor_h, neighbor_h,
+                                    counter, neighbor))
+                    if neighbor_h < h[best]:
+                        best = neighbor
+                elif neighbor_g < g[neighbor]:
+                    if closed[neighbor] == stamp:
+                        # Reopen the neighbor, keeping its number
+                        closed[neighbor] = 0
+                    else:
+                        counter += 1
+                        num[neighbor] = counter
+                    g[neighbor] = neighbor_g
+                    parent[neighbor] = current
+                    heappush(heap, (neighbor_g + h[neighbor], h[neighbor],
+                                    num[neighbor], neighbor))
+
+        path = []
+        current = best
+        while parent[current] != -1:
+            path.append(current)
+            current = parent[current]
+        path.reverse()
+        length = g[best] + h[best] if path else inf
+        return path, length, discovered
+
+
+    def search_arrays(self, start, goal, offsets, targets, costs, xs, ys,
+                      spans=None, exits=None, start_g=0, limit=None):
+        """Find the shortest path from start to goal in a graph stored as
+        arrays, as search does, but without a callback per node.
+
+        Arguments:
+
+          start, goal    - The starting and the goal node id.
+          offsets        - The edges of node id i are those from
+                           offsets[i] up to offsets[i + 1] in:
+          targets, costs - The neighbor id and cost of each edge.
+          xs, ys         - Coordinates of each node id. The heuristic is
+                           the straight line distance to the goal.
+          spans          - A dict of node id -> (first, end) to use
+                           instead of its range in offsets, e.g. for
+                           temporary edges appended to targets and costs.
+          exits          - A dict of node id -> cost of an extra edge from
+                           it to the goal.
+          start_g        - The starting cost.
+          limit          - The maximum number of node ids to search.
+
+        Returns what search returns.
+        """
+        self.stamp += 1
+        stamp = self.stamp
+        g, h, num, parent = self.g, self.h, self.num, self.parent
+        seen, closed = self.seen, self.closed
+        if self.sparse:
+            for values in (g, h, num, parent, seen, closed):
+                values.clear()
+        if limit is None:
+            limit = inf
+        if spans is None:
+            spans = {}
+        if exits is None:
+            exits = {}
+        goal_x, goal_y = xs[goal], ys[goal]
+
+        start_h = ((xs[start] - goal_x) ** 2 + (ys[start] - goal_y) ** 2) ** 0.5
+        g[start] = start_g
+        h[start] = start_h
+        num[start] = 0
+        parent[start] = -1
+        seen[start] = stamp
+        closed[start] = 0
+        counter = 0
+        discovered = 1
+        heap = [(start_g + start_h, start_h, 0, start)]
+        best = start
+
+        while heap:
+            current_f, current_h, current_num, current = heappop(heap)
+            if closed[current] == stamp or num[current] != current_num:
+                continue # Outdated heap entry
+            closed[current] = stamp
+
+            if current == goal:
+                best = current
+                break
+
+            current_g = g[current]
+            span = spans.get(current)
+            if span is None:
+                first, end = offsets[current], offsets[current + 1]
+            else:
+                first, end = span
+            edges = izip(targets[first:end], costs[first:end])
+            if current in exits:
+                edges = chain(edges, ((goal, exits[current]),))
+            for neighbor, step in edges:
+                neighbor_g = current_g + step
+                if seen[neighbor] != stamp:
+                    if discovered >= limit:
+                        continue
+                    discovered += 1
+                    neighbor_h = ((xs[neighbor] - goal_x) ** 2 +
+                                  (ys[neighbor] - goal_y) ** 2) ** 0.5
+                    counter += 1
+                    seen[neighbor] = stamp
+                    closed[neighbor] = 0
+                    g[neighbor] = neighbor_g
+                    h[neighbor] = neighbor_h
+                    num[neighbor] = counter
+                    parent[neighbor] = current
+                    heappush(heap, (neighbor_g + neighbor_h, neighbor_h,
+                                    counter, neighbor))
+                    if neighbor_h < h[best]:
+                        best = neighbor
+                elif neighbor_g < g[neighbor]:
+                    if closed[neighbor] == stamp:
+                        # Reopen the neighbor, keeping its number
+                        closed[neighbor] = 0
+                    else:
+                        counter += 1
+                        num[neighbor] = counter
+                    g[neighbor] = neighbor_g
+                    parent[neighbor] = current
+                    heappush(heap, (neighbor_g + h[neighbor], h[neighbor],
+                                    num[neighbor], neighbor))
+
+        path = []
+        current = best
+        while parent[current] != -1:
+            path.append(current)
+            current = parent[current]
+        path.reverse()
+        length = g[best] + h[best] if path else inf
+        return path, length, discovered
+
+
 def astar(start_pos, neighbors, goal, start_g, cost, heuristic, limit=100,
-          debug=None):
+          debug=None, engine=None):
 
     """Find the shortest path from start to goal.
 
@@ -59,100 +330,68 @@ def astar(start_pos, neighbors, goal, start_g, cost, heuristic, limit=100,
       limit          - The maximum number of positions to search.
       debug(nodes)   - This function will be called with a dictionary of all
                        nodes.
+      engine         - The AStarEngine to search with, to reuse its arrays
+                       over many calls. By default each call makes its own.
 
     The function returns the best path found. The returned path excludes the
     starting position.
+
+    Positions are numbered as they are found and searched with AStarEngine.
+
+    >>> grid = ['....', '.##.', '....']
+    >>> def neighbors((x, y)):
+    ...     for nx, ny in ((x+1, y), (x-1, y), (x, y+1), (x, y-1)):
+    ...         if 0 <= ny < 3 and 0 <= nx < 4 and grid[ny][nx] == '.':
+    ...             yield nx, ny
+    >>> astar((0, 1), neighbors, lambda p: p == (3, 1), 0,
+    ...       lambda a, b: 1, lambda p: abs(3 - p[0]) + abs(1 - p[1]))
+    ([(0, 2), (1, 2), (2, 2), (3, 2), (3, 1)], 5)
+
+    Every call has its own search state, so a callback may search too:
+
+    >>> goal = lambda p: p == (3, 1)
+    >>> exact = lambda p: 0 if goal(p) else astar(p, neighbors, goal, 0,
+    ...                                          lambda a, b: 1, lambda p: 0)[1]
+    >>> astar((0, 1), neighbors, goal, 0, lambda a, b: 1, exact)
+    ([(0, 2), (1, 2), (2, 2), (3, 2), (3, 1)], 5)
     """
 
-    # Create the start node.
-    nums = iter(xrange(maxint))
-    start_h = heuristic(start_pos)
-    start = [start_g + start_h, start_h, nums.next(), start_g, start_pos, True,
-             True, None]
-
-    # Track all nodes seen so far.
-    nodes = {start_pos: start}
-
-    # Maintain a heap of nodes.
-    heap = [start]
-
-    # Track the best path found so far.
-    best = start
-
-    while heap:
-
-        # Pop the next node from the heap.
-        current = heappop(heap)
-        current[OPEN] = False
-
-        # Have we reached the goal?
-        if goal(current[POS]):
-            best = current
-            break
-
-        # Visit the neighbors of the current node.
-        for neighbor_pos in neighbors(current[POS]):
-            neighbor_g = current[G] + cost(current[POS], neighbor_pos)
-            neighbor = nodes.get(neighbor_pos)
-            if neighbor is None:
-
-                # Limit the search.
-                if len(nodes) >= limit:
-                    continue
-
-                # We have found a new node.
-                neighbor_h = heuristic(neighbor_pos)
-                neighbor = [neighbor_g + neighbor_h, neighbor_h, nums.next(),
-                            neighbor_g, neighbor_pos, True, True, current[POS]]
-                nodes[neighbor_pos] = neighbor
-                heappush(heap, neighbor)
-                if neighbor_h < best[H]:
-
-                    # We are approaching the goal.
-                    best = neighbor
-
-            elif neighbor_g < neighbor[G]:
-
-                # We have found a better path to the neighbor.
-                if neighbor[OPEN]:
-
-                    # The neighbor is already open. Finding and updating it
-                    # in the heap would be a linear complexity operation.
-                    # Instead we mark the neighbor as invalid and make an
-                    # updated copy of it.
-
-                    neighbor[VALID] = False
-                    nodes[neighbor_pos] = neighbor = neighbor[:]
-                    neighbor[F] = neighbor_g + neighbor[H]
-                    neighbor[NUM] = nums.next()
-                    neighbor[G] = neighbor_g
-                    neighbor[VALID] = True
-                    neighbor[PARENT] = current[POS]
-                    heappush(heap, neighbor)
-
-                else:
-
-                    # Reopen the neighbor.
-                    neighbor[F] = neighbor_g + neighbor[H]
-                    neighbor[G] = neighbor_g
-                    neighbor[PARENT] = current[POS]
-                    neighbor[OPEN] = True
-                    heappush(heap, neighbor)
-
-        # Discard leading invalid nodes from the heap.
-        while heap and not heap[0][VALID]:
-            heappop(heap)
+    ids = {start_pos: 0}
+    positions = [start_pos]
+    if engine is None:
+        engine = AStarEngine()
+    engine.grow(1)
+
+    def expand(i):
+        pos = positions[i]
+        for neighbor_pos in neighbors(pos):
+            j = ids.get(neighbor_pos)
+            if j is None:
+                j = ids[neighbor_pos] = len(positions)
+                positions.append(neighbor_pos)
+                if j >= engine.size:
+                    engine.grow(2 * j + 1)
+            yield j, cost(pos, neighbor_pos)
+
+    path, length, discovered = engine.search(
+        0, expand, lambda i: goal(positions[i]),
+        lambda i: heuristic(positions[i]), start_g, limit)
 
     if debug is not None:
-        # Pass the dictionary of nodes to the caller.
+        # Pass a dictionary of the seen nodes, in the old list format.
+        nodes = {}
+        for pos, i in ids.iteritems():
+            if engine.seen[i] == engine.stamp:
+                parent = engine.parent[i]
+                open_ = engine.closed[i] != engine.stamp
+                nodes[pos] = [engine.g[i] + engine.h[i], engine.h[i],
+                              engine.num[i], engine.g[i], pos, open_, True,
+                              positions[parent] if parent != -1 else None]
         debug(nodes)
 
-    # Return the best path as a list.
-    path = []
-    current = best
-    while current[PARENT] is not None:
-        path.append(current[POS])
-        current = nodes[current[PARENT]]
-    path.reverse()
-    length = best[F] if path else inf
-    return path, length
+    return [positions[i] for i in path], length
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,87 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Compares the path planners of world.PLANNERS on our maps: the time to set
+them up, the time per query and the length of the paths they find, for
+the same random queries between free tiles.
+
+    python bench_planners.py [level.map ...] [--queries 200]
+
+Without arguments all maps in the current directory are compared.
+"""
+import os
+import sys
+import glob
+import time
+import random
+import optparse
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import pygame
+
+import objects
+import world
+import utils
+
+
+def path_length(start, path):
+    return sum(utils.point_dist(a, b) for a, b in zip([start] + path, path))
+
+def setup(level, planner):
+    """Build the planner from scratch and return the time it took."""
+    start = time.time()
+    if planner == 'mesh':
+        level.build_nav_mesh(level.filename, use_cache=False)
+    else:
+        level.grid_planners.pop(planner, None)
+        level.grid_planner(planner)
+    return time.time() - start
+
+def bench(filename, queries=200, seed=0, out=sys.stdout):
+    # A grid planner, so that loading does not build the nav mesh yet
+    try:
+        level = world.Level((0, 0), filename, planner='jps')
+    except KeyError, key:
+        out.write('%s: skipped, no tile definition for %s\n' % (filename,
+                                                                 key))
+        return
+    tw, th = world.MAP_TILE_SIZE
+    free = [((x + 0.5) * tw, (y + 0.5) * th)
+            for y, row in enumerate(level.grid)
+            for x, cell in enumerate(row) if cell != 1]
+    rng = random.Random(seed)
+    pairs = [(utils.Point(*rng.choice(free)), rng.choice(free))
+             for i in xrange(queries)]
+    out.write('%s: %dx%d tiles, %d queries\n' % (
+        filename, level.width, level.height, queries))
+    out.write('%-8s %10s %12s %8s %12s\n' % (
+        'planner', 'setup s', 'ms/query', 'found', 'mean length'))
+    for planner in world.PLANNERS:
+        setup_time = setup(level, planner)
+        found, total = 0, 0.0
+        start_time = time.time()
+        for start, goal in pairs:
+            level.path_cache.clear()
+            path = level.plan_path(start, goal, planner)
+            if path:
+                found += 1
+                total += path_length(start, path)
+        elapsed = time.time() - start_time
+        out.write('%-8s %10.3f %12.3f %7d%% %12.1f\n' % (
+            planner, setup_time, 1000.0 * elapsed / queries,
+            100 * found // queries, total / max(found, 1)))
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [level.map ...]')
+    parser.add_option('-q', '--queries', type='int', default=200,
+                      help='number of random queries per map')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='random seed for the queries')
+    options, args = parser.parse_args(argv)
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    for filename in args or sorted(glob.glob('*.map')):
+        bench(filename, options.queries, options.seed)
+    pygame.quit()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Micro-benchmark of the Point operations done per agent per frame
+(GameObject._set_pos, tile_pos, move and the waypoint step in
+Person.update), comparing utils.Point against the previous implementation
+that overrode __getattribute__ and type checked every operand.
+
+    python bench_point.py
+"""
+import timeit
+
+import utils
+
+class LegacyPoint(tuple):
+    """The old utils.Point, reduced to the operations benchmarked here."""
+
+    def __new__(cls, a, b):
+        return super(LegacyPoint, cls).__new__(cls, tuple((a, b)))
+
+    def __init__(self, x, y):
+        super(LegacyPoint, self).__init__(x, y)
+
+    def __sub__(self, other):
+        if isinstance(other, LegacyPoint) or isinstance(other, tuple):
+            return LegacyPoint(self[0] - other[0], self[1] - other[1])
+        else:
+            raise NotImplementedError()
+
+    def __add__(self, other):
+        if isinstance(other, LegacyPoint) or isinstance(other, tuple):
+            return LegacyPoint(self[0] + other[0], self[1] + other[1])
+        else:
+            raise NotImplementedError()
+
+    def __getattribute__(self, name):
+        if name == 'x':
+            return self[0]
+        elif name == 'y':
+            return self[1]
+        else:
+            return object.__getattribute__(self, name)
+
+    def dist(self, other):
+        if isinstance(other, LegacyPoint) or isinstance(other, tuple):
+            diff = self - other
+            return (diff[0]**2 + diff[1]**2)**0.5
+        else:
+            return NotImplementedError()
+
+def agent_step(Point, pos, offset=(8, 28), waypoint=(40, 128)):
+    """One agent update worth of Point operations."""
+    pos = Point(pos[0], pos[1])                     # _set_pos
+    pos += (1.5, -0.5)                              # move
+    tile = Point(int(pos.x / 32), int(pos.y / 16))  # tile_pos
+    target = Point(waypoint[0], waypoint[1]) - offset
+    return tile, pos.dist(target)
+
+def bench(Point, agents=1000, repeat=5):
+    """Best time in seconds to update the given number of agents."""
+    positions = [(i % 1000, i // 1000) for i in xrange(agents)]
+    def frame():
+        for pos in positions:
+            agent_step(Point, pos)
+    return min(timeit.repeat(frame, number=1, repeat=repeat))
+
+if __name__ == '__main__':
+    agents = 10000
+    old = bench(LegacyPoint, agents)
+    new = bench(utils.Point, agents)
+    print '%d agents: legacy %.2f ms, Point %.2f ms per frame (%.1fx)' % (
+        agents, 1000 * old, 1000 * new, old / new)
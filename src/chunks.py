@@ -0,0 +1,572 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Streaming of large levels in chunks around a camera. The map is split
+into square chunks of tiles. Chunks near the camera are loaded: their
+entities are active and they get a rendered image and wall overlays.
+Chunks that get far from the camera are unloaded, their entities are put
+to sleep until the chunk is loaded again. The wall rects used for
+collisions are made per chunk when needed and kept in a bounded cache.
+With the nav mesh planner each loaded chunk is meshed on its own, in
+steps spread over the updates, and joined to the meshed chunks around
+it. The work per frame and the memory
+for walls, images, entities and the nav mesh depend on the size of the
+camera, not of the level. The grid planners keep a byte per tile of the
+level and the state of a search for the tiles it visits only.
+"""
+import time
+
+import pygame
+
+import objects # Before world, which it imports
+import world
+import levelfile
+import utils
+
+CHUNK_SIZE = 16 # tiles per side
+CHUNK_RADIUS = 1 # chunks loaded around the camera
+WALL_CHUNK_CACHE = 256 # chunks whose wall rects are kept
+MESH_BUDGET = 10.0 # milliseconds of chunk meshing per update
+
+class Chunk(object):
+    """A loaded chunk: its rendered image, the tiles of its overlays and
+    its nodes of the nav mesh, None if it is not meshed."""
+
+    def __init__(self, pos):
+        self.pos = pos
+        self.image = None
+        self.overlay_tiles = []
+        self.nav_nodes = None
+
+class ChunkedLevel(world.Level):
+    """ A level that only keeps the chunks around its camera loaded.
+        Move the camera with move_camera or center_camera; update_objects
+        loads and unloads chunks to follow it, and render returns the
+        background seen by the camera. Paths are planned with one of
+        world.PLANNERS. The nav mesh only covers the loaded chunks, which
+        are meshed a few milliseconds per update; paths from or to other
+        chunks are planned with jump point search. Paths are planned
+        right away or through a plan queue, not by path workers.
+
+        >>> import os; os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+        >>> level = ChunkedLevel((64, 64), 'level_wonly.map', 'jps',
+        ...                      chunk_size=4, radius=0)
+        >>> sorted(level.chunks), sorted(level.grid_planners)
+        ([(0, 1), (0, 2)], ['jps'])
+
+        The chunks follow the camera on update, rendering loads none:
+
+        >>> level.center_camera((960, 40)); view, overlays = level.render()
+        >>> sorted(level.chunks)
+        [(0, 1), (0, 2)]
+        >>> level.update_chunks(); sorted(level.chunks)
+        [(7, 0), (7, 1)]
+
+        The entities of a chunk sleep while it is unloaded:
+
+        >>> person, = [obj for obj in level.game_objects
+        ...            if obj is not level.player]
+        >>> level.center_camera((0, 0)); level.update_chunks()
+        >>> level.game_objects.has(person), level.sleeping == {(7, 0): [person]}
+        (False, True)
+        >>> level.center_camera((960, 40)); level.update_chunks()
+        >>> level.game_objects.has(person), level.sleeping
+        (True, {})
+        >>> level.enable_path_workers()
+        Traceback (most recent call last):
+        ValueError: path workers cannot plan in a chunked level
+    """
+
+    def __init__(self, screen_size, filename="level.map", planner='jps',
+                 chunk_size=CHUNK_SIZE, radius=CHUNK_RADIUS):
+        self.chunk_size = chunk_size
+        self.radius = radius
+        self.chunks = {}   # (cx, cy) -> Chunk, the loaded chunks
+        self.sleeping = {} # (cx, cy) -> entities of an unloaded chunk
+        self._spawned = set() # Chunks whose map entities were created
+        self._spawns = {}  # (cx, cy) -> [(tile, legend entry)]
+        self._chunk_walls = utils.LRUCache(WALL_CHUNK_CACHE)
+        self.chunk_mesh = {} # Nav mesh of the meshed chunks
+        self._chunk_search = None
+        self._meshing = None # (chunk, steps) of the chunk being meshed
+        self._tiles = None
+        self._view = None
+        self._player_tile = None
+        self.player = None
+        world.Level.__init__(self, screen_size, filename, planner)
+        if self._player_tile is not None:
+            x, y = self._player_tile
+            self.center_camera(((x + 0.5) * world.MAP_TILE_WIDTH,
+                                (y + 0.5) * world.MAP_TILE_HEIGHT))
+        # Built with the level rather than on the first query; the nav
+        # mesh falls back to jump point search
+        self.grid_planner('jps' if planner == 'mesh' else planner)
+        self.update_chunks()
+
+    def load_file(self, filename):
+        """Load the map without creating its entities or wall rects."""
+        data = self._load_legend(filename)
+        self.items = {}
+        for x, y, i in data.spawns:
+            entry = self.legend[i][1]
+            self._spawns.setdefault(self.chunk_at((x, y)), []).append(
+                ((x, y), entry))
+            if entry['name'] == 'player':
+                self._player_tile = (x, y)
+        # Writable, as walls can be added
+        self.grid = levelfile.copy_walls(data)
+
+    @property
+    def bounds(self):
+        """The level in pixels."""
+        return pygame.Rect(0, 0, self.width * world.MAP_TILE_WIDTH,
+                           self.height * world.MAP_TILE_HEIGHT)
+
+    def chunk_at(self, (x, y)):
+        """The chunk containing a tile."""
+        return (x // self.chunk_size, y // self.chunk_size)
+
+    def chunk_rect(self, (cx, cy)):
+        """A chunk in pixels."""
+        width = self.chunk_size * world.MAP_TILE_WIDTH
+        height = self.chunk_size * world.MAP_TILE_HEIGHT
+        return pygame.Rect(cx * width, cy * height, width, height)
+
+    def chunks_in(self, rect):
+        """The chunks of the level that overlap a rect in pixels."""
+        rect = pygame.Rect(rect).clip(self.bounds)
+        if not rect.width or not rect.height:
+            return []
+        x0, y0 = self.chunk_at(self.tile_at(rect.topleft))
+        x1, y1 = self.chunk_at(self.tile_at((rect.right - 1,
+                                             rect.bottom - 1)))
+        return [(cx, cy) for cy in xrange(y0, y1 + 1)
+                for cx in xrange(x0, x1 + 1)]
+
+    def move_camera(self, dx, dy):
+        """Move the camera, keeping it inside the level where it fits."""
+        self.camera.move_ip(dx, dy)
+        bounds = self.bounds
+        self.camera.x = max(0, min(self.camera.x,
+                                   bounds.width - self.camera.width))
+        self.camera.y = max(0, min(self.camera.y,
+                                   bounds.height - self.camera.height))
+
+    def center_camera(self, pos):
+        """Move the camera to show pos in its centre."""
+        self.move_camera(int(pos[0]) - self.camera.centerx,
+                         int(pos[1]) - self.camera.centery)
+
+    def update_chunks(self):
+        """Load the chunks within radius of the camera and unload those
+        more than one chunk further, putting the entities outside the
+        loaded chunks to sleep."""
+        margin_x = self.radius * self.chunk_size * world.MAP_TILE_WIDTH
+        margin_y = self.radius * self.chunk_size * world.MAP_TILE_HEIGHT
+        near = self.camera.inflate(2 * margin_x, 2 * margin_y)
+        keep = set(self.chunks_in(near.inflate(
+            2 * self.chunk_size * world.MAP_TILE_WIDTH,
+            2 * self.chunk_size * world.MAP_TILE_HEIGHT)))
+        for pos in self.chunks.keys():
+            if pos not in keep:
+                self.unload_chunk(pos)
+        for pos in self.chunks_in(near):
+            if pos not in self.chunks:
+                self.load_chunk(pos)
+        if self.planner == 'mesh':
+            self.build_nav_mesh(budget=MESH_BUDGET)
+        self._sleep_entities(lambda pos: pos not in self.chunks)
+
+    def load_chunk(self, pos):
+        """Activate the entities of a chunk, creating those of the map the
+        first time. Its image is rendered when it is first seen."""
+        chunk = self.chunks[pos] = Chunk(pos)
+        if pos not in self._spawned:
+            self._spawned.add(pos)
+            for tile, entry in self._spawns.get(pos, []):
+                self.add_object(self.spawn(tile, entry))
+        members = []
+        self._view = None
+        for entity in self.sleeping.pop(pos, []):
+            if entity in self._crowd_members:
+                self.game_objects.add(entity)
+                members.append(entity)
+            else:
+                self.add_object(entity)
+        if members:
+            self.crowd.set_awake(members, True)
+        return chunk
+
+    def unload_chunk(self, pos):
+        """Forget the image and overlays of a chunk and put its entities
+        to sleep."""
+        if self._meshing is not None and \
+                pos in self._around(self._meshing[0].pos):
+            self._stop_meshing()
+        chunk = self.chunks.pop(pos)
+        if chunk.nav_nodes is not None:
+            self._unmesh_chunk(chunk)
+        for tile in chunk.overlay_tiles:
+            self._set_overlay(tile, None)
+        self._sleep_entities(lambda other: other == pos)
+        self._view = None
+
+    def _sleep_entities(self, unloaded):
+        """Put the active entities but the player to sleep that are in a
+        chunk for which unloaded is true. Crowd members are only taken out
+        of game_objects and stand still in the crowd; their chunk is found
+        from their position in the crowd, as their sprite may be stale.
+
+        >>> import os; os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+        >>> level = ChunkedLevel((64, 64), 'level_wonly.map', 'jps',
+        ...                      chunk_size=4, radius=0)
+        >>> level.center_camera((960, 40)); level.update_chunks()
+        >>> crowd = level.enable_crowd()
+        >>> level.center_camera((0, 0)); level.update_objects()
+        >>> crowd.awake.tolist(), crowd.query(level.bounds)
+        ([False], [])
+        >>> asleep = crowd.pos.tolist(); level.update_objects()
+        >>> crowd.pos.tolist() == asleep
+        True
+        >>> level.center_camera((960, 40)); level.update_objects()
+        >>> crowd.awake.tolist(), crowd.query(level.bounds) == crowd.people
+        ([True], True)
+        >>> crowd.people[0].spatial_index is None # Still only in the crowd
+        True
+        """
+        members = self._crowd_members
+        for entity in self.game_objects.sprites():
+            if entity is self.player or entity in members:
+                continue
+            pos = self.chunk_at(self.tile_at(entity.pos))
+            if unloaded(pos):
+                self.remove_object(entity)
+                self.sleeping.setdefault(pos, []).append(entity)
+        if self.crowd is None:
+            return
+        import numpy
+        crowd = self.crowd
+        agents = numpy.flatnonzero(crowd.awake).tolist()
+        x, y = crowd.pos[agents].T
+        cx = numpy.floor(x / (self.chunk_size * world.MAP_TILE_WIDTH))
+        cy = numpy.floor(y / (self.chunk_size * world.MAP_TILE_HEIGHT))
+        cells = zip(cx.astype(int).tolist(), cy.astype(int).tolist())
+        gone = set(pos for pos in set(cells) if unloaded(pos))
+        if not gone:
+            return
+        asleep = []
+        for i, pos in zip(agents, cells):
+            if pos in gone:
+                person = crowd.people[i]
+                self.game_objects.remove(person)
+                self.sleeping.setdefault(pos, []).append(person)
+                asleep.append(person)
+        crowd.set_awake(asleep, False)
+
+    def walls_of(self, pos):
+        """The merged wall rects of a chunk: its wall tiles and the walls
+        added to the level that overlap it.
+
+        >>> import os; os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+        >>> level = ChunkedLevel((64, 64), 'level_wonly.map', 'jps',
+        ...                      chunk_size=4, radius=0)
+        >>> level.walls_of((0, 0))
+        [(32, 16, 32, 48), (64, 16, 64, 16)]
+        >>> level.add_wall((0, 0, 32, 32)); level.walls_of((0, 0))
+        [(32, 16, 32, 48), (64, 16, 64, 16), (0, 0, 32, 32)]
+        """
+        rects = self._chunk_walls.get(pos)
+        if rects is None:
+            area = self.chunk_rect(pos).clip(self.bounds)
+            x0, y0 = self.tile_at(area.topleft)
+            x1, y1 = self.tile_at(area.bottomright)
+            rects = [(x * world.MAP_TILE_WIDTH, y * world.MAP_TILE_HEIGHT,
+                      world.MAP_TILE_WIDTH, world.MAP_TILE_HEIGHT)
+                     for y in xrange(y0, y1) for x in xrange(x0, x1)
+                     if self.walls[y][x]]
+            rects = utils.rects_merge(rects) + [
+                rect for rect in self.wall_rects if area.colliderect(rect)]
+            self._chunk_walls[pos] = rects
+        return rects
+
+    @property
+    def grid_array(self):
+        """The grid as a NumPy wall mask, a view instead of a copy of it, or
+        None if the grid is not a NumPy array."""
+        if hasattr(self.grid, 'view'):
+            return self.grid.view(bool)
+        return None
+
+    def _around(self, pos):
+        """The chunks of the level next to a chunk and the chunk itself."""
+        width = self.chunk_size * world.MAP_TILE_WIDTH
+        height = self.chunk_size * world.MAP_TILE_HEIGHT
+        return self.chunks_in(self.chunk_rect(pos).inflate(2 * width,
+                                                           2 * height))
+
+    @property
+    def nav_mesh(self):
+        """The nav mesh of the meshed chunks."""
+        return self.chunk_mesh
+
+    def build_nav_mesh(self, filename=None, budget=None):
+        """Mesh the loaded chunks that are not meshed yet, those the camera
+        sees first, until budget milliseconds have passed if given. A chunk
+        is meshed in small steps, and the next call goes on where the
+        budget ran out. There is no nav mesh of the whole level, nor a
+        cache file."""
+        if budget is not None:
+            deadline = time.time() + budget / 1000.0
+        while True:
+            if self._meshing is None:
+                seen = set(self.chunks_in(self.camera))
+                todo = [(pos not in seen, pos) for pos, chunk in
+                        self.chunks.iteritems() if chunk.nav_nodes is None]
+                if not todo:
+                    return
+                chunk = self.chunks[min(todo)[1]]
+                self._meshing = (chunk, self._iter_mesh_chunk(chunk))
+            for _ in self._meshing[1]:
+                if budget is not None and time.time() >= deadline:
+                    return
+            self._meshing = None
+            if budget is not None and time.time() >= deadline:
+                return
+
+    def _stop_meshing(self):
+        """Give up meshing the chunk being meshed, removing the nodes that
+        were joined to the nav mesh."""
+        chunk, steps = self._meshing
+        self._meshing = None
+        steps.close()
+        if chunk.nav_nodes is not None:
+            self._unmesh_chunk(chunk)
+
+    def _mesh_chunk(self, chunk):
+        """Mesh a chunk in one go."""
+        for _ in self._iter_mesh_chunk(chunk):
+            pass
+
+    def _iter_mesh_chunk(self, chunk, offset=world.NAV_MESH_OFFSET,
+                         simplify=world.NAV_MESH_SIMPLIFY):
+        """Mesh a chunk from the walls around it, which the lines to the
+        chunks next to it can cross, and join it to those chunks, in the
+        steps of utils.iter_nav_mesh. The nodes of the chunk are in the nav
+        mesh from the start of the join."""
+        around = self._around(chunk.pos)
+        walls = set()
+        for pos in around:
+            walls.update(tuple(rect) for rect in self.walls_of(pos))
+        walls = utils.rects_merge(sorted(walls))
+        # Nodes on the right and bottom edges are of the next chunks
+        area = self.chunk_rect(chunk.pos).clip(self.bounds)
+        mesh = {}
+        for step in utils.iter_nav_mesh(mesh, walls,
+                                        (area.x, area.y, area.width - 1,
+                                         area.height - 1), offset, simplify):
+            yield step
+        near = [node for pos in around if pos in self.chunks
+                for node in self.chunks[pos].nav_nodes or ()]
+        bounds = self.chunk_rect(around[0]).union(
+            self.chunk_rect(around[-1]))
+        chunk.nav_nodes = set(mesh)
+        for step in utils.iter_nav_mesh_join(self.chunk_mesh, mesh, near,
+                                             walls, tuple(bounds), offset,
+                                             simplify):
+            self._chunk_search = None
+            yield step
+        self._chunk_search = None
+
+    def _unmesh_chunk(self, chunk):
+        """Remove the nodes of a chunk from the nav mesh. Connections to
+        them only come from the chunks around it."""
+        mesh, nodes = self.chunk_mesh, chunk.nav_nodes
+        for node in nodes:
+            del mesh[node]
+        for pos in self._around(chunk.pos):
+            other = self.chunks.get(pos)
+            if other is not None and other.nav_nodes and other is not chunk:
+                for node in other.nav_nodes:
+                    conns = mesh[node]
+                    for gone in [n for n in conns if n in nodes]:
+                        del conns[gone]
+        chunk.nav_nodes = None
+        self._chunk_search = None
+
+    def _walls_changed(self, rect, area):
+        """Update as Level does, and mesh the meshed chunks the wall
+        reaches again.
+
+        >>> import os; os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+        >>> level = ChunkedLevel((64, 64), 'level_wonly.map', 'mesh',
+        ...                      chunk_size=4, radius=0)
+        >>> level.build_nav_mesh(); chunk = level.chunks[(0, 1)]
+        >>> before = set(chunk.nav_nodes)
+        >>> level.add_wall((48, 96, 32, 16))
+        >>> sorted(chunk.nav_nodes - before) # The corners of the new wall
+        [(41, 89), (41, 119), (87, 89), (87, 119)]
+        >>> level.plan_path((16, 104), (112, 72))
+        [(41, 89), (87, 89), (112, 72)]
+        """
+        world.Level._walls_changed(self, rect, area)
+        if self._meshing is not None:
+            self._stop_meshing()
+        grown = utils.rect_offset(rect, world.NAV_MESH_OFFSET)
+        blocker = utils.rect_offset(grown, -0.001)
+        changed = [self.chunks[pos] for pos in self.chunks_in(grown)
+                   if pos in self.chunks and
+                   self.chunks[pos].nav_nodes is not None]
+        for chunk in changed:
+            self._unmesh_chunk(chunk)
+        # Connections between the chunks around that cross a new wall
+        for pos in set(pos for chunk in changed
+                       for pos in self._around(chunk.pos)):
+            chunk = self.chunks.get(pos)
+            for node in (chunk and chunk.nav_nodes) or ():
+                conns = self.chunk_mesh[node]
+                for other in [n for n in conns if utils.line_intersects_rect(
+                        node, n, blocker)]:
+                    del conns[other]
+        for chunk in changed:
+            self._mesh_chunk(chunk)
+
+    def plan_path(self, start, goal, planner=None):
+        """Plan as Level.plan_path. Over the nav mesh, start and goal must
+        be in meshed chunks; other paths, and those the mesh cannot find,
+        are planned with jump point search.
+
+        >>> import os; os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+        >>> level = ChunkedLevel((64, 64), 'level_wonly.map', 'mesh',
+        ...                      chunk_size=4, radius=0)
+        >>> level.build_nav_mesh()
+        >>> level.plan_path((16, 104), (112, 72))
+        [(103, 87), (112, 72)]
+        >>> path = level.plan_path((16, 104), (1000, 40))
+        >>> path[-1], path == level.plan_path((16, 104), (1000, 40), 'jps')
+        ((1000, 40), True)
+        """
+        planner = planner or self.planner
+        if planner == 'mesh':
+            for point in (start, goal):
+                chunk = self.chunks.get(self.chunk_at(self.tile_at(point)))
+                if chunk is None or chunk.nav_nodes is None:
+                    break
+            else:
+                if self._chunk_search is None:
+                    self._chunk_search = utils.MeshSearch(self.chunk_mesh)
+                grid = self.grid_array
+                if grid is None:
+                    grid = self.grid
+                path = utils.find_path(start, goal, self.chunk_mesh, grid,
+                                       world.MAP_TILE_SIZE,
+                                       search=self._chunk_search)
+                if path and path[-1] == goal:
+                    return path
+            planner = 'jps'
+        return world.Level.plan_path(self, start, goal, planner)
+
+    def enable_path_workers(self, processes=None):
+        """Not supported: the nav mesh changes with every chunk that is
+        meshed or unmeshed, and the workers only plan over a nav mesh."""
+        raise ValueError('path workers cannot plan in a chunked level')
+
+    def valid_position(self, entity):
+        """Whether the entity is inside the level and has no collision."""
+        return self.bounds.collidepoint(entity.pos) and \
+            not self.collision(entity)
+
+    def outside_screen(self, pos):
+        """Whether pos is outside of the camera."""
+        return not self.camera.collidepoint(pos)
+
+    def collision(self, entity):
+        """Check for collision with a wall or with another object."""
+        rect = entity.real_rect
+        for pos in self.chunks_in(rect):
+            if rect.collidelist(self.walls_of(pos)) != -1:
+                return True
+        # The walls added to the level, and the other objects
+        return world.Level.collision(self, entity)
+
+    def update_objects(self):
+        """Follow the camera with the loaded chunks, then perform the
+        actions of the active objects."""
+        self.update_chunks()
+        world.Level.update_objects(self)
+
+    def _update_grid(self, rect):
+        """Recompute the grid cells under rect from the map and the added
+        walls and return their positions."""
+        self._grid_array = None
+        tiles = []
+        x0, y0 = self.tile_at(rect[:2])
+        x1, y1 = self.tile_at((rect[0] + rect[2] - 1, rect[1] + rect[3] - 1))
+        for y in xrange(max(y0, 0), min(y1 + 1, self.height)):
+            for x in xrange(max(x0, 0), min(x1 + 1, self.width)):
+                cell = pygame.Rect(x * world.MAP_TILE_WIDTH,
+                                   y * world.MAP_TILE_HEIGHT,
+                                   world.MAP_TILE_WIDTH,
+                                   world.MAP_TILE_HEIGHT)
+                self.grid[y][x] = 1 if (
+                    self.walls[y][x] or
+                    cell.collidelist(self.wall_rects) != -1) else 0
+                tiles.append((x, y))
+        for pos in self.chunks_in(rect):
+            if pos in self._chunk_walls:
+                del self._chunk_walls[pos]
+        return tiles
+
+    def render(self):
+        """Return the background seen by the camera and the wall overlays
+        of the chunks it sees. The background is made again when the
+        camera moved, a chunk was loaded or tiles were invalidated. Chunks
+        that are not loaded are left black, render loads none."""
+        if self._tiles is None:
+            self._tiles = world.TileCache(world.MAP_TILE_WIDTH,
+                                          world.MAP_TILE_HEIGHT)[self.tileset]
+        if self._dirty_tiles:
+            for tile in self._dirty_tiles:
+                chunk = self.chunks.get(self.chunk_at(tile))
+                if chunk is not None:
+                    chunk.image = None
+            self._dirty_tiles = set()
+            self._view = None
+        view = self.camera.clip(self.bounds)
+        if self._view is None or self._view_rect != view:
+            self._view_rect = view
+            self._view = pygame.Surface(view.size)
+            for pos in self.chunks_in(view):
+                chunk = self.chunks.get(pos)
+                if chunk is None:
+                    continue # Until update_chunks loads it
+                if chunk.image is None:
+                    self._render_chunk(chunk)
+                rect = self.chunk_rect(pos)
+                self._view.blit(chunk.image, rect.move(-view.x, -view.y))
+        return self._view, self.overlays
+
+    def invalidate_tiles(self, cells=None):
+        """Mark map cells whose contents changed, so render redraws their
+        chunks. Without cells all chunks are rendered again."""
+        if cells is None:
+            for chunk in self.chunks.itervalues():
+                chunk.image = None
+            self._view = None
+            return
+        world.Level.invalidate_tiles(self, cells)
+
+    def _render_chunk(self, chunk):
+        """Draw the tiles of a chunk on its image and set their overlays."""
+        rect = self.chunk_rect(chunk.pos).clip(self.bounds)
+        chunk.image = pygame.Surface(rect.size)
+        x0, y0 = self.tile_at(rect.topleft)
+        x1, y1 = self.tile_at(rect.bottomright)
+        chunk.overlay_tiles = []
+        for map_y in xrange(y0, y1):
+            for map_x in xrange(x0, x1):
+                tile_image, overlay = self._tile_images(map_x, map_y)
+                chunk.image.blit(tile_image,
+                                 ((map_x - x0) * world.MAP_TILE_WIDTH,
+                                  (map_y - y0) * world.MAP_TILE_HEIGHT))
+                self._set_overlay((map_x, map_y), overlay)
+                if overlay is not None:
+                    chunk.overlay_tiles.append((map_x, map_y))
@@ -0,0 +1,265 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom"""
+import numpy
+
+import utils
+from gridarray import wall_mask
+from world import MAP_TILE_WIDTH, MAP_TILE_HEIGHT, ENTITY_CELL_SIZE
+
+# Directions as used by Person.direction
+UP, RIGHT, DOWN, LEFT = xrange(4)
+
+class Crowd(object):
+    """ Struct-of-arrays backend that moves many Person agents at once.
+
+        Positions, velocities, directions and waypoints of all agents are
+        kept in NumPy arrays and advanced with vectorized operations. The
+        agents follow the level's flow fields towards their final_goal and
+        are blocked by walls; unlike Person.collision_move they do not block
+        each other. The sprites are only used for drawing: sync copies the
+        state back into the sprites that are drawn, so the position of an
+        agent is read from pos rather than from its sprite, and query answers
+        collision lookups from the arrays, through a cell index that is
+        rebuilt in one pass per step. Agents that are put to sleep with
+        set_awake stand still and are left out of query until they wake.
+    """
+
+    def __init__(self, people):
+        self.people = list(people)
+        n = len(self.people)
+        self.pos = numpy.array([p.pos for p in self.people],
+                               dtype=float).reshape(n, 2)
+        self.offset = numpy.array([p._offset for p in self.people],
+                                  dtype=float).reshape(n, 2)
+        self.size = numpy.array([p.real_rect.size for p in self.people],
+                                dtype=float).reshape(n, 2)
+        self.sprite_size = numpy.array([p.rect.size for p in self.people],
+                                       dtype=float).reshape(n, 2)
+        self.animation_speed = numpy.array(
+            [p.animation_speed for p in self.people], dtype=int)
+        self.speed = numpy.array([p.speed for p in self.people], dtype=float)
+        self.direction = numpy.array([p.direction for p in self.people],
+                                     dtype=int)
+        self.velocity = numpy.zeros((n, 2))
+        self.waypoint = numpy.zeros((n, 2))
+        goals = [tuple(p.final_goal) for p in self.people]
+        self.goals = sorted(set(goals))
+        self.goal_id = numpy.array([self.goals.index(g) for g in goals],
+                                   dtype=int)
+        self.ticks = 0
+        self.shown = numpy.ones(n, dtype=bool) # Synced on the last call
+        self.awake = numpy.ones(n, dtype=bool)
+        self._index = dict((person, i) for i, person in enumerate(self.people))
+        self._walls = None
+        self._fields = {}
+        self._order = None
+        self._cells = {}
+        self.build_index()
+
+    def __len__(self):
+        return len(self.people)
+
+    def _next_tiles(self, level, goal):
+        """ Flow field of the level towards goal as a NumPy array. """
+        field = level.flow_field(goal)
+        try:
+            cached_field, next_tiles = self._fields[goal]
+            if cached_field is field:
+                return field, next_tiles
+        except KeyError:
+            pass
+        next_tiles = numpy.array(field.next, dtype=int)
+        self._fields[goal] = (field, next_tiles)
+        return field, next_tiles
+
+    def update_waypoints(self, level):
+        """ Look up the next waypoint of every agent in the flow fields.
+            Agents that arrived or cannot reach their goal get a zero
+            velocity.
+        """
+        feet = self.pos + self.offset
+        tx = numpy.floor(feet[:, 0] / MAP_TILE_WIDTH).astype(int)
+        ty = numpy.floor(feet[:, 1] / MAP_TILE_HEIGHT).astype(int)
+        moving = numpy.zeros(len(self), dtype=bool)
+        for goal_id, goal in enumerate(self.goals):
+            field, next_tiles = self._next_tiles(level, goal)
+            mask = self.goal_id == goal_id
+            inside = (mask & (tx >= 0) & (tx < field.width) &
+                      (ty >= 0) & (ty < field.height))
+            index = numpy.where(inside, ty * field.width + tx, 0)
+            nxt = numpy.where(inside, next_tiles[index], -1)
+            has_next = mask & (nxt >= 0)
+            ny, nx = numpy.divmod(nxt, field.width)
+            self.waypoint[has_next, 0] = (nx[has_next] + 0.5) * MAP_TILE_WIDTH
+            self.waypoint[has_next, 1] = (ny[has_next] + 0.5) * MAP_TILE_HEIGHT
+            # In the goal tile itself, walk to the exact goal
+            gx, gy = level.tile_at(goal)
+            at_goal = mask & ~has_next & (tx == gx) & (ty == gy)
+            self.waypoint[at_goal] = goal
+            moving |= has_next | at_goal
+
+        delta = self.waypoint - feet
+        dist = numpy.hypot(delta[:, 0], delta[:, 1])
+        moving &= (dist >= self.speed) & self.awake
+        scale = numpy.where(moving, self.speed / numpy.maximum(dist, 1e-9), 0)
+        self.velocity = delta * scale[:, None]
+
+    def update_directions(self):
+        """ Vectorized Person.change_direction for all moving agents. """
+        dx, dy = self.velocity[:, 0], self.velocity[:, 1]
+        horizontal = numpy.abs(dx * 2) > numpy.abs(dy)
+        direction = numpy.where(horizontal,
+                                numpy.where(dx < 0, LEFT, RIGHT),
+                                numpy.where(dy < 0, UP, DOWN))
+        moving = (dx != 0) | (dy != 0)
+        self.direction = numpy.where(moving, direction, self.direction)
+
+    def blocked(self, pos, walls):
+        """ Which agents at the given positions overlap a wall tile. """
+        height, width = walls.shape
+        left, top = (pos + self.offset).T
+        right = left + self.size[:, 0] - 1
+        bottom = top + self.size[:, 1] - 1
+        hit = numpy.zeros(len(self), dtype=bool)
+        for x in (left, right):
+            for y in (top, bottom):
+                tx = numpy.floor(x / MAP_TILE_WIDTH).astype(int)
+                ty = numpy.floor(y / MAP_TILE_HEIGHT).astype(int)
+                inside = (tx >= 0) & (tx < width) & (ty >= 0) & (ty < height)
+                hit |= ~inside
+                hit[inside] |= walls[ty[inside], tx[inside]]
+        return hit
+
+    def move(self, walls):
+        """ Apply the velocities, sliding along walls like collision_move:
+            try the full step, then only the horizontal and then only the
+            vertical part.
+        """
+        candidates = (self.velocity,
+                      self.velocity * (1, 0),
+                      self.velocity * (0, 1))
+        pending = numpy.ones(len(self), dtype=bool)
+        for step in candidates:
+            new_pos = self.pos + step
+            ok = pending & ~self.blocked(new_pos, walls)
+            self.pos[ok] = new_pos[ok]
+            pending &= ~ok
+
+    def step(self, level):
+        """ Advance all agents by one tick. """
+        if self._walls is None:
+            self._walls = wall_mask(level.grid)
+        self.update_waypoints(level)
+        self.update_directions()
+        self.move(self._walls)
+        self.build_index()
+        self.ticks += 1
+
+    def set_awake(self, people, awake):
+        """ Wake the given people, or put them to sleep if awake is false.
+        """
+        agents = [self._index[person] for person in people]
+        self.awake[agents] = awake
+        self.build_index()
+
+    def real_rects(self, agents=slice(None)):
+        """ Left, top, width and height of the real_rect of the given
+            agents, truncated to whole pixels like a pygame.Rect.
+        """
+        left, top = numpy.trunc(self.pos[agents] + self.offset[agents]).T
+        width, height = self.size[agents].T
+        return left, top, width, height
+
+    def build_index(self):
+        """ Sort the agents that are awake by the cell of ENTITY_CELL_SIZE
+            that holds the top left of their real_rect, for query.
+        """
+        self._cells = {}
+        agents = numpy.flatnonzero(self.awake)
+        if not len(agents):
+            return
+        left, top, width, height = self.real_rects(agents)
+        cx = numpy.floor(left / ENTITY_CELL_SIZE[0]).astype(int)
+        cy = numpy.floor(top / ENTITY_CELL_SIZE[1]).astype(int)
+        order = numpy.lexsort((cx, cy))
+        self._order = agents[order]
+        cx, cy = cx[order], cy[order]
+        starts = numpy.flatnonzero((numpy.diff(cx) != 0) |
+                                   (numpy.diff(cy) != 0)) + 1
+        starts = numpy.concatenate(([0], starts))
+        ends = numpy.concatenate((starts[1:], [len(agents)]))
+        self._cells = dict(zip(zip(cx[starts].tolist(), cy[starts].tolist()),
+                               zip(starts.tolist(), ends.tolist())))
+
+    def query(self, rect):
+        """ The people whose real_rect overlaps rect, by their position in
+            the arrays, which may be ahead of their sprite.
+        """
+        if not self._cells:
+            return []
+        x, y, w, h = rect
+        cw, ch = ENTITY_CELL_SIZE
+        # Agents are indexed by their top left, so look as far up and to
+        # the left as the widest and tallest agent
+        max_w, max_h = self.size.max(axis=0)
+        order, cells = self._order, self._cells
+        parts = []
+        for cy in xrange(int((y - max_h) // ch), int((y + h) // ch) + 1):
+            for cx in xrange(int((x - max_w) // cw), int((x + w) // cw) + 1):
+                cell = cells.get((cx, cy))
+                if cell is not None:
+                    parts.append(order[cell[0]:cell[1]])
+        if not parts:
+            return []
+        agents = numpy.concatenate(parts)
+        left, top, width, height = self.real_rects(agents)
+        hit = ((left < x + w) & (left + width > x) &
+               (top < y + h) & (top + height > y))
+        people = self.people
+        return [people[i] for i in agents[hit].tolist()]
+
+    def invalidate(self):
+        """ Forget cached walls and flow fields, e.g. after the level
+            changed.
+        """
+        self._walls = None
+        self._fields = {}
+
+    def sync(self, area=None):
+        """ Copy positions and walking frames back into the sprites of the
+            agents that overlap area, a rect in pixels such as the camera,
+            and of those that did on the previous call, so the sprites
+            that are drawn are current and those that left area are drawn
+            where they left it. Without area all sprites are synced. The
+            sprites are moved with GameObject.place, as the crowd members
+            are in neither index; returns the number of sprites synced.
+
+            The pos, rect, real_rect, depth, direction and image of sprites
+            outside area stay where they were last synced; self.pos is the
+            position of every agent.
+        """
+        if area is None:
+            inside = numpy.ones(len(self), dtype=bool)
+        else:
+            ax, ay, aw, ah = area
+            x, y = self.pos.T
+            width, height = self.sprite_size.T
+            inside = (x + width > ax) & (x < ax + aw) & \
+                     (y + height > ay) & (y < ay + ah)
+        agents = numpy.flatnonzero(inside | self.shown)
+        self.shown = inside
+        moving = (self.velocity[agents, 0] != 0) | \
+                 (self.velocity[agents, 1] != 0)
+        # Same 4 frame cycle as Person.walk_animation
+        frames = numpy.where(moving,
+                             (self.ticks // self.animation_speed[agents]) % 4,
+                             0)
+        people, Point = self.people, utils.Point
+        for i, (x, y), direction, frame in zip(agents.tolist(),
+                                               self.pos[agents].tolist(),
+                                               self.direction[agents].tolist(),
+                                               frames.tolist()):
+            person = people[i]
+            person.place(Point(x, y))
+            person.direction = direction
+            person.image = person.frames[direction][frame]
+        return len(agents)
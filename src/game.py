@@ -30,6 +30,8 @@ screen_size = (1120, 320)
 screen = pygame.display.set_mode(screen_size)
 
 level = world.Level(screen_size, 'level_wonly.map')
+# Only redraws and updates the parts of the screen that changed
+renderer = world.DirtyRenderer(level, screen, white)
 
 #Loop until the user clicks the close button.
 done = False
@@ -43,21 +45,6 @@ while done == False:
             if event.key == pygame.K_ESCAPE:
                 done = True
 
-    # Set the screen background
-    screen.fill(white)
-
-    # ALL CODE TO DRAW SHOULD GO BELOW THIS COMMENT
-
-    background, overlay_dict = level.render()
-    overlays = pygame.sprite.RenderUpdates()
-    for (x, y), image in overlay_dict.iteritems():
-        overlay = pygame.sprite.Sprite(overlays)
-        overlay.image = image
-        overlay.rect = image.get_rect().move(x * world.MAP_TILE_WIDTH, y * world.MAP_TILE_HEIGHT - world.MAP_TILE_HEIGHT)
-
-    screen.blit(background, (0, 0))
-
-    level.game_objects.clear(screen, background)
     level.update_objects()
 
     # Handle player movement
@@ -83,13 +70,13 @@ while done == False:
     level.move_player(dx*2, dy*2)
     level.player.update(level)
 
-    dirty = level.game_objects.draw(screen)
-    overlays.draw(screen)
-    pygame.display.update(dirty)
-
     # Get mouse position
     click = pygame.mouse.get_pressed()
 
+    # ALL CODE TO DRAW SHOULD GO BELOW THIS COMMENT
+
+    dirty = renderer.draw()
+
     if DEBUG:
         level.draw_nav_mesh(screen)
         for obj in level.game_objects:
@@ -104,6 +91,9 @@ while done == False:
 
         for rect in level.wall_rects:
             pygame.draw.rect(screen, red, rect, 2)
+        # The debug drawing is not tracked, redraw everything next frame
+        renderer.invalidate()
+        dirty = [screen.get_rect()]
 
     # ALL CODE TO DRAW SHOULD GO ABOVE THIS COMMENT
 
@@ -111,7 +101,7 @@ while done == False:
     clock.tick(60)
 
     # Go ahead and update the screen with what we've drawn.
-    pygame.display.flip()
+    pygame.display.update(dirty)
 
 # Be IDLE friendly. If you forget this line, the program will 'hang'
 # on exit.
@@ -0,0 +1,352 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Path planners that search the tile grid directly, so they need no nav mesh
+build. All planners share one interface:
+
+    find_tiles(start_tile, goal_tile) - tiles from start to goal, or []
+    find_path(start, goal)            - waypoints as from utils.find_path
+    update(tiles)                     - after the given tiles changed
+
+Moves are 8-connected without cutting corners past walls, as in
+utils.FlowField, and cost their length in pixels for the tile size.
+"""
+from heapq import heappush, heappop
+from math import sqrt
+
+import astar
+import utils
+
+def tile_path_waypoints(tiles, start, goal, grid, tilesize):
+    """ Turn a tile path into waypoints for Person.update: the centres of
+        the tiles after the first, ending at goal instead of the centre of
+        the last tile, with the waypoints dropped that can be skipped
+        without walking through a wall.
+
+        >>> grid = [[0,0,0],[0,1,0],[0,0,0]]
+        >>> tile_path_waypoints([(0,0),(0,1),(0,2),(1,2),(2,2)], (0.5,0.5),
+        ...                     (2.5,2.5), grid, (1,1))
+        [(0.5, 2.5), (2.5, 2.5)]
+    """
+    if not tiles:
+        return []
+    tw, th = tilesize
+    points = [((x + 0.5) * tw, (y + 0.5) * th) for x, y in tiles[1:-1]]
+    points = [start] + points + [goal]
+    visible = lambda a, b: not utils.line_intersects_grid(a, b, grid,
+                                                          tilesize)
+    path = []
+    anchor, i = start, 1
+    while i < len(points) - 1:
+        if not visible(anchor, points[i + 1]):
+            anchor = points[i]
+            path.append(anchor)
+        i += 1
+    path.append(goal)
+    return path
+
+class GridPlanner(object):
+    """ Base class of the grid planners. Keeps the grid as a flat
+        bytearray with a border of walls, so that neighbours never need a
+        bounds check. Tile (x, y) has index (y + 1) * stride + x + 1.
+
+        >>> import numpy
+        >>> grid = [[0, 1, 0], [0, 0, 1]]
+        >>> GridPlanner(numpy.array(grid)).blocked == GridPlanner(grid).blocked
+        True
+    """
+
+    def __init__(self, grid, tilesize=(1,1)):
+        self.grid = grid
+        self.tilesize = tilesize
+        if hasattr(grid, 'shape'):
+            # A NumPy grid is copied in one go rather than tile by tile
+            import numpy
+            self.height, self.width = grid.shape
+            self.stride = self.width + 2
+            blocked = numpy.pad(numpy.asarray(grid) == 1, 1, 'constant',
+                                constant_values=True)
+            self.blocked = bytearray(blocked.astype(numpy.uint8).tobytes())
+        else:
+            self.width = max(len(row) for row in grid)
+            self.height = len(grid)
+            self.stride = self.width + 2
+            self.blocked = bytearray([1]) * (self.stride * (self.height + 2))
+            self.update((x, y) for y in xrange(self.height)
+                        for x in xrange(self.width))
+        tw, th = float(tilesize[0]), float(tilesize[1])
+        self.tile_width, self.tile_height = tw, th
+        self.diagonal = sqrt(tw ** 2 + th ** 2)
+
+    def index(self, (x, y)):
+        return (y + 1) * self.stride + x + 1
+
+    def tile(self, i):
+        y, x = divmod(i, self.stride)
+        return (x - 1, y - 1)
+
+    def update(self, tiles):
+        """ Copy the given tiles from the grid. """
+        blocked, grid = self.blocked, self.grid
+        for x, y in tiles:
+            try:
+                wall = grid[y][x] == 1
+            except IndexError:
+                wall = True
+            blocked[self.index((x, y))] = wall
+
+    def free(self, tile):
+        x, y = tile
+        return (0 <= x < self.width and 0 <= y < self.height and
+                not self.blocked[self.index(tile)])
+
+    def octile(self, a, b):
+        """ Cost of the shortest 8-connected path between two tile indices
+            on an empty grid.
+        """
+        ay, ax = divmod(a, self.stride)
+        by, bx = divmod(b, self.stride)
+        dx, dy = abs(ax - bx), abs(ay - by)
+        if dx < dy:
+            return dx * self.diagonal + (dy - dx) * self.tile_height
+        return dy * self.diagonal + (dx - dy) * self.tile_width
+
+    def find_tiles(self, start, goal):
+        raise NotImplementedError()
+
+    def find_path(self, start, goal):
+        """ Waypoints in pixels from start to goal like utils.find_path,
+            excluding start and ending at goal.
+        """
+        tw, th = self.tilesize
+        tiles = self.find_tiles((int(start[0] // tw), int(start[1] // th)),
+                                (int(goal[0] // tw), int(goal[1] // th)))
+        return tile_path_waypoints(tiles, start, goal, self.grid,
+                                   self.tilesize)
+
+    def expand_tiles(self, tiles):
+        """ Fill in the tiles between consecutive straight or diagonal
+            jumps of a path.
+        """
+        full = tiles[:1]
+        for (x0, y0), (x1, y1) in zip(tiles, tiles[1:]):
+            dx, dy = cmp(x1, x0), cmp(y1, y0)
+            x, y = x0, y0
+            while (x, y) != (x1, y1):
+                x, y = x + dx, y + dy
+                full.append((x, y))
+        return full
+
+class JumpPointSearch(GridPlanner):
+    """ A* that jumps along straight and diagonal lines of free tiles and
+        only stops at tiles where the path may have to turn, which expands
+        far fewer nodes than A* over all tiles. Gives shortest 8-connected
+        paths.
+
+        >>> grid = [[0,0,0,0,0],
+        ...         [0,1,1,1,0],
+        ...         [0,0,0,1,0],
+        ...         [1,1,0,1,0],
+        ...         [0,0,0,0,0]]
+        >>> jps = JumpPointSearch(grid)
+        >>> jps.find_tiles((0,2), (4,4))
+        [(0, 2), (1, 2), (2, 2), (2, 3), (2, 4), (3, 4), (4, 4)]
+        >>> jps.find_tiles((0,0), (0,4))
+        [(0, 0), (0, 1), (0, 2), (1, 2), (2, 2), (2, 3), (2, 4), (1, 4), (0, 4)]
+    """
+
+    def __init__(self, grid, tilesize=(1,1)):
+        GridPlanner.__init__(self, grid, tilesize)
+        # Sparse, as a search visits few of the tiles of a large grid
+        self.engine = astar.AStarEngine(sparse=True)
+
+    def _jump(self, i, dx, dy, goal):
+        """ First jump point from index i (excluded) in direction dx, dy,
+            or -1 if there is none.
+        """
+        blocked, stride = self.blocked, self.stride
+        step = dy * stride + dx
+        while True:
+            if dx and dy and (blocked[i + dx] or blocked[i + dy * stride]):
+                return -1 # Would cut a corner
+            i += step
+            if blocked[i]:
+                return -1
+            if i == goal:
+                return i
+            if dx and dy:
+                if (self._jump(i, dx, 0, goal) != -1 or
+                    self._jump(i, 0, dy, goal) != -1):
+                    return i
+            elif dx:
+                # A wall behind a free tile above or below forces a turn
+                if ((not blocked[i - stride] and blocked[i - stride - dx]) or
+                    (not blocked[i + stride] and blocked[i + stride - dx])):
+                    return i
+            else:
+                if ((not blocked[i - 1] and blocked[i - 1 - dy * stride]) or
+                    (not blocked[i + 1] and blocked[i + 1 - dy * stride])):
+                    return i
+
+    def _directions(self, i, parent):
+        """ Directions worth searching from index i, coming from parent. """
+        blocked, stride = self.blocked, self.stride
+        if parent == -1:
+            return [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                    if dx or dy]
+        py, px = divmod(parent, stride)
+        y, x = divmod(i, stride)
+        dx, dy = cmp(x, px), cmp(y, py)
+        if dx and dy:
+            return [(dx, dy), (dx, 0), (0, dy)]
+        if dx:
+            return [(dx, 0), (dx, 1), (dx, -1), (0, 1), (0, -1)]
+        return [(0, dy), (1, dy), (-1, dy), (1, 0), (-1, 0)]
+
+    def find_tiles(self, start, goal):
+        """ Tiles of a shortest path from start to goal tile, including
+            both, or [] if there is none.
+        """
+        if not self.free(start) or not self.free(goal):
+            return []
+        if start == goal:
+            return [start]
+        start, goal = self.index(start), self.index(goal)
+        engine = self.engine
+        parent = engine.parent
+        octile = self.octile
+        def expand(i):
+            for dx, dy in self._directions(i, parent[i]):
+                j = self._jump(i, dx, dy, goal)
+                if j != -1:
+                    yield j, octile(i, j)
+        path, length, seen = engine.search(
+            start, expand, lambda i: i == goal, lambda i: octile(i, goal))
+        if not path or path[-1] != goal:
+            return []
+        return self.expand_tiles([self.tile(i) for i in [start] + path])
+
+class ThetaStar(GridPlanner):
+    """ Any-angle A*: a tile can take its parent's parent as parent when
+        the straight line between them is free, so paths are not limited
+        to 8 directions and cost their straight line length.
+
+        >>> grid = [[0,0,0,0,0,0],
+        ...         [0,0,0,1,0,0],
+        ...         [0,0,0,1,0,0],
+        ...         [0,0,0,0,0,0]]
+        >>> theta = ThetaStar(grid)
+        >>> theta.find_tiles((0,0), (5,2))
+        [(0, 0), (4, 0), (5, 2)]
+        >>> theta.find_path((0.5,0.5), (5.5,2.5))
+        [(4.5, 0.5), (5.5, 2.5)]
+    """
+
+    def __init__(self, grid, tilesize=(1,1)):
+        GridPlanner.__init__(self, grid, tilesize)
+        # Only the tiles of the last search, see astar.AStarEngine
+        self.g = astar.SparseArray(0.0)
+        self.parent = astar.SparseArray(-1)
+        self.seen = astar.SparseArray(0)
+        self.closed = astar.SparseArray(0)
+        self.stamp = 0
+
+    def _distance(self, a, b):
+        ay, ax = divmod(a, self.stride)
+        by, bx = divmod(b, self.stride)
+        return sqrt(((ax - bx) * self.tile_width) ** 2 +
+                    ((ay - by) * self.tile_height) ** 2)
+
+    def _line_of_sight(self, a, b):
+        """ Whether the line between the centres of two tiles is free.
+            Two lines just beside it are tested, so that it cannot slip
+            between walls that touch at a corner.
+        """
+        ay, ax = divmod(a, self.stride)
+        by, bx = divmod(b, self.stride)
+        length = sqrt((bx - ax) ** 2 + (by - ay) ** 2)
+        ox = (ay - by) / length * 1e-6
+        oy = (bx - ax) / length * 1e-6
+        for side in (-1, 1):
+            if utils.line_intersects_grid(
+                    (ax - 0.5 + side * ox, ay - 0.5 + side * oy),
+                    (bx - 0.5 + side * ox, by - 0.5 + side * oy), self.grid):
+                return False
+        return True
+
+    def find_tiles(self, start, goal):
+        """ Corner tiles of an any-angle path from start to goal tile,
+            including both, or [] if there is none.
+        """
+        if not self.free(start) or not self.free(goal):
+            return []
+        start, goal = self.index(start), self.index(goal)
+        self.stamp += 1
+        stamp = self.stamp
+        g, parent, seen, closed = self.g, self.parent, self.seen, self.closed
+        for values in (g, parent, seen, closed):
+            values.clear()
+        blocked, stride = self.blocked, self.stride
+        distance, sight = self._distance, self._line_of_sight
+        steps = [(dy * stride + dx, dx, dy) for dx in (-1, 0, 1)
+                 for dy in (-1, 0, 1) if dx or dy]
+        g[start] = 0.0
+        parent[start] = start
+        seen[start] = stamp
+        heap = [(distance(start, goal), start)]
+        while heap:
+            f, i = heappop(heap)
+            if closed[i] == stamp:
+                continue
+            closed[i] = stamp
+            if i == goal:
+                break
+            grand = parent[i]
+            for step, dx, dy in steps:
+                j = i + step
+                if blocked[j] or (dx and dy and (blocked[i + dx] or
+                                                 blocked[i + dy * stride])):
+                    continue
+                if closed[j] == stamp:
+                    continue
+                if grand != i and sight(grand, j):
+                    source = grand
+                else:
+                    source = i
+                new_g = g[source] + distance(source, j)
+                if seen[j] != stamp or new_g < g[j]:
+                    seen[j] = stamp
+                    g[j] = new_g
+                    parent[j] = source
+                    heappush(heap, (new_g + distance(j, goal), j))
+        if closed[goal] != stamp:
+            return []
+        path = [goal]
+        while path[-1] != start:
+            path.append(parent[path[-1]])
+        path.reverse()
+        return [self.tile(i) for i in path]
+
+    def find_path(self, start, goal):
+        """ Waypoints in pixels from start to goal like utils.find_path,
+            excluding start and ending at goal. The corners are seen from
+            the tile centres, so the centre of the start or goal tile is
+            kept when the line from start or to goal is blocked.
+
+            >>> grid = [[0,0,0],[0,0,0],[0,0,1],[0,0,0],[0,0,0]]
+            >>> ThetaStar(grid).find_path((1.9,2.5), (2.5,4.5))
+            [(1.5, 2.5), (2.5, 4.5)]
+        """
+        tw, th = self.tilesize
+        tiles = self.find_tiles((int(start[0] // tw), int(start[1] // th)),
+                                (int(goal[0] // tw), int(goal[1] // th)))
+        if not tiles:
+            return []
+        centres = [((x + 0.5) * tw, (y + 0.5) * th) for x, y in tiles]
+        path = centres[1:-1] + [goal]
+        blocked = lambda a, b: utils.line_intersects_grid(a, b, self.grid,
+                                                          self.tilesize)
+        if len(tiles) > 1 and blocked(start, path[0]):
+            path.insert(0, centres[0])
+        if len(tiles) > 1 and blocked(([start] + path)[-2], goal):
+            path.insert(-1, centres[-1])
+        return path
@@ -0,0 +1,303 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Hierarchical path finding (HPA*) over a tile grid, for maps too large for
+the visibility graph nav mesh. The grid is split into square clusters.
+Where two neighbouring clusters share a run of free tiles on their border
+there is an entrance, a pair of tiles that become nodes of an abstract
+graph. Nodes in the same cluster are connected by their travel distance
+inside the cluster. A query searches the abstract graph and only plans
+tile paths inside the clusters on the abstract path. Paths pass through
+the entrances, so they can be a little longer than the shortest path.
+"""
+from heapq import heappush, heappop
+from math import sqrt
+
+import astar
+import gridplan
+import utils
+
+# Runs of free border tiles at least this long get an entrance at both
+# ends instead of one in the middle
+LONG_ENTRANCE = 6
+
+class HierarchicalGrid(object):
+    """ Cluster graph over a tile grid, 1 is a wall. Moves are 8-connected
+        without cutting corners past walls, as in utils.FlowField, and
+        cost their length in pixels for the given tile size. The grid is
+        not copied: after changing tiles, call update with them.
+
+        >>> grid = [[0,0,0,0,0,0],
+        ...         [0,0,1,0,0,0],
+        ...         [0,0,1,0,0,0],
+        ...         [0,0,1,1,1,0],
+        ...         [0,0,0,0,1,0],
+        ...         [0,0,0,0,1,0]]
+        >>> hpa = HierarchicalGrid(grid, 3)
+        >>> hpa.find_tiles((1,1), (3,4))
+        [(1, 1), (1, 2), (1, 3), (1, 4), (2, 5), (3, 5), (3, 4)]
+        >>> round(hpa.distance((1,1), (3,4)), 2)
+        6.41
+        >>> grid[4][3] = 1; hpa.update([(3,4)])
+        >>> hpa.find_tiles((1,1), (3,4))
+        []
+    """
+
+    def __init__(self, grid, cluster_size=8, tilesize=(1,1)):
+        self.grid = grid
+        self.width = max(len(row) for row in grid)
+        self.height = len(grid)
+        self.cluster_size = cluster_size
+        self.tilesize = tilesize
+        tw, th = float(tilesize[0]), float(tilesize[1])
+        diagonal = sqrt(tw ** 2 + th ** 2)
+        self.steps = ((1,0,tw), (-1,0,tw), (0,1,th), (0,-1,th),
+                      (1,1,diagonal), (-1,1,diagonal), (1,-1,diagonal),
+                      (-1,-1,diagonal))
+        self.columns = (self.width + cluster_size - 1) // cluster_size
+        self.rows = (self.height + cluster_size - 1) // cluster_size
+        self.borders = {} # (cluster, cluster) -> [(tile, tile)]
+        self.inter = {}   # tile -> {tile in a neighbouring cluster: cost}
+        self.intra = {}   # cluster -> {tile: {tile in the cluster: cost}}
+        self.engine = astar.AStarEngine() # For the abstract searches
+        clusters = [(cx, cy) for cy in xrange(self.rows)
+                    for cx in xrange(self.columns)]
+        for cluster in clusters:
+            self._build_borders(cluster)
+        for cluster in clusters:
+            self._build_intra(cluster)
+
+    def free(self, (x, y)):
+        """ Whether tile is inside the grid and not a wall. """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return False
+        try:
+            return self.grid[y][x] != 1
+        except IndexError:
+            return False
+
+    def cluster(self, (x, y)):
+        """ The cluster containing a tile. """
+        return (x // self.cluster_size, y // self.cluster_size)
+
+    def bounds(self, (cx, cy)):
+        """ Tile bounds (x0, y0, x1, y1) of a cluster, excluding x1, y1. """
+        size = self.cluster_size
+        return (cx * size, cy * size, min((cx + 1) * size, self.width),
+                min((cy + 1) * size, self.height))
+
+    def nodes(self, cluster):
+        """ The abstract nodes of a cluster. """
+        return self.intra.get(cluster, {}).keys()
+
+    def _build_borders(self, cluster):
+        """ Find the entrances to the right and bottom neighbours. """
+        cx, cy = cluster
+        x0, y0, x1, y1 = self.bounds(cluster)
+        if cx + 1 < self.columns:
+            pairs = [((x1 - 1, y), (x1, y)) for y in xrange(y0, y1)]
+            self._set_border(cluster, (cx + 1, cy), pairs, self.steps[0][2])
+        if cy + 1 < self.rows:
+            pairs = [((x, y1 - 1), (x, y1)) for x in xrange(x0, x1)]
+            self._set_border(cluster, (cx, cy + 1), pairs, self.steps[2][2])
+
+    def _set_border(self, first, second, pairs, cost):
+        """ Replace the entrances between two clusters, given the pairs of
+            facing tiles along their border.
+        """
+        for a, b in self.borders.pop((first, second), []):
+            for tile, other in ((a, b), (b, a)):
+                del self.inter[tile][other]
+                if not self.inter[tile]:
+                    del self.inter[tile]
+        transitions = []
+        run = []
+        for a, b in pairs + [(None, None)]:
+            if a is not None and self.free(a) and self.free(b):
+                run.append((a, b))
+            elif run:
+                if len(run) >= LONG_ENTRANCE:
+                    transitions.extend((run[0], run[-1]))
+                else:
+                    transitions.append(run[len(run) // 2])
+                run = []
+        for a, b in transitions:
+            self.inter.setdefault(a, {})[b] = cost
+            self.inter.setdefault(b, {})[a] = cost
+        self.borders[(first, second)] = transitions
+
+    def _free_tiles(self, cluster):
+        """ The set of free tiles in a cluster. """
+        x0, y0, x1, y1 = self.bounds(cluster)
+        return set((x, y) for y in xrange(y0, y1) for x in xrange(x0, x1)
+                   if self.free((x, y)))
+
+    def _local_distances(self, source, cluster, targets=None, free=None):
+        """ Dijkstra from source inside cluster. Returns the distances and
+            parents of the tiles reached, stopping early once all targets
+            are reached. free is the set of free tiles of the cluster, if
+            already known.
+        """
+        if free is None:
+            free = self._free_tiles(cluster)
+        left = set(targets) if targets is not None else None
+        dist = {source: 0.0}
+        parent = {source: None}
+        heap = [(0.0, source)]
+        while heap:
+            d, tile = heappop(heap)
+            if d > dist[tile]:
+                continue
+            if left is not None:
+                left.discard(tile)
+                if not left:
+                    break
+            x, y = tile
+            for dx, dy, step in self.steps:
+                nxt = (x + dx, y + dy)
+                if nxt not in free or not ((x + dx, y) in free and
+                                           (x, y + dy) in free):
+                    continue
+                nd = d + step
+                if nd < dist.get(nxt, utils.inf):
+                    dist[nxt] = nd
+                    parent[nxt] = tile
+                    heappush(heap, (nd, nxt))
+        return dist, parent
+
+    def _build_intra(self, cluster):
+        """ Connect the abstract nodes of a cluster by their distance
+            inside it.
+        """
+        cx, cy = cluster
+        nodes = set()
+        for border in ((cluster, (cx + 1, cy)), (cluster, (cx, cy + 1)),
+                       ((cx - 1, cy), cluster), ((cx, cy - 1), cluster)):
+            for a, b in self.borders.get(border, []):
+                nodes.add(a if border[0] == cluster else b)
+        nodes = sorted(nodes)
+        edges = dict((n, {}) for n in nodes)
+        free = self._free_tiles(cluster)
+        for i, a in enumerate(nodes):
+            dist = self._local_distances(a, cluster, nodes[i+1:], free)[0]
+            for b in nodes[i+1:]:
+                if b in dist:
+                    edges[a][b] = edges[b][a] = dist[b]
+        self.intra[cluster] = edges
+
+    def update(self, tiles):
+        """ Bring the entrances and distances up to date after the given
+            tiles changed. Only the clusters of the tiles and their direct
+            neighbours are rebuilt.
+        """
+        changed = set(self.cluster(tile) for tile in tiles)
+        rebuild = set()
+        for cx, cy in changed:
+            for cluster in ((cx, cy), (cx - 1, cy), (cx, cy - 1)):
+                if 0 <= cluster[0] < self.columns and \
+                   0 <= cluster[1] < self.rows:
+                    self._build_borders(cluster)
+            rebuild.update(((cx, cy), (cx - 1, cy), (cx + 1, cy),
+                            (cx, cy - 1), (cx, cy + 1)))
+        for cluster in rebuild:
+            if 0 <= cluster[0] < self.columns and 0 <= cluster[1] < self.rows:
+                self._build_intra(cluster)
+
+    def _abstract_path(self, start, goal):
+        """ Abstract nodes from start to goal, with start and goal
+            connected to the nodes of their clusters for this query.
+        """
+        start_cluster = self.cluster(start)
+        goal_cluster = self.cluster(goal)
+        nodes = self.nodes(start_cluster)
+        if start_cluster == goal_cluster:
+            nodes = nodes + [goal]
+        dist = self._local_distances(start, start_cluster, nodes)[0]
+        start_edges = dict((n, dist[n]) for n in nodes if n in dist)
+        if start_cluster == goal_cluster and goal in start_edges:
+            # Leaving the cluster can only pay off if it is not convex
+            if start_edges[goal] == self._straight(start, goal):
+                return [start, goal]
+        dist = self._local_distances(goal, goal_cluster,
+                                     self.nodes(goal_cluster))[0]
+        goal_edges = dict((n, d) for n, d in dist.iteritems()
+                          if n in self.inter and n != goal)
+
+        intra, inter, cluster = self.intra, self.inter, self.cluster
+        def edges(tile):
+            if tile == start:
+                found = dict(start_edges)
+            else:
+                found = dict(intra[cluster(tile)].get(tile, {}))
+            found.update(inter.get(tile, {}))
+            if tile in goal_edges:
+                found[goal] = goal_edges[tile]
+            return found
+
+        cache = {}
+        def neighbours(tile):
+            if tile not in cache:
+                cache[tile] = edges(tile)
+            return cache[tile]
+        gx, gy = goal
+        tw, th = self.tilesize
+        path, length = astar.astar(
+            start, neighbours, lambda tile: tile == goal, 0,
+            lambda a, b: cache[a][b],
+            lambda (x, y): sqrt(((x - gx) * tw) ** 2 + ((y - gy) * th) ** 2),
+            limit=None, engine=self.engine)
+        if not path or path[-1] != goal:
+            return None
+        return [start] + path
+
+    def _straight(self, a, b):
+        """ Cost of the 8-connected path between two tiles without walls. """
+        dx, dy = abs(a[0] - b[0]), abs(a[1] - b[1])
+        diagonal = self.steps[4][2]
+        if dx < dy:
+            return dx * diagonal + (dy - dx) * self.steps[2][2]
+        return dy * diagonal + (dx - dy) * self.steps[0][2]
+
+    def find_tiles(self, start, goal):
+        """ Tiles of a path from start to goal tile, including both, or []
+            if there is none. It passes through the entrances of the
+            clusters, so it is only close to the shortest path and can be
+            much longer for goals near the start.
+        """
+        if not self.free(start) or not self.free(goal):
+            return []
+        abstract = self._abstract_path(start, goal)
+        if abstract is None:
+            return []
+        tiles = [start]
+        for a, b in zip(abstract, abstract[1:]):
+            if self.cluster(a) != self.cluster(b):
+                tiles.append(b) # Entrance, a single step
+                continue
+            parent = self._local_distances(a, self.cluster(a), [b])[1]
+            segment = []
+            while b is not None and b != a:
+                segment.append(b)
+                b = parent[b]
+            tiles.extend(reversed(segment))
+        return tiles
+
+    def distance(self, start, goal):
+        """ Travel distance between two tiles along find_tiles, inf if
+            unreachable. An upper bound of the shortest distance, not the
+            distance itself.
+        """
+        tiles = self.find_tiles(start, goal)
+        if not tiles:
+            return utils.inf
+        return sum(self._straight(a, b) for a, b in zip(tiles, tiles[1:]))
+
+    def find_path(self, start, goal):
+        """ Waypoints in pixels from start to goal like utils.find_path:
+            the tile path with its corners cut where the grid allows,
+            excluding start and ending at goal.
+        """
+        tw, th = self.tilesize
+        tiles = self.find_tiles((int(start[0] // tw), int(start[1] // th)),
+                                (int(goal[0] // tw), int(goal[1] // th)))
+        return gridplan.tile_path_waypoints(tiles, start, goal, self.grid,
+                                            self.tilesize)
@@ -0,0 +1,252 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Levels compiled from the text .map format to a binary file, so that
+loading does not parse the map and look up the flags of each cell again.
+The file holds grids of the wall and block flags and of the legend entry
+of each cell, the legend itself and the spawn list of the entities. The
+grids are NumPy arrays memory mapped from the file, so a large level is
+only read as far as it is used. The .map file stays the source: the
+compiled file next to it is rebuilt when the map changes.
+
+    python levelfile.py level.map [...]
+
+compiles maps ahead of time, Level compiles them when first loaded.
+"""
+import sys
+import json
+import struct
+import hashlib
+import ConfigParser
+
+COMPILED_EXT = '.level'
+MAGIC = 'CMGLEVEL'
+VERSION = 1
+# magic, version, sha1 of the source, width, height, spawns, legend bytes
+HEADER = struct.Struct('<8sH20sIIII')
+ALIGN = 8
+
+TRUE_VALUES = (True, 1, 'true', 'yes', 'True', 'Yes', '1', 'on', 'On')
+
+def is_true(value):
+    """ Whether a value of the map legend counts as a set flag. """
+    return value in TRUE_VALUES
+
+class LevelData(object):
+    """ The contents of a map. walls, blocks and tiles are grids indexed
+        [y][x]: the wall and block flags and the index in legend of each
+        cell, -1 where a row of the map is shorter than the widest one.
+        legend is a list of (character, description) and spawns a list of
+        (x, y, legend index) of the cells with a sprite. source is the
+        compiled file the grids are mapped from, if any.
+    """
+
+    def __init__(self, tileset, legend, walls, blocks, tiles, spawns,
+                 source=None):
+        self.tileset = tileset
+        self.legend = legend
+        self.walls = walls
+        self.blocks = blocks
+        self.tiles = tiles
+        self.spawns = spawns
+        self.source = source
+        self.height = len(tiles)
+        self.width = len(tiles[0]) if self.height else 0
+
+def parse(filename):
+    """ Read a text .map file into a LevelData of nested lists. Raises
+        KeyError for a map character without a legend entry.
+    """
+    parser = ConfigParser.ConfigParser()
+    parser.read(filename)
+    tileset = parser.get("level", "tileset")
+    rows = parser.get("level", "map").split("\n")
+    legend = [(section, dict(parser.items(section)))
+              for section in sorted(parser.sections()) if len(section) == 1]
+    index = dict((char, i) for i, (char, desc) in enumerate(legend))
+    wall = [int(is_true(desc.get('wall'))) for char, desc in legend]
+    block = [int(is_true(desc.get('block'))) for char, desc in legend]
+    width = max(len(row) for row in rows)
+    walls, blocks, tiles, spawns = [], [], [], []
+    for y, row in enumerate(rows):
+        line = [index[char] for char in row] + [-1] * (width - len(row))
+        tiles.append(line)
+        walls.append([wall[i] if i >= 0 else 0 for i in line])
+        blocks.append([block[i] if i >= 0 else 0 for i in line])
+        for x, i in enumerate(line):
+            if i >= 0 and 'sprite' in legend[i][1]:
+                spawns.append((x, y, i))
+    return LevelData(tileset, legend, walls, blocks, tiles, spawns)
+
+def source_key(filename):
+    """ Hash of a map file, to tell whether its compiled file is current. """
+    with open(filename, 'rb') as source:
+        return hashlib.sha1(source.read()).digest()
+
+def _padded(data):
+    return data + '\0' * (-len(data) % ALIGN)
+
+def save(filename, level, key):
+    """ Write a LevelData to a compiled file, tagged with key. Requires
+        NumPy.
+    """
+    import numpy
+    meta = _padded(json.dumps({'tileset': level.tileset,
+                               'legend': level.legend}))
+    shape = (level.height, level.width)
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, key, level.width, level.height,
+                            len(level.spawns), len(meta)))
+        f.write(meta)
+        for grid, dtype in ((level.walls, '<u1'), (level.blocks, '<u1'),
+                            (level.tiles, '<i2')):
+            data = numpy.asarray(grid, dtype=dtype).reshape(shape)
+            f.write(_padded(data.tostring()))
+        spawns = numpy.asarray(level.spawns, dtype='<i4').reshape(-1, 3)
+        f.write(spawns.tostring())
+
+def load_compiled(filename, key=None):
+    """ Read a file written by save, with the grids memory mapped copy on
+        write. Returns None if the file is missing, damaged or was compiled
+        from a source with a different key. Requires NumPy.
+
+        >>> import os, tempfile
+        >>> level = LevelData('tiles.png', [('#', {'wall': 'true'}),
+        ...     ('.', {}), ('p', {'sprite': 'p.png'})],
+        ...     [[1,1,1],[1,0,0]], [[0,0,0],[0,0,0]], [[0,0,0],[0,1,2]],
+        ...     [(2, 1, 2)])
+        >>> fd, filename = tempfile.mkstemp()
+        >>> save(filename, level, 'k' * 20)
+        >>> loaded = load_compiled(filename, 'k' * 20)
+        >>> loaded.walls.tolist(), loaded.tiles[1, 2], loaded.spawns
+        ([[1, 1, 1], [1, 0, 0]], 2, [(2, 1, 2)])
+        >>> loaded.legend[0], loaded.tileset
+        (('#', {'wall': 'true'}), 'tiles.png')
+        >>> load_compiled(filename, 'x' * 20) is None
+        True
+
+        Cells can be changed, only in the loaded copy:
+
+        >>> loaded.walls[1, 1] = 1; loaded.walls[1].tolist()
+        [1, 1, 0]
+        >>> load_compiled(filename, 'k' * 20).walls[1].tolist()
+        [1, 0, 0]
+        >>> copy_walls(loaded)[1].tolist()
+        [1, 0, 0]
+        >>> os.close(fd); del loaded; os.remove(filename)
+    """
+    import numpy
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            (magic, version, file_key, width, height, n_spawns,
+             meta_size) = HEADER.unpack(header)
+            if (magic, version) != (MAGIC, VERSION) or \
+               (key is not None and file_key != key):
+                return None
+            meta = json.loads(f.read(meta_size).rstrip('\0'))
+    except (IOError, ValueError):
+        return None
+    offset = HEADER.size + meta_size
+    grids = []
+    try:
+        for dtype in ('<u1', '<u1', '<i2'):
+            size = width * height * numpy.dtype(dtype).itemsize
+            if size:
+                # Copy on write: the grids can be edited at runtime
+                # like parsed ones, without changing the file
+                grid = numpy.memmap(filename, dtype, 'c', offset,
+                                    (height, width))
+                # Plain arrays on the same memory index much faster
+                grid = grid.view(numpy.ndarray)
+            else:
+                grid = numpy.zeros((height, width), dtype)
+            grids.append(grid)
+            offset += size + (-size % ALIGN)
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(12 * n_spawns)
+    except (IOError, ValueError):
+        return None
+    if len(data) != 12 * n_spawns:
+        return None
+    spawns = numpy.frombuffer(data, '<i4').reshape(-1, 3)
+    spawns = [tuple(spawn) for spawn in spawns.tolist()]
+    legend = [(str(char), dict((str(k), str(v)) for k, v in desc.items()))
+              for char, desc in meta['legend']]
+    return LevelData(str(meta['tileset']), legend, grids[0], grids[1],
+                     grids[2], spawns, filename)
+
+def copy_walls(level):
+    """ A writable copy of the walls of a LevelData. The walls of a
+        compiled level are mapped from its file again, copy on write, so
+        the copy only takes memory for the pages that are written.
+
+        >>> level = LevelData('tiles.png', [], [[1, 0]], [[0, 0]],
+        ...                   [[0, 0]], [])
+        >>> walls = copy_walls(level); walls[0][1] = 1
+        >>> level.walls, walls
+        ([[1, 0]], [[1, 1]])
+    """
+    if level.source is not None:
+        compiled = load_compiled(level.source)
+        if compiled is not None:
+            return compiled.walls
+    if hasattr(level.walls, 'copy'):
+        return level.walls.copy()
+    return [list(row) for row in level.walls]
+
+def compile_level(filename, target=None):
+    """ Compile a .map file and return its LevelData. Requires NumPy. """
+    if target is None:
+        target = filename + COMPILED_EXT
+    level = parse(filename)
+    save(target, level, source_key(filename))
+    return level
+
+def load(filename):
+    """ Load a level from a .map file or a compiled file. A .map file is
+        loaded from its compiled file, which is compiled first if it is
+        missing or out of date; if that cannot be written, the map is
+        parsed. Without NumPy the map is always parsed, into lists.
+
+        A level edited at runtime renders the changed cells again:
+
+        >>> import os; os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+        >>> import objects, world
+        >>> level = world.Level((64, 64), 'level_wonly.map', planner='jps')
+        >>> hasattr(level.walls, 'shape') # Loaded from the compiled file
+        True
+        >>> overlays = len(level.render()[1])
+        >>> level.walls[0, 0] = 1; level.invalidate_tiles([(0, 0)])
+        >>> len(level.render()[1]) - overlays # The new wall has a top
+        1
+    """
+    try:
+        import numpy
+    except ImportError:
+        return parse(filename)
+    if filename.endswith(COMPILED_EXT):
+        level = load_compiled(filename)
+        if level is None:
+            raise IOError('not a compiled level: %s' % filename)
+        return level
+    key = source_key(filename)
+    target = filename + COMPILED_EXT
+    level = load_compiled(target, key)
+    if level is None:
+        level = parse(filename)
+        try:
+            save(target, level, key)
+        except IOError:
+            return level # Read-only directory, use the parsed map
+        level = load_compiled(target, key) or level
+    return level
+
+if __name__ == '__main__':
+    for name in sys.argv[1:]:
+        compiled = compile_level(name)
+        print '%s: %dx%d, %d entities -> %s' % (
+            name, compiled.width, compiled.height, len(compiled.spawns),
+            name + COMPILED_EXT)
@@ -1,17 +1,11 @@
 import pygame
 import pygame.locals
 
+import objects # Before world, which it imports
+import world
+
 def load_tile_table(filename, width, height):
-    image = pygame.image.load(filename).convert()
-    image_width, image_height = image.get_size()
-    tile_table = []
-    for tile_x in range(0, image_width/width):
-        line = []
-        tile_table.append(line)
-        for tile_y in range(0, image_height/height):
-            rect = (tile_x*width, tile_y*height, width, height)
-            line.append(image.subsurface(rect))
-    return tile_table
+    return world.ASSETS.tiles(filename, width, height)
 
 if __name__=='__main__':
     pygame.init()
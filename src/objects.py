@@ -10,6 +10,9 @@ import utils
 class GameObject(pygame.sprite.Sprite):
     """Abstract superclass for all objects in the game."""
     world = None
+    spatial_index = None # Set by the level to keep collision lookups fast
+    depth_index = None # Set by the level to keep the drawing order sorted
+    depth = None
     def __init__(self, position, frames, real_rect = None):
         super(GameObject, self).__init__()
         self.image = frames[0][0]
@@ -32,21 +35,37 @@ class GameObject(pygame.sprite.Sprite):
     @property
     def tile_pos(self):
         """Return the tile that corresponds to this object's position."""
-        return utils.Point(int(self.pos.x / MAP_TILE_WIDTH),
-                           int(self.pos.y / MAP_TILE_HEIGHT))
+        pos = self._pos
+        return utils.Point(int(pos[0] / MAP_TILE_WIDTH),
+                           int(pos[1] / MAP_TILE_HEIGHT))
 
     def _get_pos(self):
         """Check the current position of the sprite on the map."""
         return self._pos
 
+    def place(self, position):
+        """Move the sprite to position, a utils.Point, without telling the
+        spatial and depth indices; return whether its depth changed."""
+        self._pos = position
+        x, y = position
+        self.rect.x = x
+        self.rect.y = y
+        self.real_rect.x = x + self._offset[0]
+        self.real_rect.y = y + self._offset[1]
+        depth = self.real_rect.bottom
+        if depth != self.depth:
+            self.depth = depth
+            return True
+        return False
+
     def _set_pos(self, position):
         """Set the position and depth of the sprite on the map."""
-        self._pos = utils.Point(position[0], position[1])
-        self.rect.x = self._pos[0]
-        self.rect.y = self._pos[1]
-        self.real_rect.x = self._pos[0] + self._offset[0]
-        self.real_rect.y = self._pos[1] + self._offset[1]
-        self.depth = self.real_rect.midbottom[1]
+        if type(position) is not utils.Point:
+            position = utils.Point(position[0], position[1])
+        if self.place(position) and self.depth_index is not None:
+            self.depth_index.depth_changed(self)
+        if self.spatial_index is not None:
+            self.spatial_index.update(self, self.real_rect)
 
     # Use special getters and setters for pos, that adjust the rect as well
     pos = property(_get_pos, _set_pos)
@@ -98,6 +117,8 @@ class GameObject(pygame.sprite.Sprite):
 
 class Person(GameObject):
     """Class for one person."""
+    use_flow_field = False # Follow the level's shared flow field to final_goal
+    planner = None # One of world.PLANNERS to override the level's planner
 
     def __init__(self, position, image, rect):
         GameObject.__init__(self, position, image, rect)
@@ -147,9 +168,22 @@ class Person(GameObject):
         y = y if y < 320 else 320 -10
         return x, y
 
+    def follow_flow_field(self, level):
+        """Take one step along the level's flow field towards final_goal."""
+        feet = self.pos + self._offset
+        waypoint = level.flow_step(feet, self.final_goal)
+        if waypoint is None or feet.dist(waypoint) < self.speed:
+            return
+        if self.animation is None:
+            self.animation = self.walk_animation()
+        adjusted_pos = utils.Point(waypoint[0], waypoint[1]) - self._offset
+        self.walk_to_place(level, adjusted_pos)
+
     def update(self, level):
-        if not self.path:
-            self.path = level.plan_path(self.pos, self.final_goal)
+        if self.use_flow_field:
+            self.follow_flow_field(level)
+        elif not self.path:
+            self.path = level.request_path(self, self.pos, self.final_goal)
         else:
             if self.animation is None:
                 self.animation = self.walk_animation()
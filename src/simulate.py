@@ -0,0 +1,193 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Headless simulation runner. Loads a level, spawns a crowd of persons and
+steps the world as fast as possible, reporting ticks per second and the
+time spent in each phase. Does not need a display:
+
+    python simulate.py level_wonly.map --agents 200 --ticks 500
+"""
+import os
+import sys
+import time
+import random
+import optparse
+
+# Must be set before pygame initializes its display
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import pygame
+
+import objects
+import world
+
+PERSON_SPRITE = '../img/player_old.png'
+PERSON_RECT = (8, 28, 16, 4)
+CAMERA_SIZE = (1120, 320) # of the camera of a chunked level
+CAMERA_STEP = 4 # pixels the camera of a chunked level pans per tick
+
+class PhaseTimer(object):
+    """Accumulates wall clock time and call counts per named phase."""
+
+    def __init__(self):
+        self.total = {}
+        self.calls = {}
+
+    def wrap(self, name, function):
+        """Return function, timed under the given phase name."""
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - start)
+        return timed
+
+    def add(self, name, seconds):
+        self.total[name] = self.total.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def report(self, ticks, out=sys.stdout):
+        for name in sorted(self.total, key=self.total.get, reverse=True):
+            seconds = self.total[name]
+            out.write('%-16s %9.3f s %9.3f ms/tick %9d calls\n' % (
+                name, seconds, 1000.0 * seconds / max(ticks, 1),
+                self.calls[name]))
+
+def spawn_people(level, count, rng):
+    """Place count persons on random free tiles of the level."""
+    frames = world.TileCache(world.SPRITE_WIDTH,
+                             world.SPRITE_HEIGHT)[PERSON_SPRITE]
+    free = [(x, y) for y, row in enumerate(level.grid)
+            for x, cell in enumerate(row) if cell != 1]
+    people = []
+    attempts = 0
+    while len(people) < count and attempts < 100 * count:
+        attempts += 1
+        x, y = rng.choice(free)
+        position = (x * world.MAP_TILE_WIDTH, y * world.MAP_TILE_HEIGHT)
+        person = objects.Person(position, frames, pygame.Rect(PERSON_RECT))
+        if level.valid_position(person):
+            level.add_object(person)
+            people.append(person)
+    return people
+
+def run(filename, agents=100, ticks=300, seed=0, crowd=False,
+        flow_field=False, render=False, plan_budget=None, workers=None,
+        planner='mesh', chunked=False, out=sys.stdout):
+    """Run the simulation and return the number of ticks per second."""
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    timer = PhaseTimer()
+
+    start = time.time()
+    if chunked:
+        import chunks
+        level = chunks.ChunkedLevel(CAMERA_SIZE, filename, planner)
+    else:
+        level = world.Level((0, 0), filename, planner)
+        level.screen_size = (level.width * world.MAP_TILE_WIDTH,
+                             level.height * world.MAP_TILE_HEIGHT)
+        level.camera = pygame.Rect((0, 0), level.screen_size)
+    timer.add('load', time.time() - start)
+
+    start = time.time()
+    people = spawn_people(level, agents, random.Random(seed))
+    if flow_field:
+        for person in people:
+            person.use_flow_field = True
+    if crowd:
+        level.enable_crowd(people)
+    timer.add('spawn', time.time() - start)
+
+    # Time the phases inside update_objects through the level's methods
+    level.plan_path = timer.wrap('plan_path', level.plan_path)
+    level.collision = timer.wrap('collision', level.collision)
+    level.flow_step = timer.wrap('flow_step', level.flow_step)
+    if workers is not None:
+        level.enable_path_workers(workers or None)
+    elif plan_budget is not None:
+        level.enable_plan_queue(plan_budget)
+    if render:
+        screen = pygame.Surface(level.camera.size if chunked
+                                else level.screen_size)
+        renderer = world.DirtyRenderer(level, screen)
+        renderer.draw()
+        dirty_area = 0
+
+    start = time.time()
+    for tick in xrange(ticks):
+        tick_start = time.time()
+        if chunked:
+            # Sweep the camera along the level, row by row
+            width = level.width * world.MAP_TILE_WIDTH
+            x = tick * CAMERA_STEP
+            level.center_camera((x % width,
+                                 (x // width + 0.5) * CAMERA_SIZE[1]))
+        level.update_objects()
+        timer.add('update_objects', time.time() - tick_start)
+        if render:
+            render_start = time.time()
+            dirty = renderer.draw()
+            timer.add('render', time.time() - render_start)
+            dirty_area += sum(rect.width * rect.height for rect in dirty)
+    elapsed = time.time() - start
+    tps = ticks / elapsed if elapsed > 0 else float('inf')
+
+    out.write('%s: %d agents, %d ticks in %.3f s, %.1f ticks/s\n' % (
+        filename, len(people), ticks, elapsed, tps))
+    if chunked:
+        out.write('%d chunks loaded, %d objects active\n' % (
+            len(level.chunks), len(level.game_objects)))
+    timer.report(ticks, out)
+    if render:
+        out.write('dirty area: %.1f%% of the screen per tick\n' % (
+            100.0 * dirty_area / max(ticks, 1) /
+            (screen.get_width() * screen.get_height())))
+    level.disable_plan_queue()
+    pygame.quit()
+    return tps
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options] [level.map]')
+    parser.add_option('-n', '--agents', type='int', default=100,
+                      help='number of persons to spawn')
+    parser.add_option('-t', '--ticks', type='int', default=300,
+                      help='number of ticks to simulate')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='random seed for spawn positions')
+    parser.add_option('--crowd', action='store_true',
+                      help='use the NumPy crowd backend')
+    parser.add_option('--flow-field', action='store_true',
+                      help='let persons follow the shared flow field')
+    parser.add_option('--render', action='store_true',
+                      help='also draw every tick to an offscreen surface, '
+                           'redrawing only what changed')
+    parser.add_option('--planner', type='choice', choices=world.PLANNERS,
+                      default='mesh', help='path planner, one of: %s' %
+                      ', '.join(world.PLANNERS))
+    parser.add_option('--plan-budget', type='float', default=None,
+                      help='queue path requests, planning them for at most '
+                           'this many ms per tick')
+    parser.add_option('--workers', type='int', default=None,
+                      help='plan paths in this many worker processes '
+                           '(0 for one per core)')
+    parser.add_option('--chunked', action='store_true',
+                      help='stream the level in chunks around a camera '
+                           'that sweeps along it')
+    parser.add_option('--min-tps', type='float', default=None,
+                      help='exit with status 1 below this many ticks/s')
+    options, args = parser.parse_args(argv)
+    if options.chunked and options.workers is not None:
+        parser.error('--workers cannot be used with --chunked')
+    filename = args[0] if args else 'level_wonly.map'
+    tps = run(filename, options.agents, options.ticks, options.seed,
+              options.crowd, options.flow_field, options.render,
+              options.plan_budget, options.workers, options.planner,
+              options.chunked)
+    if options.min_tps is not None and tps < options.min_tps:
+        sys.stderr.write('too slow: %.1f < %.1f ticks/s\n' % (
+            tps, options.min_tps))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
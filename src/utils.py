@@ -1,7 +1,14 @@
 """By Michael Cabot, Steven Laan, Richard Rozeboom"""
 import astar
 import math
-import copy
+import hashlib
+import struct
+import time
+from array import array
+from heapq import heappush, heappop
+from collections import OrderedDict
+from numbers import Number
+from operator import itemgetter
 
 # Shortcuts
 sqrt  = math.sqrt
@@ -10,8 +17,12 @@ try:
 except ValueError:
     inf = 1e1000000
 pi    = math.pi
+AStarEngine = astar.AStarEngine
 astar = astar.astar
 
+_new_tuple = tuple.__new__
+_SCALARS = (int, long, float) # Checked before the slower Number test
+
 class Point(tuple):
     """Point object expands 'tuple' with arithmetic operators:
     >>> Point(4, 5) + Point(6, 5)
@@ -26,82 +37,61 @@ class Point(tuple):
     >>> p.x
     4
 
-    Awesome!"""
+    >>> p.dist((1, 1))
+    5.0
 
-    def __new__(cls, a, b):
-        return super(Point, cls).__new__(cls, tuple((a, b)))
+    Points scale by numbers, from either side, but not by other points:
+    >>> 2 * Point(4, 5)
+    Point(8, 10)
+    >>> Point(4, 5) * Point(1, 2)
+    Traceback (most recent call last):
+    TypeError: can't multiply Point by 'Point', only by a number
 
-    def __init__(self, x, y):
-        super(Point, self).__init__(x, y)
+    Points are used per agent per frame, so they carry no instance dict
+    and the operators build the result tuple directly.
 
-    def __isub__(self, other):
-        if isinstance(other, Point) or isinstance(other, tuple):
-            self = Point(self[0] - other[0], self[1] - other[1])
-            return self
-        else:
-            raise NotImplementedError()
+    Awesome!"""
 
-    def __sub__(self, other):
-        if isinstance(other, Point) or isinstance(other, tuple):
-            return Point(self[0] - other[0], self[1] - other[1])
-        else:
-            raise NotImplementedError()
+    __slots__ = ()
 
-    def __iadd__(self, other):
-        if isinstance(other, Point) or isinstance(other, tuple):
-            self = Point(self[0] + other[0], self[1] + other[1])
-            return self
-        else:
-            raise NotImplementedError()
+    def __new__(cls, x, y):
+        return _new_tuple(cls, (x, y))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    x = property(itemgetter(0))
+    y = property(itemgetter(1))
 
     def __add__(self, other):
-        if isinstance(other, Point) or isinstance(other, tuple):
-            return Point(self[0] + other[0], self[1] + other[1])
-        else:
-            raise NotImplementedError()
+        return _new_tuple(Point, (self[0] + other[0], self[1] + other[1]))
 
-    def __mul__(self, other):
-        if isinstance(other, int) or isinstance(other, float):
-            return Point(self[0] * other, self[1] * other)
-        else:
-            raise NotImplementedError()
+    def __sub__(self, other):
+        return _new_tuple(Point, (self[0] - other[0], self[1] - other[1]))
 
-    def __imul__(self, other):
-        if isinstance(other, int) or isinstance(other, float):
-            self = Point(self[0] * other, self[1] * other)
-            return self
-        else:
-            raise NotImplementedError()
+    def __mul__(self, other):
+        if type(other) not in _SCALARS and not isinstance(other, Number):
+            raise TypeError("can't multiply Point by %r, only by a number"
+                            % type(other).__name__)
+        return _new_tuple(Point, (self[0] * other, self[1] * other))
 
-    def __getattribute__(self, name):
-        if name == 'x':
-            return self[0]
-        elif name == 'y':
-            return self[1]
-        else:
-            return object.__getattribute__(self, name)
+    __rmul__ = __mul__
 
-    def __eq__(self, other):
-        if isinstance(other, Point) or isinstance(other, tuple):
-            return self[0] == other[0] and self[1] == other[1]
-        else:
-            raise NotImplementedError()
+    # Points are immutable, so the in-place operators return new points
+    __iadd__ = __add__
+    __isub__ = __sub__
+    __imul__ = __mul__
 
     def dist(self, other):
-        if isinstance(other, Point) or isinstance(other, tuple):
-            diff = self - other
-            return (diff[0]**2 + diff[1]**2)**0.5
-        else:
-            return NotImplementedError()
+        dx = self[0] - other[0]
+        dy = self[1] - other[1]
+        return (dx*dx + dy*dy) ** 0.5
 
     def dot(self, other):
-        if isinstance(other, Point) or isinstance(other, tuple):
-            return Point(self.x * other[0], self.y * other[1])
-        else:
-            return NotImplementedError()
+        return _new_tuple(Point, (self[0] * other[0], self[1] * other[1]))
 
     def __repr__(self):
-        return 'Point(%s, %s)' % (self.x, self.y)
+        return 'Point(%s, %s)' % self
 
     def __str__(self):
         return self.__repr__()
@@ -299,6 +289,422 @@ def rects_merge(rects):
     # Stack twice, once in each direction
     return stack(stack(rects),horizontal=True)
 
+class LRUCache(object):
+    """ Size-bounded mapping that evicts the least recently used entry
+        and counts hits and misses. With a weigh function, maxsize bounds
+        the total weight of the values instead of their number.
+
+        >>> cache = LRUCache(2)
+        >>> cache['a'] = 1
+        >>> cache['b'] = 2
+        >>> cache.get('a')
+        1
+        >>> cache['c'] = 3
+        >>> cache.get('b') is None
+        True
+        >>> cache.hits, cache.misses
+        (1, 1)
+        >>> cache = LRUCache(10, weigh=len)
+        >>> cache['a'] = 'aaaa'
+        >>> cache['b'] = 'bbbbb'
+        >>> cache['c'] = 'cc'
+        >>> sorted(cache.data), cache.weight
+        (['b', 'c'], 7)
+    """
+
+    def __init__(self, maxsize=1024, weigh=None):
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.weights = {} # key -> weight, only with a weigh function
+        self.weight = 0
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Return the value for key and mark it as recently used. """
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def reject(self, key):
+        """ Drop an entry returned by get that turned out to be unusable,
+            counting that lookup as a miss instead of a hit.
+        """
+        if key in self.data:
+            del self[key]
+        self.hits -= 1
+        self.misses += 1
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            del self[key]
+        self.data[key] = value
+        if self.weigh is None:
+            self.weight = len(self.data)
+        else:
+            self.weights[key] = self.weigh(value)
+            self.weight += self.weights[key]
+        while self.weight > self.maxsize and self.data:
+            del self[next(iter(self.data))]
+
+    def __delitem__(self, key):
+        del self.data[key]
+        if self.weigh is None:
+            self.weight = len(self.data)
+        else:
+            self.weight -= self.weights.pop(key)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def items(self):
+        """ (key, value) pairs from least to most recently used, without
+            touching the order or the counters.
+        """
+        return self.data.items()
+
+    def clear(self):
+        """ Remove all entries, keeping the counters. """
+        self.data.clear()
+        self.weights.clear()
+        self.weight = 0
+
+class PlanQueue(object):
+    """ Queue of path requests that are planned a few at a time, so that
+        many agents asking for a path at once do not stall a single frame.
+        plan(start, goal, **options) computes a path. Every requester has
+        at most one pending request; lower priorities are planned first and
+        equal priorities in order of arrival.
+
+        >>> queue = PlanQueue(lambda start, goal: [start, goal])
+        >>> queue.request('a', (0,0), (1,1), priority=1)
+        >>> queue.request('b', (2,2), (3,3))
+        >>> queue.run(budget=0)
+        1
+        >>> queue.result('a') is None, queue.result('b')
+        (True, [(2, 2), (3, 3)])
+        >>> queue.run(), queue.result('a')
+        (1, [(0, 0), (1, 1)])
+    """
+
+    def __init__(self, plan, budget=2.0):
+        self.plan = plan
+        self.budget = budget # milliseconds per call to run
+        self.pending = {}    # requester -> (priority, number, start, goal,
+                             #               options)
+        self.done = {}       # requester -> path
+        self._heap = []
+        self._count = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def request(self, requester, start, goal, priority=0, **options):
+        """ Ask for a path from start to goal, replacing an earlier request
+            of the same requester that was not planned yet. The options are
+            passed on to plan.
+        """
+        self._count += 1
+        entry = (priority, self._count, start, goal, options)
+        self.pending[requester] = entry
+        self.done.pop(requester, None)
+        heappush(self._heap, entry[:2] + (requester,))
+
+    def result(self, requester):
+        """ Return and forget the planned path of requester, or None if it
+            is not planned yet.
+        """
+        return self.done.pop(requester, None)
+
+    def cancel(self, requester):
+        """ Drop the pending request and planned path of requester. """
+        self.pending.pop(requester, None)
+        self.done.pop(requester, None)
+
+    def run(self, budget=None):
+        """ Plan pending requests until budget milliseconds (by default
+            self.budget) have passed, and return how many were planned. At
+            least one request is planned per call, so the queue always
+            makes progress.
+        """
+        if budget is None:
+            budget = self.budget
+        deadline = time.time() + budget / 1000.0
+        heap, pending = self._heap, self.pending
+        planned = 0
+        while heap:
+            priority, number, requester = heappop(heap)
+            entry = pending.get(requester)
+            if entry is None or entry[1] != number:
+                continue # cancelled or replaced
+            del pending[requester]
+            self.done[requester] = self.plan(entry[2], entry[3], **entry[4])
+            planned += 1
+            if time.time() >= deadline:
+                break
+        return planned
+
+    def clear(self):
+        """ Drop all pending requests and planned paths. """
+        self.pending.clear()
+        self.done.clear()
+        del self._heap[:]
+
+class SpatialHash(object):
+    """ Uniform grid over the plane that maps cells to the items whose
+        rectangles overlap them, for near constant time neighbour queries.
+
+        >>> index = SpatialHash((10,10))
+        >>> index.update('a', (0,0,5,5))
+        >>> index.update('b', (30,30,5,5))
+        >>> sorted(index.query((3,3,4,4)))
+        ['a']
+        >>> index.update('b', (8,8,5,5))
+        >>> sorted(index.query((3,3,4,4)))
+        ['a', 'b']
+        >>> index.remove('a')
+        >>> sorted(index.query((3,3,4,4)))
+        ['b']
+    """
+
+    def __init__(self, cell_size=(64,64)):
+        self.cell_width, self.cell_height = cell_size
+        self.cells = {}
+        self.item_bounds = {}
+
+    def _bounds(self, rect):
+        """ Range of cells (inclusive) covered by rect. """
+        return (int(rect[0] // self.cell_width),
+                int(rect[1] // self.cell_height),
+                int((rect[0] + rect[2]) // self.cell_width),
+                int((rect[1] + rect[3]) // self.cell_height))
+
+    def update(self, item, rect):
+        """ Insert item, or move it to the cells covered by rect. """
+        bounds = self._bounds(rect)
+        old_bounds = self.item_bounds.get(item)
+        if bounds == old_bounds:
+            return
+        if old_bounds is not None:
+            self._unlink(item, old_bounds)
+        self.item_bounds[item] = bounds
+        cells = self.cells
+        x0, y0, x1, y1 = bounds
+        for cx in xrange(x0, x1 + 1):
+            for cy in xrange(y0, y1 + 1):
+                try:
+                    cells[(cx,cy)].add(item)
+                except KeyError:
+                    cells[(cx,cy)] = set([item])
+
+    def remove(self, item):
+        """ Remove item from the index, if present. """
+        bounds = self.item_bounds.pop(item, None)
+        if bounds is not None:
+            self._unlink(item, bounds)
+
+    def _unlink(self, item, bounds):
+        cells = self.cells
+        x0, y0, x1, y1 = bounds
+        for cx in xrange(x0, x1 + 1):
+            for cy in xrange(y0, y1 + 1):
+                cell = cells[(cx,cy)]
+                cell.discard(item)
+                if not cell:
+                    del cells[(cx,cy)]
+
+    def query(self, rect):
+        """ Items in the cells covered by rect. This is a superset of
+            the items that actually overlap rect.
+        """
+        found = set()
+        cells = self.cells
+        x0, y0, x1, y1 = self._bounds(rect)
+        for cx in xrange(x0, x1 + 1):
+            for cy in xrange(y0, y1 + 1):
+                cell = cells.get((cx,cy))
+                if cell:
+                    found.update(cell)
+        return found
+
+    def query_segment(self, p0, p1):
+        """ Items in the cells the line segment from p0 to p1 passes
+            through. This is a superset of the items it intersects.
+
+            >>> index = SpatialHash((10,10))
+            >>> index.update('a', (0,20,5,5))
+            >>> index.update('b', (22,22,5,5))
+            >>> sorted(index.query_segment((0,0),(29,29)))
+            ['b']
+        """
+        (x0, y0), (x1, y1) = p0, p1
+        if y0 > y1:
+            x0, y0, x1, y1 = x1, y1, x0, y0
+        cw, ch = self.cell_width, self.cell_height
+        cells = self.cells
+        found = set()
+        dx, dy = x1 - x0, y1 - y0
+        for row in xrange(int((y0 - 1e-6) // ch), int((y1 + 1e-6) // ch) + 1):
+            # Horizontal extent of the segment within this row of cells
+            if dy:
+                top = max(y0, row * ch)
+                bottom = min(y1, (row + 1) * ch)
+                xa = x0 + dx * (top - y0) / float(dy)
+                xb = x0 + dx * (bottom - y0) / float(dy)
+            else:
+                xa, xb = x0, x1
+            left, right = min(xa, xb) - 1e-6, max(xa, xb) + 1e-6
+            for col in xrange(int(left // cw), int(right // cw) + 1):
+                cell = cells.get((col, row))
+                if cell:
+                    found.update(cell)
+        return found
+
+    def __contains__(self, item):
+        return item in self.item_bounds
+
+    def __len__(self):
+        return len(self.item_bounds)
+
+class FlowField(object):
+    """ Dijkstra distance and direction field over a tile grid towards a
+        single goal tile. Built once, after which any number of agents can
+        look up their next tile in constant time.
+
+        >>> grid = [[0,0,0],[1,1,0],[0,0,0]]
+        >>> field = FlowField(grid, (0,2))
+        >>> field.next_tile((0,0))
+        (1, 0)
+        >>> field.next_tile((2,1))
+        (2, 2)
+        >>> field.distance((0,0))
+        6.0
+        >>> field.next_tile((0,2)) is None
+        True
+    """
+
+    def __init__(self, grid, goal, tilesize=(1,1)):
+        self.width = width = len(grid[0])
+        self.height = height = len(grid)
+        self.goal = goal
+        self.tilesize = tilesize
+        tw, th = float(tilesize[0]), float(tilesize[1])
+        diagonal = sqrt(tw ** 2 + th ** 2)
+        steps = ((1,0,tw), (-1,0,tw), (0,1,th), (0,-1,th),
+                 (1,1,diagonal), (-1,1,diagonal), (1,-1,diagonal),
+                 (-1,-1,diagonal))
+        def free(x, y):
+            if not (0 <= x < width and 0 <= y < height):
+                return False
+            try:
+                return grid[y][x] != 1
+            except IndexError:
+                return False
+        self.dist = dist = [inf] * (width * height)
+        self.next = nxt = [-1] * (width * height)
+        if not free(*goal):
+            return
+        start = goal[1] * width + goal[0]
+        dist[start] = 0.0
+        heap = [(0.0, start)]
+        while heap:
+            d, i = heappop(heap)
+            if d > dist[i]:
+                continue
+            y, x = divmod(i, width)
+            for dx, dy, step in steps:
+                nx, ny = x + dx, y + dy
+                # Do not cut corners past walls
+                if not free(nx, ny) or not (free(nx, y) and free(x, ny)):
+                    continue
+                j = ny * width + nx
+                nd = d + step
+                if nd < dist[j]:
+                    dist[j] = nd
+                    nxt[j] = i
+                    heappush(heap, (nd, j))
+
+    def distance(self, tile):
+        """ Travel distance from tile to the goal, inf if unreachable. """
+        x, y = tile
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return inf
+        return self.dist[y * self.width + x]
+
+    def next_tile(self, tile):
+        """ Next tile on the way to the goal, None if tile is the goal
+            itself or cannot reach it.
+        """
+        x, y = tile
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        j = self.next[y * self.width + x]
+        if j < 0:
+            return None
+        y, x = divmod(j, self.width)
+        return (x, y)
+
+def wall_cell_size(walls, bounds):
+    """ Cell size for a spatial index over walls: roughly one wall per
+        cell, but never smaller than the average wall.
+    """
+    if not walls:
+        return (1, 1)
+    n = max(1, int(len(walls) ** 0.5))
+    avg_w = sum(w[2] for w in walls) / float(len(walls))
+    avg_h = sum(w[3] for w in walls) / float(len(walls))
+    return (max(bounds[2] / float(n), avg_w, 1),
+            max(bounds[3] / float(n), avg_h, 1))
+
+def _wall_index(walls, cell_size):
+    """ SpatialHash over the given wall rectangles. """
+    index = SpatialHash(cell_size)
+    for w in walls:
+        index.update(w, w)
+    return index
+
+def _visible(n1, n2, wall_index):
+    """ Whether no wall in the index blocks the line from n1 to n2. """
+    return not any(line_intersects_rect(n1,n2,w)
+                   for w in wall_index.query_segment(n1, n2))
+
+def _prune_connections(mesh, connections, simplify):
+    """ Remove the given direct connections (length, (n1, n2)) if they
+        are not much shorter than the best indirect path.
+    """
+    for _ in _iter_prune_connections(mesh, connections, simplify):
+        pass
+
+def _iter_prune_connections(mesh, connections, simplify):
+    """ _prune_connections, yielding after each connection. """
+    engine = AStarEngine()
+    def astar_path_length(m, start, end):
+        """ Length of a path from start to end """
+        neighbours = lambda n: m[n].keys()
+        cost       = lambda n1, n2: m[n1][n2]
+        goal       = lambda n: n == end
+        heuristic  = lambda n: point_dist(end, n)
+        nodes, length = astar(start, neighbours, goal, 0, cost, heuristic,
+                              engine=engine)
+        return length
+    connections.sort(reverse=True) # Start with the longest connections
+    for length, (n1, n2) in connections:
+        mesh[n1].pop(n2) # Remove connection to see best path without it
+        alternative_dist = astar_path_length(mesh, n1,n2)
+        # Put the connection back if the alternative is much worse
+        if alternative_dist > (1+simplify) * length:
+            mesh[n1][n2] = length
+        yield
+
 def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
     """ Generate an almost optimal navigation mesh
         between the given walls (rectangles), within
@@ -306,79 +712,861 @@ def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
         Mesh is a dictionary of dictionaries:
             mesh[point1][point2] = distance
     """
+    mesh = {}
+    for _ in iter_nav_mesh(mesh, walls, bounds, offset, simplify, add_points):
+        pass
+    return mesh
+
+def iter_nav_mesh(mesh, walls, bounds=None, offset=7, simplify=0.001,
+                  add_points=[]):
+    """ Build the nav mesh of make_nav_mesh in the empty dict mesh in
+        small steps, yielding after each node is connected and after each
+        connection is pruned, so that the work can be spread over several
+        calls. The mesh is complete once the generator is exhausted.
+
+        >>> mesh = {}
+        >>> steps = list(iter_nav_mesh(mesh, [(1,1,1,1)], (0,0,3,3), 1))
+        >>> len(steps) > 1, mesh == make_nav_mesh([(1,1,1,1)], (0,0,3,3), 1)
+        (True, True)
+    """
     # If bounds not given, assume outer walls are bounds.
     if bounds is None:
         bounds = rects_bound(walls)
     # 1) Offset walls and add nodes on corners
     walls = [rect_offset(w,offset) for w in walls]
+    cell_size = wall_cell_size(walls, bounds)
+    wall_index = _wall_index(walls, cell_size)
     nodes = set(add_points)
     for w in walls:
         for point in rect_corners(w):
     # 2) Remove points that are inside of other walls (or outside bounds)
-            other_walls = filter(lambda x: x!=w,walls)
+            other_walls = wall_index.query((point[0], point[1], 0, 0))
+            other_walls.discard(w)
             if (rect_contains_point(bounds, point) and
                 not any(rect_contains_point(ow, point) for ow in other_walls)):
                 nodes.add((int(point[0]),int(point[1])))
-    # 3) Connect nodes that can "see" eachother
+    # 3) Connect nodes that can "see" eachother, only testing the walls
+    #    near the line between them. Visibility is symmetric, so each
+    #    pair is tested once.
     walls = [rect_offset(w,-0.001) for w in walls]
-    mesh = dict((n,{}) for n in nodes)
+    wall_index = _wall_index(walls, cell_size)
+    visible = set()
+    ordered = sorted(nodes)
+    for i, n1 in enumerate(ordered):
+        for n2 in ordered[i+1:]:
+            if _visible(n1, n2, wall_index):
+                visible.add((n1,n2))
+                visible.add((n2,n1))
+        yield
+    # Fill the mesh in node order: the A* in step 4 has a search limit,
+    # so its result depends on the neighbour order
+    mesh.update((n,{}) for n in nodes)
     for n1 in nodes:
         for n2 in nodes:
-            if n1 != n2:
-                if not any(line_intersects_rect(n1,n2,w) for w in walls):
-                    mesh[n1][n2] = point_dist(n1,n2)
+            if (n1,n2) in visible:
+                mesh[n1][n2] = point_dist(n1,n2)
     # 4) Remove direct connections that are not much shorter than indirect ones
-    def astar_path_length(m, start, end):
-        """ Length of a path from start to end """
-        neighbours = lambda n: m[n].keys()
-        cost       = lambda n1, n2: m[n1][n2]
-        goal       = lambda n: n == end
-        heuristic  = lambda n: point_dist(end, n)
-        nodes, length = astar(start, neighbours, goal, 0, cost, heuristic)
-        return length
     connections = []
     for n1 in mesh:
         for n2 in mesh[n1]:
             connections.append((mesh[n1][n2],(n1,n2)))
-    connections.sort(reverse=True) # Start with the longest connections
-    for length, (n1, n2) in connections:
-        mesh[n1].pop(n2) # Remove connection to see best path without it
-        alternative_dist = astar_path_length(mesh, n1,n2)
-        # Put the connection back if the alternative is much worse
-        if alternative_dist > (1+simplify) * length:
-            mesh[n1][n2] = length
+    for step in _iter_prune_connections(mesh, connections, simplify):
+        yield step
 
-    return mesh
+def _connect_nav_nodes(mesh, nodes, wall_index):
+    """ Connect the given mesh nodes, both ways, to every node they can
+        see and are not yet connected to. Returns the new connections.
+    """
+    connections = []
+    for n1 in nodes:
+        for n2 in mesh:
+            if n2 == n1:
+                continue
+            missing = [(a, b) for a, b in ((n1, n2), (n2, n1))
+                       if b not in mesh[a]]
+            if missing and _visible(n1, n2, wall_index):
+                dist = point_dist(n1, n2)
+                for a, b in missing:
+                    mesh[a][b] = dist
+                    connections.append((dist, (a, b)))
+    return connections
+
+def _remove_nav_node(mesh, node):
+    """ Remove a node and all connections to it from the mesh.
+        Returns the nodes it was connected to.
+    """
+    neighbours = set(mesh.pop(node))
+    for n, conns in mesh.iteritems():
+        if conns.pop(node, None) is not None:
+            neighbours.add(n)
+    return neighbours
+
+def _valid_nav_node(point, grown_walls, own_wall, bounds):
+    """ Step 2 of make_nav_mesh for a single corner point. """
+    return (rect_contains_point(bounds, point) and
+            not any(rect_contains_point(ow, point)
+                    for ow in grown_walls.query((point[0], point[1], 0, 0))
+                    if ow != own_wall))
+
+def nav_mesh_add_wall(mesh, walls, wall, bounds, offset=7, simplify=0.001):
+    """ Update a mesh built by make_nav_mesh(walls, bounds, offset,
+        simplify) in place after adding a wall, which is appended to
+        walls. Only nodes and connections near the wall are touched.
+        Returns the area (the offset wall) in which the mesh changed.
+
+        >>> walls = [(0,0,1,1)]
+        >>> mesh = make_nav_mesh(walls, (-2,-2,8,8), 1)
+        >>> area = nav_mesh_add_wall(mesh, walls, (4,0,1,1), (-2,-2,8,8), 1)
+        >>> sorted(mesh) == sorted(make_nav_mesh(walls, (-2,-2,8,8), 1))
+        True
+        >>> area
+        (3, -1, 3, 3)
+    """
+    grown = rect_offset(wall, offset)
+    blocker = rect_offset(grown, -0.001)
+    walls.append(wall)
+    # Nodes inside the new wall disappear
+    affected = set()
+    for n in [n for n in mesh if rect_contains_point(grown, n)]:
+        affected.update(_remove_nav_node(mesh, n))
+    # Connections through the new wall are blocked
+    for n1, conns in mesh.iteritems():
+        for n2 in [n2 for n2 in conns if line_intersects_rect(n1,n2,blocker)]:
+            del conns[n2]
+            affected.update((n1, n2))
+    # The corners of the new wall become nodes
+    grown_walls = [rect_offset(w,offset) for w in walls]
+    cell_size = wall_cell_size(grown_walls, bounds)
+    grown_index = _wall_index(grown_walls, cell_size)
+    for point in rect_corners(grown):
+        node = (int(point[0]),int(point[1]))
+        if node not in mesh and _valid_nav_node(point, grown_index, grown, bounds):
+            mesh[node] = {}
+            affected.add(node)
+    # Connections that were pruned in favour of a path through the
+    # changed area may be needed again, so reconnect all nodes near it
+    wall_index = _wall_index([rect_offset(w,-0.001) for w in grown_walls],
+                             cell_size)
+    affected.intersection_update(mesh)
+    connections = _connect_nav_nodes(mesh, sorted(affected), wall_index)
+    _prune_connections(mesh, connections, simplify)
+    return grown
+
+def nav_mesh_remove_wall(mesh, walls, wall, bounds, offset=7, simplify=0.001):
+    """ Update a mesh built by make_nav_mesh(walls, bounds, offset,
+        simplify) in place after removing a wall from walls. Raises
+        ValueError if the wall is not in walls. Returns the area (the
+        offset wall) in which the mesh changed.
+
+        >>> walls = [(0,0,1,1), (3,0,1,1)]
+        >>> mesh = make_nav_mesh(walls, (-2,-2,8,8), 1)
+        >>> (2, 2) in mesh
+        False
+        >>> area = nav_mesh_remove_wall(mesh, walls, (3,0,1,1), (-2,-2,8,8), 1)
+        >>> sorted(mesh)
+        [(-1, -1), (-1, 2), (2, -1), (2, 2)]
+    """
+    walls.remove(wall)
+    grown = rect_offset(wall, offset)
+    blocker = rect_offset(grown, -0.001)
+    grown_walls = [rect_offset(w,offset) for w in walls]
+    cell_size = wall_cell_size(grown_walls, bounds)
+    grown_index = _wall_index(grown_walls, cell_size)
+    # Corners of other walls that were hidden by this one become nodes,
+    # the corners of this wall stop being nodes (unless shared)
+    wanted = set()
+    for w in grown_index.query(grown):
+        for point in rect_corners(w):
+            if (rect_contains_point(grown, point) and
+                _valid_nav_node(point, grown_index, w, bounds)):
+                wanted.add((int(point[0]),int(point[1])))
+    affected = set()
+    for point in rect_corners(grown):
+        node = (int(point[0]),int(point[1]))
+        if node in mesh and node not in wanted:
+            affected.update(_remove_nav_node(mesh, node))
+    for node in wanted:
+        if node not in mesh:
+            mesh[node] = {}
+            affected.add(node)
+    wall_index = _wall_index([rect_offset(w,-0.001) for w in grown_walls],
+                             cell_size)
+    # Connections that were blocked by the wall may be free now
+    connections = []
+    nodes = sorted(mesh)
+    for i, n1 in enumerate(nodes):
+        for n2 in nodes[i+1:]:
+            if (n2 not in mesh[n1] and n1 not in mesh[n2] and
+                line_intersects_rect(n1,n2,blocker) and
+                _visible(n1, n2, wall_index)):
+                dist = point_dist(n1, n2)
+                mesh[n1][n2] = mesh[n2][n1] = dist
+                connections.append((dist, (n1, n2)))
+                connections.append((dist, (n2, n1)))
+    affected.intersection_update(mesh)
+    connections.extend(_connect_nav_nodes(mesh, sorted(affected), wall_index))
+    _prune_connections(mesh, connections, simplify)
+    return grown
+
+def nav_mesh_join(mesh, other, near, walls, bounds, offset=7, simplify=0.001):
+    """ Add the mesh other, built by make_nav_mesh for a neighbouring area,
+        to mesh and connect its nodes both ways to the nodes in near that
+        they can see. walls are the walls the lines between them can
+        cross, bounds the area around them.
+
+        >>> left = make_nav_mesh([(1,1,1,1)], (0,0,3,4), 1)
+        >>> right = make_nav_mesh([(5,1,1,1)], (4,0,4,4), 1)
+        >>> walls = [(1,1,1,1), (5,1,1,1)]
+        >>> nav_mesh_join(left, right, list(left), walls, (0,0,8,4), 1)
+        >>> sorted(left) == sorted(make_nav_mesh(walls, (0,0,8,4), 1))
+        True
+        >>> sorted(left[(3, 0)])
+        [(0, 0), (3, 3), (4, 0), (4, 3)]
+    """
+    for _ in iter_nav_mesh_join(mesh, other, near, walls, bounds, offset,
+                                simplify):
+        pass
+
+def iter_nav_mesh_join(mesh, other, near, walls, bounds, offset=7,
+                       simplify=0.001):
+    """ nav_mesh_join in small steps like iter_nav_mesh. mesh is only
+        complete once the generator is exhausted, but it is a valid mesh
+        between the steps.
+    """
+    grown_walls = [rect_offset(w,offset) for w in walls]
+    wall_index = _wall_index([rect_offset(w,-0.001) for w in grown_walls],
+                             wall_cell_size(grown_walls, bounds))
+    for n, conns in other.iteritems():
+        mesh.setdefault(n, {}).update(conns)
+    connections = []
+    for n1 in sorted(other):
+        for n2 in near:
+            if n2 not in other and _visible(n1, n2, wall_index):
+                dist = point_dist(n1, n2)
+                mesh[n1][n2] = mesh[n2][n1] = dist
+                connections.append((dist, (n1, n2)))
+                connections.append((dist, (n2, n1)))
+        yield
+    for step in _iter_prune_connections(mesh, connections, simplify):
+        yield step
+
+# Nav mesh cache file layout (little-endian):
+#   header:     magic, version, sha1 key, node count, edge count,
+#               grid width and height, full and partial visibility counts
+#   nodes:      int32 x, y for each node
+#   edges:      uint32 CSR offsets (node count + 1) and uint32 edge targets
+#   visibility: only if the grid size is not 0, the TileVisibility CSR
+#               arrays: full offsets and targets, partial offsets and targets
+# Edge lengths are not stored, they are recomputed from the node coords.
+NAV_MESH_MAGIC   = 'CMGNAV'
+NAV_MESH_VERSION = 2
+NAV_MESH_HEADER  = struct.Struct('<6sB20sIIIIII')
+BIG_ENDIAN       = struct.pack('=H', 1) == struct.pack('>H', 1)
+
+def nav_mesh_key(map_data, *params):
+    """ Hash of the level source and the parameters the nav mesh was
+        built with, used to tell whether a cached nav mesh is still valid.
+    """
+    key = hashlib.sha1(map_data)
+    key.update(repr(params))
+    return key.digest()
+
+def save_nav_mesh(filename, mesh, key, visibility=None):
+    """ Write a nav mesh, and optionally its TileVisibility, to a compact
+        binary file, tagged with key.
+    """
+    nodes = sorted(mesh)
+    index = dict((n, i) for i, n in enumerate(nodes))
+    coords = array('i')
+    offsets = array('I', [0])
+    targets = array('I')
+    for n in nodes:
+        coords.extend((int(n[0]), int(n[1])))
+        targets.extend(sorted(index[m] for m in mesh[n]))
+        offsets.append(len(targets))
+    sections = [coords, offsets, targets]
+    width = height = n_full = n_partial = 0
+    if visibility is not None:
+        width, height = visibility.width, visibility.height
+        n_full = len(visibility.full_targets)
+        n_partial = len(visibility.partial_targets)
+        sections += [array('I', a) for a in (
+            visibility.full_offsets, visibility.full_targets,
+            visibility.partial_offsets, visibility.partial_targets)]
+    if BIG_ENDIAN:
+        for a in sections:
+            a.byteswap()
+    with open(filename, 'wb') as f:
+        f.write(NAV_MESH_HEADER.pack(NAV_MESH_MAGIC, NAV_MESH_VERSION, key,
+                                     len(nodes), len(targets), width, height,
+                                     n_full, n_partial))
+        for a in sections:
+            f.write(a.tostring())
+
+def load_nav_cache(filename, key, tilesize=(16,16)):
+    """ Read a file written by save_nav_mesh. Returns (mesh, visibility),
+        with visibility None if it was not saved, or None if the file is
+        missing, damaged or was saved with a different key.
+
+        >>> import os, tempfile
+        >>> grid = [[0,0,0,0,0],[0,0,0,0,0],[0,0,1,0,0],[0,0,0,0,0],[0,0,0,0,0]]
+        >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
+        >>> vis = TileVisibility.build(mesh, grid, (1,1))
+        >>> fd, filename = tempfile.mkstemp()
+        >>> key = nav_mesh_key('map', 1, 0.001)
+        >>> save_nav_mesh(filename, mesh, key, vis)
+        >>> loaded_mesh, loaded_vis = load_nav_cache(filename, key, (1,1))
+        >>> loaded_mesh == mesh
+        True
+        >>> loaded_vis.full_nodes((0,0)) == vis.full_nodes((0,0))
+        True
+        >>> os.close(fd); os.remove(filename)
+    """
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    if len(data) < NAV_MESH_HEADER.size:
+        return None
+    (magic, version, file_key, n_nodes, n_edges, width, height, n_full,
+     n_partial) = NAV_MESH_HEADER.unpack_from(data)
+    if (magic, version, file_key) != (NAV_MESH_MAGIC, NAV_MESH_VERSION, key):
+        return None
+    counts = [('i', 2*n_nodes), ('I', n_nodes+1), ('I', n_edges)]
+    if width and height:
+        n_tiles = width * height
+        counts += [('I', n_tiles+1), ('I', n_full),
+                   ('I', n_tiles+1), ('I', n_partial)]
+    sections = []
+    pos = NAV_MESH_HEADER.size
+    for typecode, count in counts:
+        a = array(typecode)
+        end = pos + count * a.itemsize
+        if end > len(data):
+            return None
+        a.fromstring(data[pos:end])
+        if BIG_ENDIAN:
+            a.byteswap()
+        sections.append(a)
+        pos = end
+    coords, offsets, targets = sections[:3]
+    nodes = [(coords[2*i], coords[2*i+1]) for i in xrange(n_nodes)]
+    mesh = {}
+    for i, n in enumerate(nodes):
+        mesh[n] = dict((nodes[j], point_dist(n, nodes[j]))
+                       for j in targets[offsets[i]:offsets[i+1]])
+    visibility = None
+    if width and height:
+        visibility = TileVisibility(nodes, width, height, tilesize,
+                                    *sections[3:])
+    return mesh, visibility
+
+def load_nav_mesh(filename, key):
+    """ Read the nav mesh from a file written by save_nav_mesh.
+        Returns None if the file is missing, damaged or was saved
+        with a different key.
+
+        >>> import os, tempfile
+        >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
+        >>> fd, filename = tempfile.mkstemp()
+        >>> key = nav_mesh_key('map', 1, 0.001)
+        >>> save_nav_mesh(filename, mesh, key)
+        >>> load_nav_mesh(filename, key) == mesh
+        True
+        >>> load_nav_mesh(filename, nav_mesh_key('map', 2, 0.001)) is None
+        True
+        >>> os.close(fd); os.remove(filename)
+    """
+    cache = load_nav_cache(filename, key)
+    if cache is None:
+        return None
+    return cache[0]
+
+class TileVisibility(object):
+    """ For every walkable tile of a grid, the mesh nodes that can be seen
+        from the whole tile and those that can be seen from only part of
+        it, as CSR arrays (offsets per tile into an array of node indices).
+        Attaching a point to the mesh is then a lookup plus exact checks
+        for the partially visible nodes.
+
+        Visibility from a tile is sampled at its corners, edge midpoints
+        and center: a node seen from all samples counts as fully visible,
+        one seen from some of them as partially visible. A node seen from
+        none of them is left out, even if it is visible through a narrow
+        gap from some other point of the tile.
+
+        >>> grid = [[0,0,0,0,0],[0,0,0,0,0],[0,0,1,0,0],[0,0,0,0,0],[0,0,0,0,0]]
+        >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
+        >>> vis = TileVisibility.build(mesh, grid, (1,1))
+        >>> sorted(vis.full_nodes((0,0)))
+        [(1, 1), (1, 4), (4, 1)]
+        >>> sorted(vis.visible_nodes((0.5,0.5), grid))
+        [(1, 1), (1, 4), (4, 1)]
+    """
+
+    # Sample points within a tile, as fractions of the tile size
+    SAMPLES = [(fx, fy) for fx in (0.001, 0.5, 0.999)
+               for fy in (0.001, 0.5, 0.999)]
+
+    def __init__(self, nodes, width, height, tilesize, full_offsets,
+                 full_targets, partial_offsets, partial_targets):
+        self.nodes = nodes
+        self.width = width
+        self.height = height
+        self.tilesize = tilesize
+        self.full_offsets = full_offsets
+        self.full_targets = full_targets
+        self.partial_offsets = partial_offsets
+        self.partial_targets = partial_targets
+
+    @classmethod
+    def build(cls, mesh, grid, tilesize=(16,16)):
+        """ Sample the visibility of every node of mesh from every tile
+            of grid. Uses the batched line tests if grid is a NumPy wall
+            mask.
+        """
+        nodes = sorted(mesh)
+        height = len(grid)
+        width = max(len(row) for row in grid) if height else 0
+        tiles = [(x, y) for y in xrange(height) for x in xrange(width)]
+        walkable = cls._walkable(grid, tiles)
+        walkable_tiles = [tile for tile, free in zip(tiles, walkable) if free]
+        # seen[i][k] is the number of samples of walkable tile k that see
+        # node i
+        seen = [cls._count_seen(n, walkable_tiles, grid, tilesize)
+                for n in nodes]
+        full_offsets, full_targets = array('I', [0]), array('I')
+        partial_offsets, partial_targets = array('I', [0]), array('I')
+        per_tile = len(cls.SAMPLES)
+        k = 0
+        for t in xrange(len(tiles)):
+            if walkable[t]:
+                for i in xrange(len(nodes)):
+                    count = seen[i][k]
+                    if count == per_tile:
+                        full_targets.append(i)
+                    elif count:
+                        partial_targets.append(i)
+                k += 1
+            full_offsets.append(len(full_targets))
+            partial_offsets.append(len(partial_targets))
+        return cls(nodes, width, height, tilesize, full_offsets, full_targets,
+                   partial_offsets, partial_targets)
+
+    @staticmethod
+    def _walkable(grid, tiles):
+        return [x < len(grid[y]) and grid[y][x] != 1 for x, y in tiles]
+
+    @classmethod
+    def _count_seen(cls, node, tiles, grid, tilesize):
+        """ For each of the given walkable tiles, the number of its
+            samples that see node.
+        """
+        if not tiles:
+            return []
+        tw, th = tilesize
+        samples = [((x + fx) * tw, (y + fy) * th)
+                   for x, y in tiles for fx, fy in cls.SAMPLES]
+        per_tile = len(cls.SAMPLES)
+        if hasattr(grid, 'shape'):
+            import gridarray
+            blocked = gridarray.lines_intersect_grid(node, samples, grid,
+                                                     tilesize)
+            return (~blocked).reshape(len(tiles), per_tile).sum(axis=1)
+        clear = [0] * len(tiles)
+        for s, point in enumerate(samples):
+            if not line_intersects_grid(point,node,grid,tilesize):
+                clear[s // per_tile] += 1
+        return clear
+
+    def update(self, mesh, grid, changed):
+        """ Bring the tables up to date after the walls of grid changed
+            on the tiles in changed and mesh was updated for it. Only the
+            lines to new nodes, the lines that pass the changed tiles and
+            the changed tiles themselves are sampled again. Nodes that
+            left the mesh stay in nodes as None, so the indices in the
+            tables keep their meaning.
+
+            >>> grid = [[0]*8 for y in range(6)]; grid[2][2] = 1
+            >>> walls = [(2,2,1,1)]
+            >>> mesh = make_nav_mesh(walls,(0,0,7,5),1)
+            >>> vis = TileVisibility.build(mesh, grid, (1,1))
+            >>> grid[3][5] = 1; area = nav_mesh_add_wall(mesh, walls,
+            ...     (5,3,1,1), (0,0,7,5), 1)
+            >>> vis.update(mesh, grid, [(5,3)])
+            >>> fresh = TileVisibility.build(mesh, grid, (1,1))
+            >>> all(sorted(vis.full_nodes(t)) == sorted(fresh.full_nodes(t))
+            ...     for t in [(x, y) for x in range(8) for y in range(6)])
+            True
+            >>> sorted(vis.full_nodes((7,4)))
+            [(1, 4), (4, 5), (7, 2), (7, 5)]
+        """
+        tw, th = self.tilesize
+        nodes = self.nodes
+        index = dict((n, i) for i, n in enumerate(nodes) if n is not None)
+        for n, i in index.items():
+            if n not in mesh:
+                nodes[i] = None
+                del index[n]
+        added = set()
+        for n in sorted(mesh):
+            if n not in index:
+                index[n] = len(nodes)
+                added.add(len(nodes))
+                nodes.append(n)
+        tiles = [(x, y) for y in xrange(self.height)
+                 for x in xrange(self.width)]
+        walkable = self._walkable(grid, tiles)
+        # The changed tiles get new lists. For the other tiles, a line
+        # from a node to a sample stays within half a tile of the line to
+        # the centre of the tile, so only lines to nodes whose centre line
+        # passes that close to the changed tiles are sampled again.
+        replaced = set(self._tile_index(tile) for tile in changed)
+        replaced.discard(None)
+        redo = dict((t, set(index.itervalues())) for t in replaced)
+        if changed:
+            x0 = min(x for x, y in changed) * tw - 0.5 * tw
+            y0 = min(y for x, y in changed) * th - 0.5 * th
+            x1 = (max(x for x, y in changed) + 1.5) * tw
+            y1 = (max(y for x, y in changed) + 1.5) * th
+            box = (x0, y0, x1 - x0, y1 - y0)
+        centres = [((x + 0.5) * tw, (y + 0.5) * th) for x, y in tiles]
+        if hasattr(grid, 'shape'):
+            import gridarray
+            import numpy
+            centres = numpy.array(centres).reshape(-1, 2)
+        for n, i in index.iteritems():
+            if i in added:
+                crossing = xrange(len(tiles))
+            elif not changed:
+                continue
+            elif hasattr(grid, 'shape'):
+                crossing = gridarray.lines_intersect_rect(
+                    n, centres, box).nonzero()[0].tolist()
+            else:
+                crossing = [t for t, centre in enumerate(centres)
+                            if line_intersects_rect(n, centre, box)]
+            for t in crossing:
+                redo.setdefault(t, set()).add(i)
+        # Sample the lines again, one batch per node
+        per_node = {}
+        for t, ids in redo.iteritems():
+            if walkable[t]:
+                for i in ids:
+                    per_node.setdefault(i, []).append(t)
+        full, partial = {}, {}
+        per_tile = len(self.SAMPLES)
+        for i, ts in per_node.iteritems():
+            counts = self._count_seen(nodes[i], [tiles[t] for t in ts], grid,
+                                      self.tilesize)
+            for t, count in zip(ts, counts):
+                if count == per_tile:
+                    full.setdefault(t, []).append(i)
+                elif count:
+                    partial.setdefault(t, []).append(i)
+        self.full_offsets, self.full_targets = self._patch(
+            self.full_offsets, self.full_targets, redo, replaced, full)
+        self.partial_offsets, self.partial_targets = self._patch(
+            self.partial_offsets, self.partial_targets, redo, replaced,
+            partial)
+
+    @staticmethod
+    def _patch(offsets, targets, redo, replaced, found):
+        """ CSR arrays with the entries of redo[t] of each tile t replaced
+            by those in found[t], or all entries for a tile in replaced.
+        """
+        new_offsets, new_targets = array('I', [0]), array('I')
+        for t in xrange(len(offsets) - 1):
+            start, end = offsets[t], offsets[t+1]
+            ids = redo.get(t)
+            if ids is None:
+                new_targets.extend(targets[start:end])
+            else:
+                kept = [] if t in replaced else [
+                    i for i in targets[start:end] if i not in ids]
+                new_targets.extend(sorted(kept + found.get(t, [])))
+            new_offsets.append(len(new_targets))
+        return new_offsets, new_targets
+
+    def _tile_index(self, tile):
+        x, y = tile
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return None
+
+    def full_nodes(self, tile):
+        """ Nodes visible from every point of the tile. """
+        t = self._tile_index(tile)
+        if t is None:
+            return []
+        nodes = self.nodes
+        return [nodes[i] for i in
+                self.full_targets[self.full_offsets[t]:self.full_offsets[t+1]]
+                if nodes[i] is not None]
+
+    def partial_nodes(self, tile):
+        """ Nodes visible from some sampled points of the tile. """
+        t = self._tile_index(tile)
+        if t is None:
+            return []
+        nodes = self.nodes
+        return [nodes[i] for i in self.partial_targets[
+                    self.partial_offsets[t]:self.partial_offsets[t+1]]
+                if nodes[i] is not None]
+
+    def visible_nodes(self, point, grid):
+        """ Distances from point to the nodes it can see, like the
+            module level visible_nodes. Returns None if the tables have
+            nothing for this point, so the caller can test all nodes.
+        """
+        tile = (int(math.floor(point[0] / float(self.tilesize[0]))),
+                int(math.floor(point[1] / float(self.tilesize[1]))))
+        conns = dict((n, point_dist(point, n)) for n in self.full_nodes(tile))
+        conns.update(visible_nodes(point, self.partial_nodes(tile), grid,
+                                   self.tilesize))
+        return conns or None
+
+class MeshRoutes(object):
+    """ All-pairs shortest paths between the nodes of a static nav mesh:
+        a distance matrix and a next-hop table, so the route between two
+        mesh nodes is read from the tables instead of searched for.
+
+        >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
+        >>> routes = MeshRoutes(mesh)
+        >>> routes.route((1,1), (4,1))
+        [(4, 1)]
+        >>> routes.distance((1,1), (4,4))
+        6.0
+    """
+
+    def __init__(self, mesh):
+        self.nodes = nodes = sorted(mesh)
+        self.index = index = dict((n, i) for i, n in enumerate(nodes))
+        size = len(nodes)
+        edges = [[(index[m], dist) for m, dist in mesh[n].iteritems()]
+                 for n in nodes]
+        self.dist = []
+        self.next_hop = []
+        # One Dijkstra per source, remembering the first hop of each path
+        for source in xrange(size):
+            dist = array('d', [inf]) * size
+            first = array('i', [-1]) * size
+            dist[source] = 0.0
+            first[source] = source
+            heap = [(0.0, source)]
+            while heap:
+                d, i = heappop(heap)
+                if d > dist[i]:
+                    continue
+                for j, step in edges[i]:
+                    nd = d + step
+                    if nd < dist[j]:
+                        dist[j] = nd
+                        first[j] = j if i == source else first[i]
+                        heappush(heap, (nd, j))
+            self.dist.append(dist)
+            self.next_hop.append(first)
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def distance(self, a, b):
+        """ Length of the shortest route from node a to node b. """
+        return self.dist[self.index[a]][self.index[b]]
 
-def find_path(start, end, mesh, grid, tilesize=(16,16)):
+    def route(self, a, b):
+        """ Nodes on the shortest route from a to b, excluding a.
+            Empty if b cannot be reached.
+        """
+        i, j = self.index[a], self.index[b]
+        if self.dist[i][j] == inf:
+            return []
+        nodes, next_hop = self.nodes, self.next_hop
+        path = []
+        while i != j:
+            i = next_hop[i][j]
+            path.append(nodes[i])
+        return path
+
+class MeshSearch(object):
+    """ A nav mesh as CSR adjacency arrays (offsets, targets, costs) for
+        AStarEngine. Built once per mesh; the engine and its arrays are
+        reused by every query, which gives the same paths as find_path
+        with the callback based astar.
+
+        >>> grid = [[0,0,0,0,0],[0,0,0,0,0],[0,0,1,0,0],[0,0,0,0,0],[0,0,0,0,0]]
+        >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
+        >>> find_path((0,0),(4,4),mesh,grid,(1,1),search=MeshSearch(mesh))
+        [(4, 1), (4, 4)]
+    """
+
+    def __init__(self, mesh):
+        self.nodes = nodes = list(mesh)
+        self.index = index = dict((n, i) for i, n in enumerate(nodes))
+        self.offsets = array('I', [0])
+        self.targets = array('I')
+        self.costs = array('d')
+        for n in nodes:
+            for m, dist in mesh[n].iteritems():
+                self.targets.append(index[m])
+                self.costs.append(dist)
+            self.offsets.append(len(self.targets))
+        # Two extra ids for the temporary start and end nodes, with no
+        # edges of their own in the arrays
+        self.offsets.extend([len(self.targets)] * 2)
+        self.edge_count = len(self.targets)
+        self.xs = array('d', [n[0] for n in nodes] + [0.0, 0.0])
+        self.ys = array('d', [n[1] for n in nodes] + [0.0, 0.0])
+        self.engine = AStarEngine(len(nodes) + 2)
+
+    def find(self, start, end, start_conns, end_conns, limit=100):
+        """ Path from start to end over the mesh plus the temporary
+            connections, like the astar call in find_path.
+        """
+        nodes, index = self.nodes, self.index
+        offsets, targets, costs = self.offsets, self.targets, self.costs
+        start_id = index.get(start, len(nodes))
+        end_id = index.get(end, len(nodes) + 1)
+        self.xs[len(nodes)], self.ys[len(nodes)] = start[0], start[1]
+        self.xs[len(nodes)+1], self.ys[len(nodes)+1] = end[0], end[1]
+        exits = dict((index[n], dist) for n, dist in end_conns.iteritems())
+        # The edges of start go after those of the mesh
+        del targets[self.edge_count:], costs[self.edge_count:]
+        for n, dist in start_conns.iteritems():
+            targets.append(index[n])
+            costs.append(dist)
+        spans = {start_id: (self.edge_count, len(targets))}
+        path, length, seen = self.engine.search_arrays(
+            start_id, end_id, offsets, targets, costs, self.xs, self.ys,
+            spans, exits, 0, limit)
+        positions = lambda i: (nodes[i] if i < len(nodes) else
+                               start if i == start_id else end)
+        return [positions(i) for i in path]
+
+def visible_nodes(point, nodes, grid, tilesize=(16,16)):
+    """ Distances from point to each of the nodes it can see on the grid.
+        If grid is a NumPy wall mask (see gridarray.wall_mask), all lines
+        are tested in one vectorized pass.
+
+        >>> visible_nodes((0,0), [(2,2),(0,2)], [[0,0,0],[0,1,0],[0,0,0]], (1,1))
+        {(0, 2): 2.0}
+    """
+    if hasattr(grid, 'shape'):
+        import gridarray
+        nodes = list(nodes)
+        if not nodes:
+            return {}
+        blocked = gridarray.lines_intersect_grid(point, nodes, grid, tilesize)
+        return dict((n, point_dist(point,n))
+                    for n, hit in zip(nodes, blocked) if not hit)
+    return dict((n, point_dist(point,n)) for n in nodes
+                if not line_intersects_grid(point,n,grid,tilesize))
+
+def find_path(start, end, mesh, grid, tilesize=(16,16), routes=None,
+              visibility=None, search=None):
     """ Uses astar to find a path from start to end,
         using the given mesh and tile grid.
 
         >>> grid = [[0,0,0,0,0],[0,0,0,0,0],[0,0,1,0,0],[0,0,0,0,0],[0,0,0,0,0]]
         >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
+        >>> before = dict((n, dict(conns)) for n, conns in mesh.items())
         >>> find_path((0,0),(4,4),mesh,grid,(1,1))
         [(4, 1), (4, 4)]
+        >>> mesh == before
+        True
+
+        With precomputed MeshRoutes for the mesh, the route between the
+        mesh nodes nearest to start and end is read from its tables:
+
+        >>> find_path((0,0),(4,4),mesh,grid,(1,1),MeshRoutes(mesh))
+        [(4, 1), (4, 4)]
+
+        A start on a mesh node is a route end itself, here one the goal
+        can see past the corner of the wall:
+
+        >>> grid = [[0]*6 for y in range(6)]; grid[1][1] = grid[2][1] = 1
+        >>> mesh = make_nav_mesh([(1,1,1,2)],(0,0,5,5),1)
+        >>> find_path((0,0),(1.5,4.5),mesh,grid,(1,1),MeshRoutes(mesh))
+        [(1.5, 4.5)]
+        >>> find_path((0,0),(1.5,4.5),mesh,grid,(1,1))
+        [(1.5, 4.5)]
     """
     # If there is a straight line, just return the end point
     if not line_intersects_grid(start, end, grid, tilesize):
         return [end]
-    # Copy mesh so we can add temp nodes
-    mesh = copy.deepcopy(mesh)
-    # Add temp notes for start
-    mesh[start] = dict([(n, point_dist(start,n)) for n in mesh if not line_intersects_grid(start,n,grid,tilesize)])
-    # Add temp nodes for end:
+    # Temp connections for start and end live in an overlay on top of the
+    # shared mesh, so the mesh itself is never copied or changed.
+    def attach(point):
+        conns = None
+        if visibility is not None:
+            conns = visibility.visible_nodes(point, grid)
+        if conns is None:
+            conns = visible_nodes(point, mesh, grid, tilesize)
+        return conns
+    start_conns = attach(start)
+    end_conns = {}
     if end not in mesh:
-        endconns = [(n, point_dist(end,n)) for n in mesh if not line_intersects_grid(end,n,grid,tilesize)]
-        for n, dst in endconns:
-            mesh[n][end] = dst
+        end_conns = attach(end)
+
+    if routes is not None:
+        if end in mesh:
+            end_conns = {end: 0.0}
+        return _find_route(start, end, start_conns, end_conns, routes)
+
+    if search is not None:
+        return search.find(start, end, start_conns, end_conns)
+
+    def neighbours(n):
+        if n == start:
+            conns = start_conns.keys()
+        else:
+            conns = mesh[n].keys()
+        if n in end_conns:
+            conns.append(end)
+        return conns
+
+    def cost(n1, n2):
+        # The start may be a mesh node the end can see
+        if n2 == end and n1 in end_conns:
+            return end_conns[n1]
+        if n1 == start:
+            return start_conns[n2]
+        return mesh[n1][n2]
 
-    neighbours = lambda n: mesh[n].keys()
-    cost       = lambda n1, n2: mesh[n1][n2]
     goal       = lambda n: n == end
     heuristic  = lambda n: ((n[0]-end[0]) ** 2 + (n[1]-end[1]) ** 2) ** 0.5
     nodes, length = astar(start, neighbours, goal, 0, cost, heuristic)
     return nodes
 
+def _find_route(start, end, start_conns, end_conns, routes):
+    """ Best path over precomputed routes, through one of the mesh nodes
+        visible from start and one visible from end. A start or end that
+        is itself a mesh node is a candidate at distance 0.
+    """
+    if start in routes:
+        start_conns = dict(start_conns)
+        start_conns[start] = 0.0
+    if end in routes:
+        end_conns = dict(end_conns)
+        end_conns[end] = 0.0
+    best, best_pair = inf, None
+    for s, start_dist in start_conns.iteritems():
+        row = routes.dist[routes.index[s]]
+        for e, end_dist in end_conns.iteritems():
+            length = start_dist + row[routes.index[e]] + end_dist
+            if length < best:
+                best, best_pair = length, (s, e)
+    if best_pair is None:
+        return []
+    s, e = best_pair
+    path = routes.route(s, e)
+    if s != start:
+        path.insert(0, s)
+    if not path or path[-1] != end:
+        path.append(end)
+    return path
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -0,0 +1,157 @@
+"""By Michael Cabot, Steven Laan, Richard Rozeboom
+
+Path planning in a pool of worker processes, to use the other cores of
+the machine for planning the paths of a crowd.
+"""
+import os
+import signal
+import tempfile
+import cPickle
+import multiprocessing
+
+import utils
+
+# Read-only copy of the level in each worker process: the file the level
+# data is published in, the shared version of its contents, and the
+# state loaded from it with the version it was loaded at
+_source = None
+_state = None
+_loaded = -1
+
+def _init_worker(filename, version):
+    global _source
+    # SDL turns SIGTERM into a quit event, which would keep Pool.terminate
+    # waiting for workers forked from a game with pygame initialized
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _source = (filename, version)
+
+def _current_state():
+    """ The level data, loaded again if a newer version was published. """
+    global _state, _loaded
+    filename, version = _source
+    current = version.value
+    if current != _loaded:
+        with open(filename, 'rb') as f:
+            mesh, grid, tilesize, visibility = cPickle.load(f)
+        _state = (mesh, grid, tilesize, visibility, utils.MeshSearch(mesh))
+        _loaded = current
+    return _state
+
+def _find_path(start, goal):
+    mesh, grid, tilesize, visibility, search = _current_state()
+    return _loaded, utils.find_path(start, goal, mesh, grid, tilesize,
+                                    visibility=visibility, search=search)
+
+class PathWorkers(object):
+    """ Pool of processes that each hold a copy of the nav mesh and grid
+        and run utils.find_path on them. submit returns an
+        AsyncResult to collect the path from on a later tick.
+
+        It also offers the interface of utils.PlanQueue, so it can serve
+        as the plan queue of a level: request hands a path request to the
+        pool, run collects the finished paths without waiting and result
+        returns them. Priorities are accepted but not used, requests are
+        started as soon as a worker is free.
+
+        The level data reaches the workers through a file and a shared
+        version number: refresh writes a new copy and bumps the version,
+        and each worker loads the file again before its next job. The
+        processes keep running.
+    """
+
+    def __init__(self, mesh, grid, tilesize, visibility=None,
+                 processes=None):
+        self.processes = processes
+        self.pending = {} # requester -> (start, goal, AsyncResult)
+        self.done = {}    # requester -> path
+        self.failures = 0 # Jobs that raised an exception in a worker
+        self.last_error = None
+        fd, self.filename = tempfile.mkstemp(suffix='.paths')
+        os.close(fd)
+        self.version = multiprocessing.Value('i', 0, lock=False)
+        self.pool = None
+        self.refresh(mesh, grid, tilesize, visibility)
+        self.pool = multiprocessing.Pool(processes, _init_worker,
+                                         (self.filename, self.version))
+
+    def __len__(self):
+        return len(self.pending)
+
+    def refresh(self, mesh, grid, tilesize, visibility=None):
+        """ Send the workers new level data. Requests pending on the old
+            data are planned again on the new data.
+        """
+        # Replace the file in one step, then publish it: a worker that
+        # sees the new version always finds the new file
+        fd, filename = tempfile.mkstemp(suffix='.paths',
+                                        dir=os.path.dirname(self.filename))
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump((mesh, grid, tilesize, visibility), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(filename, self.filename)
+        self.version.value += 1
+
+    def submit(self, start, goal):
+        """ Start planning a path and return its AsyncResult. """
+        return self.pool.apply_async(_find_path, (start, goal))
+
+    def request(self, requester, start, goal, priority=0, **options):
+        """ Ask for a path from start to goal, replacing an earlier request
+            of the same requester. The workers always plan over the nav
+            mesh, so options such as a planner are ignored.
+        """
+        self.pending[requester] = (start, goal, self.submit(start, goal))
+        self.done.pop(requester, None)
+
+    def result(self, requester):
+        """ Return and forget the planned path of requester, or None if it
+            is not planned yet.
+        """
+        return self.done.pop(requester, None)
+
+    def cancel(self, requester):
+        """ Drop the pending request and planned path of requester. The
+            worker still finishes it, but the path is thrown away.
+        """
+        self.pending.pop(requester, None)
+        self.done.pop(requester, None)
+
+    def run(self, budget=None):
+        """ Collect the paths that are finished, and return how many. Never
+            waits for a worker, budget is ignored.
+        """
+        collected = 0
+        for requester, (start, goal, job) in self.pending.items():
+            if not job.ready():
+                continue
+            try:
+                version, path = job.get()
+            except Exception, error:
+                # A failed job gives no path instead of stopping the game
+                self.failures += 1
+                self.last_error = error
+                version, path = self.version.value, []
+            if version != self.version.value:
+                # Planned on level data that has been replaced since
+                self.pending[requester] = (start, goal,
+                                           self.submit(start, goal))
+                continue
+            del self.pending[requester]
+            self.done[requester] = path
+            collected += 1
+        return collected
+
+    def clear(self):
+        """ Drop all pending requests and planned paths. """
+        self.pending.clear()
+        self.done.clear()
+
+    def close(self):
+        """ Stop the worker processes. """
+        self.clear()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
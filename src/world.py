@@ -1,7 +1,8 @@
 """By Michael Cabot, Steven Laan, Richard Rozeboom"""
 import pygame
 import astar
-import ConfigParser
+from operator import attrgetter
+import levelfile
 import objects
 import utils
 
@@ -12,30 +13,89 @@ SPRITE_HEIGHT = 32
 
 MAP_TILE_SIZE = (MAP_TILE_WIDTH, MAP_TILE_HEIGHT)
 
-class TileCache:
-    """Load the tilesets lazily into global cache"""
-
-    def __init__(self,  width=32, height=None):
-        self.width = width
-        self.height = height or width
-        self.cache = {}
-
-    def __getitem__(self, filename):
-        """Return a table of tiles, load it from disk if needed."""
-
-        key = (filename, self.width, self.height)
-        try:
-            return self.cache[key]
-        except KeyError:
-            tile_table = self._load_tile_table(filename, self.width,
-                                               self.height)
-            self.cache[key] = tile_table
-            return tile_table
-
-    def _load_tile_table(self, filename, width, height):
-        """Load an image and split it into tiles."""
-
-        image = pygame.image.load(filename).convert()
+NAV_MESH_OFFSET = 7
+NAV_MESH_SIMPLIFY = 0.001
+NAV_MESH_CACHE_EXT = '.navmesh'
+
+PATH_CACHE_SIZE = 1024
+PLAN_BUDGET = 2.0 # milliseconds of queued path planning per tick
+HPA_CLUSTER_SIZE = 8 # tiles per side of a cluster of the hierarchical planner
+# Path planners for plan_path: the nav mesh or one of the grid planners
+PLANNERS = ('mesh', 'hpa', 'jps', 'theta')
+
+ENTITY_CELL_SIZE = (2 * MAP_TILE_WIDTH, 4 * MAP_TILE_HEIGHT)
+
+ASSET_CACHE_BYTES = 64 * 1024 * 1024 # of decoded images and tile tables
+
+def surface_bytes(value):
+    """Bytes of pixels of a surface or of nested lists of them, each
+    surface counted once. A subsurface counts its own size, not the whole
+    of its parent."""
+    seen = set()
+    total = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, pygame.Surface):
+            if id(item) not in seen:
+                seen.add(id(item))
+                total += (item.get_width() * item.get_height() *
+                          item.get_bytesize())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return total
+
+
+class AssetCache(object):
+    """Images loaded once per process and converted to the pixel format of
+    the display, with the things derived from them such as tile tables.
+    Entries are weighed by their pixel memory, and the least recently used
+    are evicted when they exceed max_bytes. A tile table holds its own copy
+    of the image rather than the cached one, so every entry owns the pixels
+    it is weighed by. Nothing is cached before the display is set, as
+    images cannot be converted to its pixel format yet."""
+
+    def __init__(self, max_bytes=ASSET_CACHE_BYTES):
+        self.entries = utils.LRUCache(max_bytes, weigh=surface_bytes)
+        self.loads = 0 # Images decoded from disk
+
+    @property
+    def memory(self):
+        """Bytes of pixel memory held by the cached entries."""
+        return self.entries.weight
+
+    def variant(self, key, make):
+        """The entry for key, made by calling make if it is not cached."""
+        value = self.entries.get(key)
+        if value is None:
+            value = make()
+            if pygame.display.get_surface() is not None:
+                self.entries[key] = value
+        return value
+
+    def image(self, filename):
+        """The image in filename, keeping its per-pixel alpha if any."""
+        return self.variant(('image', filename),
+                            lambda: self._load_image(filename))
+
+    def _load_image(self, filename):
+        self.loads += 1
+        image = pygame.image.load(filename)
+        if pygame.display.get_surface() is None:
+            return image # No display format to convert to yet
+        if image.get_flags() & pygame.SRCALPHA:
+            return image.convert_alpha()
+        return image.convert()
+
+    def tiles(self, filename, width, height):
+        """The image in filename split into a table of tiles, indexed by
+        column and row. The tiles are subsurfaces, so a tileset stays one
+        packed surface."""
+        return self.variant(('tiles', filename, width, height),
+                            lambda: self._split(self._load_image(filename),
+                                                width, height))
+
+    def _split(self, image, width, height):
         image_width, image_height = image.get_size()
         tile_table = []
         for tile_x in range(0, image_width/width):
@@ -46,86 +106,391 @@ class TileCache:
                 line.append(image.subsurface(rect))
         return tile_table
 
+    def clear(self):
+        self.entries.clear()
+
     def __repr__(self):
-        return str(self.cache)
+        return '%s(%d entries, %d bytes)' % (self.__class__.__name__,
+                                             len(self.entries), self.memory)
+
+# Shared by all levels of the process
+ASSETS = AssetCache()
+
+
+class TileCache:
+    """Tables of tiles of one size, from the shared asset cache"""
+
+    def __init__(self,  width=32, height=None, assets=ASSETS):
+        self.width = width
+        self.height = height or width
+        self.assets = assets
+
+    def __getitem__(self, filename):
+        """Return a table of tiles, load it from disk if needed."""
+        return self.assets.tiles(filename, self.width, self.height)
+
+    def __repr__(self):
+        return repr(self.assets)
 
     def __str__(self):
         return self.__repr__()
 
 
 class SortedUpdates(pygame.sprite.RenderUpdates):
-    """A sprite group that sorts them by depth."""
+    """A sprite group that sorts them by depth. The order is kept between
+    calls and only repaired after a sprite was added or reported a change
+    of its depth with depth_changed."""
+
+    def __init__(self, *sprites):
+        self._order = []
+        self._unsorted = False
+        pygame.sprite.RenderUpdates.__init__(self, *sprites)
+
+    def add_internal(self, sprite):
+        pygame.sprite.RenderUpdates.add_internal(self, sprite)
+        self._order.append(sprite)
+        self._unsorted = True
+
+    def remove_internal(self, sprite):
+        pygame.sprite.RenderUpdates.remove_internal(self, sprite)
+        self._order.remove(sprite)
+
+    def depth_changed(self, sprite):
+        """Note that sprite changed its depth."""
+        self._unsorted = True
 
     def sprites(self):
         """The list of sprites in the group, sorted by depth."""
-        return sorted(self.spritedict.keys(), key=lambda sprite: sprite.depth)
+        if self._unsorted:
+            # Sprites only move a little per frame, so the order is nearly
+            # right and sort, which merges the sorted runs it finds, takes
+            # close to linear time
+            self._order.sort(key=attrgetter('depth'))
+            self._unsorted = False
+        return list(self._order)
+
+    def unsorted(self):
+        """The list of sprites in the group, without repairing their
+        order."""
+        return list(self._order)
+
+
+class WallOverlay(pygame.sprite.Sprite):
+    """The top of a wall tile, drawn over the tile above it. Sprites behind
+    the wall are hidden by it, sprites in front of it are drawn over it."""
+
+    def __init__(self, tile, image):
+        pygame.sprite.Sprite.__init__(self)
+        x, y = tile
+        self.image = image
+        self.rect = image.get_rect().move(x * MAP_TILE_WIDTH,
+                                          (y - 1) * MAP_TILE_HEIGHT)
+        # Sprites standing below the middle of the wall tile are in front
+        self.depth = y * MAP_TILE_HEIGHT + MAP_TILE_HEIGHT // 2
+
+
+class DirtyRenderer(object):
+    """Draws a level on a screen, only touching the regions that changed
+    since the previous frame: where a sprite moved or changed its image,
+    where a sprite was removed and where background tiles were redrawn.
+    Each region is restored from the background, and the sprites and wall
+    overlays that overlap it are drawn again clipped to it, in depth
+    order. draw returns the regions for pygame.display.update.
+
+    The screen shows the level from the top left of level.camera, where
+    the background returned by level.render starts."""
+
+    def __init__(self, level, screen, color=(255, 255, 255)):
+        self.level = level
+        self.screen = screen
+        self.color = color # Of the screen outside the level
+        self.backdrop = None
+        self._background = None
+        self.drawn = {} # sprite -> (image, rect on screen) as last drawn
+        self.offset = (0, 0) # Top left of the camera when last drawn
+        self.overlays = [] # The wall overlays of the level by depth
+        self.overlay_rects = []
+        level.redrawn_tiles = []
+
+    def draw(self):
+        """Bring the screen up to date and return the changed rects."""
+        level, screen = self.level, self.screen
+        background, overlays = level.render()
+        if background is not self._background:
+            return self.draw_all()
+        backdrop = self.backdrop
+        ox, oy = self.offset
+        dirty = []
+        for x, y in level.redrawn_tiles:
+            # The overlay of a wall tile covers the tile above it
+            rect = pygame.Rect(x * MAP_TILE_WIDTH - ox,
+                               (y - 1) * MAP_TILE_HEIGHT - oy,
+                               MAP_TILE_WIDTH, 2 * MAP_TILE_HEIGHT)
+            backdrop.blit(background, rect, rect)
+            dirty.append(rect)
+        if level.redrawn_tiles:
+            self._sort_overlays(overlays)
+            del level.redrawn_tiles[:]
+
+        sprites = level.game_objects.sprites()
+        drawn, self.drawn = self.drawn, {}
+        rects = []
+        for sprite in sprites:
+            image, rect = sprite.image, sprite.rect.move(-ox, -oy)
+            rects.append(rect)
+            last = drawn.pop(sprite, None)
+            if last is None:
+                dirty.append(pygame.Rect(rect))
+            elif last[0] is not image or last[1] != rect:
+                if last[1].colliderect(rect):
+                    dirty.append(last[1].union(rect))
+                else:
+                    dirty.append(last[1])
+                    dirty.append(pygame.Rect(rect))
+            else:
+                self.drawn[sprite] = last
+                continue
+            self.drawn[sprite] = (image, pygame.Rect(rect))
+        for image, rect in drawn.itervalues():
+            dirty.append(rect) # Removed sprites
+
+        # Merge overlapping regions, so crowds are not drawn several times
+        merged = []
+        for area in dirty:
+            i = area.collidelist(merged)
+            while i != -1:
+                area = area.union(merged.pop(i))
+                i = area.collidelist(merged)
+            merged.append(area)
+        dirty = merged
+
+        depth = lambda (sprite, rect): sprite.depth
+        for area in dirty:
+            screen.set_clip(area)
+            screen.blit(backdrop, area, area)
+            # Both lists are sorted by depth, so this sort only merges them
+            hits = [(sprites[i], rects[i]) for i in area.collidelistall(rects)]
+            hits.extend((self.overlays[i], self.overlay_rects[i])
+                        for i in area.collidelistall(self.overlay_rects))
+            hits.sort(key=depth)
+            for sprite, rect in hits:
+                screen.blit(sprite.image, rect)
+        screen.set_clip(None)
+        return dirty
+
+    def _sort_overlays(self, overlays):
+        ox, oy = self.offset
+        self.overlays = overlays.sprites()
+        self.overlay_rects = [overlay.rect.move(-ox, -oy)
+                              for overlay in self.overlays]
+
+    def invalidate(self):
+        """Redraw the whole screen on the next call of draw, e.g. after
+        drawing something else on it."""
+        self._background = None
+
+    def draw_all(self):
+        """Redraw the whole screen and return its rect."""
+        level, screen = self.level, self.screen
+        background, overlays = level.render()
+        del level.redrawn_tiles[:]
+        self._background = background
+        self.offset = level.camera.topleft
+        self._sort_overlays(overlays)
+        self.backdrop = pygame.Surface(screen.get_size())
+        self.backdrop.fill(self.color)
+        self.backdrop.blit(background, (0, 0))
+        screen.blit(self.backdrop, (0, 0))
+        self.drawn = {}
+        ox, oy = self.offset
+        sprites = level.game_objects.sprites()
+        for sprite in sprites:
+            self.drawn[sprite] = (sprite.image, sprite.rect.move(-ox, -oy))
+        for sprite in sorted(sprites + self.overlays,
+                             key=lambda sprite: sprite.depth):
+            screen.blit(sprite.image, sprite.rect.move(-ox, -oy))
+        return [screen.get_rect()]
 
 
 class Level(object):
 
-    def __init__(self, screen_size, filename="level.map"):
+    def __init__(self, screen_size, filename="level.map", planner='mesh'):
         self.screen_size = screen_size
+        self.camera = pygame.Rect((0, 0), screen_size) # What the screen shows
+        self.filename = filename
         self.wall_rects = []
+        self._background = None
+        self._overlays = {} # tile -> WallOverlay
+        self.overlays = SortedUpdates() # Wall overlays, kept between frames
+        self._dirty_tiles = set()
+        self.redrawn_tiles = None # Tiles rendered, kept for a DirtyRenderer
+        self.flow_fields = {}
+        self.path_cache = utils.LRUCache(PATH_CACHE_SIZE)
+        self.routes = None
+        self.tile_visibility = None
+        self.wall_listeners = []
+        self._grid_array = None
+        self.crowd = None
+        self._crowd_members = set()
+        self.plan_queue = None
+        self.planner = planner
+        self.grid_planners = {}
+        self._nav_mesh = None
+        self._walls_edited = False
         self.load_file(filename)
-        sprite_cache = TileCache(SPRITE_WIDTH, SPRITE_HEIGHT)
         self.game_objects = SortedUpdates()
+        self.entity_index = utils.SpatialHash(ENTITY_CELL_SIZE)
 
         for tile_pos, tile in self.items.iteritems():
-            position = (tile_pos[0] * MAP_TILE_WIDTH,
-                        tile_pos[1] * MAP_TILE_HEIGHT)
-            sprite = sprite_cache[tile["sprite"]]
-            parsed_rect = [int(v) for v in tile["rect"].split(', ')]
-            rect = pygame.Rect(parsed_rect)
-
-            if tile["name"] == "player": # Create a player
-                self.player = objects.Player(position, sprite, rect)
-                entity = self.player
-            elif tile["name"] == "person": # Create a player
-                entity  = objects.Person(position, sprite, rect)
-            #elif tile["name"] == "wall": # Found a wall
-            #    rect.move_ip(position[0], position[1])
-            #    self.wall_rects.append(rect)
-            #    continue
-            else:
-                entity = objects.GameObject(position, sprite, rect)
-
-            self.game_objects.add(entity)
+            self.add_object(self.spawn(tile_pos, tile))
 
         self.wall_rects = utils.rects_merge(self.wall_rects)
-        self.nav_mesh = utils.make_nav_mesh(self.wall_rects)
+        self.nav_bounds = utils.rects_bound(self.wall_rects or [
+            (0, 0, self.width * MAP_TILE_WIDTH,
+             self.height * MAP_TILE_HEIGHT)])
+        if planner == 'mesh':
+            self.build_nav_mesh(filename)
+        # Otherwise the nav mesh is only built if it is used
+
+    def spawn(self, tile_pos, tile):
+        """Create the entity described by a legend entry on a tile."""
+        position = (tile_pos[0] * MAP_TILE_WIDTH,
+                    tile_pos[1] * MAP_TILE_HEIGHT)
+        sprite = TileCache(SPRITE_WIDTH, SPRITE_HEIGHT)[tile["sprite"]]
+        parsed_rect = [int(v) for v in tile["rect"].split(', ')]
+        rect = pygame.Rect(parsed_rect)
+
+        if tile["name"] == "player": # Create a player
+            self.player = objects.Player(position, sprite, rect)
+            return self.player
+        elif tile["name"] == "person": # Create a player
+            return objects.Person(position, sprite, rect)
+        #elif tile["name"] == "wall": # Found a wall
+        #    rect.move_ip(position[0], position[1])
+        #    self.wall_rects.append(rect)
+        #    continue
+        return objects.GameObject(position, sprite, rect)
 
     def load_file(self, filename):
-        self.map = []
-        self.key = {}
-
-        parser = ConfigParser.ConfigParser()
-        parser.read(filename)
-        self.tileset = parser.get("level", "tileset")
-        self.map = parser.get("level", "map").split("\n")
-
-        for section in parser.sections():
-            if len(section) == 1:
-                desc = dict(parser.items(section))
-                self.key[section] = desc
-        self.width = len(self.map[0])
-        self.height = len(self.map)
+        """Load a .map file, through its compiled form if NumPy is
+        available (see levelfile), or a compiled level file."""
+        data = self._load_legend(filename)
 
         self.items = {}
-        self.grid = []
-        for y, line in enumerate(self.map):
-            gridline = []
-            for x, c in enumerate(line):
-                if self.is_wall(x, y):
+        for x, y, i in data.spawns:
+            self.items[(x, y)] = self.legend[i][1]
+        if hasattr(self.walls, 'tolist'):
+            self.grid = self.walls.tolist()
+        else:
+            self.grid = [list(row) for row in self.walls]
+        for y, gridline in enumerate(self.grid):
+            for x, cell in enumerate(gridline):
+                if cell:
                     rect = pygame.Rect(x * MAP_TILE_WIDTH, y * MAP_TILE_HEIGHT, MAP_TILE_WIDTH, MAP_TILE_HEIGHT)
                     self.wall_rects.append(rect)
-                    gridline.append(1)
-                else:
-                    gridline.append(0)
 
-                if 'sprite' in self.key[c]:
-                    self.items[(x, y)] = self.key[c]
-
-            self.grid.append(gridline)
+    def _load_legend(self, filename):
+        """Load the level data and set up the per cell lookups of the map,
+        return the levelfile.LevelData."""
+        data = levelfile.load(filename)
+        self.tileset = data.tileset
+        self.legend = data.legend
+        self.key = dict(data.legend)
+        self.walls, self.blocks, self.tiles = data.walls, data.blocks, data.tiles
+        self.width = data.width
+        self.height = data.height
+        self._legend_tiles = []
+        for char, desc in self.legend:
+            try:
+                tile = desc['tile'].split(',')
+                self._legend_tiles.append((int(tile[0]), int(tile[1])))
+            except (ValueError, KeyError, IndexError):
+                self._legend_tiles.append(None)
+        return data
+
+    def _get_nav_mesh(self):
+        if self._nav_mesh is None:
+            self.build_nav_mesh(self.filename,
+                                use_cache=not self._walls_edited)
+        return self._nav_mesh
+
+    def _set_nav_mesh(self, mesh, visibility=None):
+        """Replace the nav mesh and the TileVisibility built for it, if
+        any, dropping paths planned on the old one and sending the new
+        mesh to the path workers."""
+        self._nav_mesh = mesh
+        self.tile_visibility = visibility
+        self.mesh_search = utils.MeshSearch(mesh)
+        self.path_cache.clear()
+        if self.plan_queue is not None:
+            self.plan_queue.done.clear()
+        if self.routes is not None:
+            self.routes = utils.MeshRoutes(mesh)
+        if self._refresh_workers in self.wall_listeners:
+            self._refresh_workers()
+
+    nav_mesh = property(_get_nav_mesh, _set_nav_mesh)
+
+    def enable_routes(self):
+        """Precompute all shortest routes between the nav mesh nodes, so
+        plan_path only has to attach start and end to the mesh."""
+        self.routes = utils.MeshRoutes(self.nav_mesh)
+
+    def build_nav_mesh(self, filename, offset=NAV_MESH_OFFSET,
+                       simplify=NAV_MESH_SIMPLIFY, use_cache=True):
+        """Load the nav mesh and the per-tile visible nodes from the cache
+        file next to the map, or build them from the wall rects and cache
+        them if the map or the mesh parameters changed. Without use_cache
+        they are always built and not saved, e.g. after walls were edited
+        in a level without nav mesh."""
+        with open(filename, 'rb') as map_file:
+            key = utils.nav_mesh_key(map_file.read(), offset, simplify,
+                                     MAP_TILE_SIZE)
+        cache_file = filename + NAV_MESH_CACHE_EXT
+        cache = None
+        if use_cache:
+            cache = utils.load_nav_cache(cache_file, key, MAP_TILE_SIZE)
+        if cache is None or cache[1] is None:
+            mesh = utils.make_nav_mesh(self.wall_rects, offset=offset,
+                                       simplify=simplify)
+            grid = self.grid_array
+            if grid is None:
+                grid = self.grid
+            self._set_nav_mesh(mesh, utils.TileVisibility.build(
+                mesh, grid, MAP_TILE_SIZE))
+            if not use_cache:
+                return
+            try:
+                utils.save_nav_mesh(cache_file, mesh, key,
+                                    self.tile_visibility)
+            except IOError:
+                pass # Read-only location, just build again next time
+        else:
+            self._set_nav_mesh(*cache)
+
+    def build_tile_visibility(self):
+        """Precompute which nav mesh nodes are visible from each tile."""
+        grid = self.grid_array
+        if grid is None:
+            grid = self.grid
+        self.tile_visibility = utils.TileVisibility.build(self.nav_mesh, grid,
+                                                          MAP_TILE_SIZE)
+
+    def add_object(self, entity):
+        """Add an entity to the level and to the collision index."""
+        self.game_objects.add(entity)
+        entity.spatial_index = self.entity_index
+        entity.depth_index = self.game_objects
+        self.entity_index.update(entity, entity.real_rect)
+
+    def remove_object(self, entity):
+        """Remove an entity from the level and from the collision index."""
+        self.game_objects.remove(entity)
+        self.entity_index.remove(entity)
+        entity.spatial_index = None
+        entity.depth_index = None
+        if self.plan_queue is not None:
+            self.plan_queue.cancel(entity)
 
     def walk_animation(self, direction):
         """Start walking in specified direction."""
@@ -157,15 +522,30 @@ class Level(object):
             pos.x > self.screen_size[0] or pos.y > self.screen_size[1]
 
     def collision(self, entity):
-        """Check for collision."""
+        """Check for collision with a wall or with another object."""
         if entity.real_rect.collidelist(self.wall_rects) != -1:
             return True
 
-        self.game_objects.remove(entity) # do not detect collision with itself
-        collided = pygame.sprite.spritecollideany(entity, self.game_objects,
-                                                  self.real_rect_collision)
-        self.game_objects.add(entity)
-        return collided
+        real_rect = entity.real_rect
+        for other in self.entity_index.query(real_rect):
+            if other is not entity and real_rect.colliderect(other.real_rect):
+                return other
+        if self.crowd is not None:
+            for other in self.crowd.query(real_rect):
+                if other is not entity:
+                    return other
+        return None
+
+    def neighbours(self, entity, radius):
+        """Return the objects whose real_rect lies within radius of the
+        real_rect of the given entity."""
+        area = entity.real_rect.inflate(2 * radius, 2 * radius)
+        found = [other for other in self.entity_index.query(area)
+                 if other is not entity and area.colliderect(other.real_rect)]
+        if self.crowd is not None:
+            found.extend(other for other in self.crowd.query(area)
+                         if other is not entity)
+        return found
 
     def real_rect_collision(self, sprite1, sprite2):
         """Detect collision between the real_rect variables of the given
@@ -174,93 +554,449 @@ class Level(object):
 
     def update_objects(self):
         """Perform the actions of each object."""
-        for obj in self.game_objects:
-            obj.update(self)
+        if self.crowd is not None:
+            self.crowd.step(self)
+            # Only the sprites that are drawn are brought up to date
+            if self.crowd.sync(self.camera):
+                self.game_objects.depth_changed(None)
+            # The others in depth order, without sorting the whole crowd
+            in_crowd = self._crowd_members
+            others = [obj for obj in self.game_objects.unsorted()
+                      if obj not in in_crowd]
+            others.sort(key=attrgetter('depth'))
+            for obj in others:
+                obj.update(self)
+        else:
+            for obj in self.game_objects:
+                obj.update(self)
+        if self.plan_queue is not None:
+            self.plan_queue.run()
+
+    def enable_crowd(self, people=None):
+        """Move the given people (by default every Person except the player)
+        with the vectorized NumPy crowd backend instead of their own update
+        method. Requires NumPy. The crowd answers the collision lookups for
+        its members, which leave the collision index and no longer report
+        their depth one by one. Their sprites are only kept current while
+        they are drawn; Crowd.pos holds where every member is."""
+        import crowd
+        self.disable_crowd()
+        if people is None:
+            people = [obj for obj in self.game_objects
+                      if type(obj) is objects.Person]
+        self.crowd = crowd.Crowd(people)
+        self._crowd_members = set(self.crowd.people)
+        for person in self.crowd.people:
+            self.entity_index.remove(person)
+            person.spatial_index = None
+            person.depth_index = None
+        return self.crowd
+
+    def disable_crowd(self):
+        """Let the crowd members update themselves again."""
+        if self.crowd is None:
+            return
+        self.crowd.sync()
+        for person in self.crowd.people:
+            if self.game_objects.has(person):
+                person.spatial_index = self.entity_index
+                person.depth_index = self.game_objects
+                self.entity_index.update(person, person.real_rect)
+        self.game_objects.depth_changed(None)
+        self.crowd = None
+        self._crowd_members = set()
 
     def get_tile(self, x, y):
         """Tell what's at the specified position of the map."""
         try:
-            char = self.map[y][x]
+            i = self.tiles[y][x]
         except IndexError:
             return {}
-        try:
-            return self.key[char]
-        except KeyError:
+        if i < 0:
             return {}
+        return self.legend[i][1]
 
     def is_wall(self, x, y):
-        return self.get_bool(x, y, 'wall')
+        try:
+            return bool(self.walls[y][x])
+        except IndexError:
+            return False
 
     def get_bool(self, x, y, name):
         """Tell if the specified flag is set for position on the map."""
 
-        value = self.get_tile(x, y).get(name)
-        return value in (True, 1, 'true', 'yes', 'True', 'Yes', '1', 'on', 'On')
+        return levelfile.is_true(self.get_tile(x, y).get(name))
 
     def is_blocking(self, x, y):
         """Is this place blocking movement?"""
 
         if not 0 <= x < self.width or not 0 <= y < self.height:
             return True
-        return self.get_bool(x, y, 'block')
+        return bool(self.blocks[y][x])
+
+    def plan_path(self, start, goal, planner=None):
+        """Return optimal path from start to goal. planner is one of
+        PLANNERS, by default the level's planner. Paths are cached by
+        planner, start and goal tile and reused for nearby queries when
+        still valid."""
+        planner = planner or self.planner
+        key = (planner, self.tile_at(start), self.tile_at(goal))
+        cached = self.path_cache.get(key)
+        if cached is not None:
+            path = self._reuse_path(cached, start, goal)
+            if path is not None:
+                return path
+            self.path_cache.reject(key)
+
+        if planner != 'mesh':
+            path = self.grid_planner(planner).find_path(start, goal)
+        else:
+            grid = self.grid_array
+            if grid is None:
+                grid = self.grid
+            path = utils.find_path(start, goal, self.nav_mesh, grid,
+                                   MAP_TILE_SIZE, self.routes,
+                                   self.tile_visibility, self.mesh_search)
+        self.path_cache[key] = (tuple(path), goal, start)
+        return path
 
-    def plan_path(self, start, goal):
-        """Return optimal path from start to goal."""
+    def grid_planner(self, kind):
+        """Return the planner over the grid of the given kind, building it
+        on first use: 'hpa' for hierarchical path finding, which scales
+        best to large maps, 'jps' for jump point search or 'theta' for
+        any-angle Theta*."""
+        planner = self.grid_planners.get(kind)
+        if planner is not None:
+            return planner
+        if kind == 'hpa':
+            import hpa
+            planner = hpa.HierarchicalGrid(self.grid, HPA_CLUSTER_SIZE,
+                                           MAP_TILE_SIZE)
+        elif kind == 'jps':
+            import gridplan
+            planner = gridplan.JumpPointSearch(self.grid, MAP_TILE_SIZE)
+        elif kind == 'theta':
+            import gridplan
+            planner = gridplan.ThetaStar(self.grid, MAP_TILE_SIZE)
+        else:
+            raise ValueError('unknown grid planner %r' % (kind,))
+        self.grid_planners[kind] = planner
+        return planner
+
+    def enable_plan_queue(self, budget=PLAN_BUDGET):
+        """Let request_path plan paths through a queue that gets budget
+        milliseconds per call of update_objects, instead of planning them
+        right away."""
+        self.plan_queue = utils.PlanQueue(self.plan_path, budget)
+        return self.plan_queue
+
+    def enable_path_workers(self, processes=None):
+        """Let request_path plan paths in a pool of worker processes (by
+        default one per core) that hold a copy of the nav mesh and grid.
+        The copies are refreshed whenever the nav mesh changes."""
+        import workers
+        self.disable_plan_queue()
+        grid = self.grid_array
+        if grid is None:
+            grid = self.grid
+        self.plan_queue = workers.PathWorkers(self.nav_mesh, grid,
+                                              MAP_TILE_SIZE,
+                                              self.tile_visibility, processes)
+        self.wall_listeners.append(self._refresh_workers)
+        return self.plan_queue
+
+    def _refresh_workers(self, area=None):
+        grid = self.grid_array
+        if grid is None:
+            grid = self.grid
+        self.plan_queue.refresh(self.nav_mesh, grid, MAP_TILE_SIZE,
+                                self.tile_visibility)
+
+    def disable_plan_queue(self):
+        """Plan requested paths right away again, stopping the path
+        workers if there are any."""
+        if self._refresh_workers in self.wall_listeners:
+            self.wall_listeners.remove(self._refresh_workers)
+            self.plan_queue.close()
+        self.plan_queue = None
+
+    def request_path(self, requester, start, goal, priority=None):
+        """Path from start to goal for requester. Without a plan queue this
+        is plan_path. With one, returns the path once it is planned and None
+        until then, so the requester keeps its current route or idles in
+        the meantime. By default requesters on screen are planned first.
+        The planner attribute of requester, if set, overrides the level's
+        planner."""
+        planner = getattr(requester, 'planner', None)
+        queue = self.plan_queue
+        if queue is None:
+            return self.plan_path(start, goal, planner)
+        path = queue.result(requester)
+        if path is None and requester not in queue.pending:
+            if priority is None:
+                priority = 1 if self.outside_screen(start) else 0
+            queue.request(requester, start, goal, priority, planner=planner)
+        return path
 
-        path = utils.find_path(start, goal, self.nav_mesh, self.grid, MAP_TILE_SIZE)
+    def _reuse_path(self, cached, start, goal):
+        """Adapt a cached path to a new start and goal in the same tiles.
+        Returns None if the waypoints cannot be seen from the new ends."""
+        path, cached_goal, cached_start = cached
+        path = list(path)
+        if not path:
+            return path
+        visible = lambda a, b: not utils.line_intersects_grid(a, b, self.grid,
+                                                              MAP_TILE_SIZE)
+        if path[-1] == cached_goal:
+            path[-1] = goal
+            if len(path) > 1 and not visible(path[-2], goal):
+                return None
+        if not visible(start, path[0]):
+            return None
         return path
 
+    def add_wall(self, rect):
+        """Add a wall rectangle (in pixels), updating the nav mesh around it
+        instead of rebuilding it, and notify the wall listeners."""
+        rect = tuple(rect)
+        if self._nav_mesh is None:
+            self.wall_rects.append(rect)
+            area = rect
+        else:
+            area = utils.nav_mesh_add_wall(self.nav_mesh, self.wall_rects,
+                                           rect, self.nav_bounds,
+                                           NAV_MESH_OFFSET, NAV_MESH_SIMPLIFY)
+        self._walls_changed(rect, area)
+
+    def remove_wall(self, rect):
+        """Remove a wall rectangle previously added or present in
+        wall_rects, updating the nav mesh around it. Raises ValueError if
+        there is no such wall."""
+        rect = tuple(rect)
+        if self._nav_mesh is None:
+            self.wall_rects.remove(rect)
+            area = rect
+        else:
+            area = utils.nav_mesh_remove_wall(self.nav_mesh, self.wall_rects,
+                                              rect, self.nav_bounds,
+                                              NAV_MESH_OFFSET,
+                                              NAV_MESH_SIMPLIFY)
+        self._walls_changed(rect, area)
+
+    def _walls_changed(self, rect, area):
+        """Bring everything that depends on the walls up to date after the
+        nav mesh changed inside area."""
+        tiles = self._update_grid(rect)
+        for planner in self.grid_planners.itervalues():
+            planner.update(tiles)
+        if self._nav_mesh is None:
+            self._walls_edited = True
+        else:
+            self.mesh_search = utils.MeshSearch(self.nav_mesh)
+            if self.tile_visibility is None:
+                self.build_tile_visibility()
+            else:
+                grid = self.grid_array
+                if grid is None:
+                    grid = self.grid
+                self.tile_visibility.update(self.nav_mesh, grid, tiles)
+            if self.routes is not None:
+                self.routes = utils.MeshRoutes(self.nav_mesh)
+        self.invalidate_flow_fields()
+        self.drop_paths(area)
+        for listener in self.wall_listeners:
+            listener(area)
+
+    @property
+    def grid_array(self):
+        """NumPy wall mask of the grid for batched line of sight tests, or
+        None if NumPy is not available."""
+        if self._grid_array is None:
+            try:
+                import gridarray
+            except ImportError:
+                return None
+            self._grid_array = gridarray.wall_mask(self.grid)
+        return self._grid_array
+
+    def lines_of_sight(self, start, points):
+        """Tell for each of the points whether it can be seen from start,
+        testing all lines against the grid at once."""
+        grid = self.grid_array
+        if grid is None:
+            return [not utils.line_intersects_grid(start, p, self.grid,
+                                                   MAP_TILE_SIZE)
+                    for p in points]
+        import gridarray
+        blocked = gridarray.lines_intersect_grid(start, points, grid,
+                                                 MAP_TILE_SIZE)
+        return (~blocked).tolist()
+
+    def _update_grid(self, rect):
+        """Recompute the grid cells under rect from the wall rects and
+        return their positions."""
+        self._grid_array = None
+        tiles = []
+        x0, y0 = self.tile_at(rect[:2])
+        x1, y1 = self.tile_at((rect[0] + rect[2] - 1, rect[1] + rect[3] - 1))
+        for y in xrange(max(y0, 0), min(y1 + 1, len(self.grid))):
+            row = self.grid[y]
+            for x in xrange(max(x0, 0), min(x1 + 1, len(row))):
+                cell = pygame.Rect(x * MAP_TILE_WIDTH, y * MAP_TILE_HEIGHT,
+                                   MAP_TILE_WIDTH, MAP_TILE_HEIGHT)
+                row[x] = 1 if cell.collidelist(self.wall_rects) != -1 else 0
+                tiles.append((x, y))
+        return tiles
+
+    def drop_paths(self, area):
+        """Forget cached and followed paths that pass through area."""
+        def crosses(points):
+            return any(utils.line_intersects_rect(a, b, area)
+                       for a, b in zip(points, points[1:]))
+        for key, (path, goal, start) in self.path_cache.items():
+            if crosses((start,) + path):
+                del self.path_cache[key]
+        for obj in self.game_objects:
+            path = getattr(obj, 'path', None)
+            if path and crosses([obj.pos] + path):
+                obj.path = None
+        if self.plan_queue is not None:
+            done = self.plan_queue.done
+            for obj, path in done.items():
+                if path and crosses([obj.pos] + path):
+                    del done[obj]
+
+    def tile_at(self, point):
+        """Return the map cell that contains the given pixel position."""
+        return (int(point[0] // MAP_TILE_WIDTH), int(point[1] // MAP_TILE_HEIGHT))
+
+    def flow_field(self, goal):
+        """Return the flow field towards the tile containing goal, building
+        it on first use."""
+        goal_tile = self.tile_at(goal)
+        try:
+            return self.flow_fields[goal_tile]
+        except KeyError:
+            field = utils.FlowField(self.grid, goal_tile, MAP_TILE_SIZE)
+            self.flow_fields[goal_tile] = field
+            return field
+
+    def flow_step(self, start, goal):
+        """Return the next waypoint from start towards goal according to
+        the shared flow field, or None if goal cannot be reached."""
+        tile = self.flow_field(goal).next_tile(self.tile_at(start))
+        if tile is None:
+            if self.tile_at(start) == self.tile_at(goal):
+                return goal
+            return None
+        return ((tile[0] + 0.5) * MAP_TILE_WIDTH,
+                (tile[1] + 0.5) * MAP_TILE_HEIGHT)
+
+    def invalidate_flow_fields(self):
+        """Drop all flow fields, e.g. after the walls changed."""
+        self.flow_fields = {}
+        if self.crowd is not None:
+            self.crowd.invalidate()
+
     def render(self):
+        """Return the background image and the wall overlay layer of the
+        level, a group of WallOverlay sprites. Both are built once and kept;
+        tiles marked with invalidate_tiles are redrawn on the next call."""
+        if self._background is None:
+            self._tiles = TileCache(MAP_TILE_WIDTH, MAP_TILE_HEIGHT)[self.tileset]
+            self._background = pygame.Surface((self.width*MAP_TILE_WIDTH,
+                self.height*MAP_TILE_HEIGHT))
+            self.overlays.empty()
+            self._overlays = {}
+            self._dirty_tiles = set((x, y) for y in xrange(self.height)
+                                    for x in xrange(self.width))
+        if self._dirty_tiles:
+            for map_x, map_y in self._dirty_tiles:
+                self._render_tile(map_x, map_y)
+            if self.redrawn_tiles is not None:
+                self.redrawn_tiles.extend(self._dirty_tiles)
+            self._dirty_tiles = set()
+        return self._background, self.overlays
+
+    def invalidate_tiles(self, cells=None):
+        """Mark map cells whose contents changed, so render redraws them
+        and their neighbours (wall tiles depend on the surrounding walls).
+        Without cells the whole level is rendered again."""
+        if cells is None:
+            self._background = None
+            return
+        for x, y in cells:
+            for nx in xrange(x - 1, x + 2):
+                for ny in xrange(y - 1, y + 2):
+                    if 0 <= nx < self.width and 0 <= ny < self.height:
+                        self._dirty_tiles.add((nx, ny))
+
+    def _render_tile(self, map_x, map_y):
+        """Draw a single map cell on the background and update its overlay."""
+        tile_image, overlay = self._tile_images(map_x, map_y)
+        self._background.blit(tile_image,
+                              (map_x*MAP_TILE_WIDTH, map_y*MAP_TILE_HEIGHT))
+        self._set_overlay((map_x, map_y), overlay)
+
+    def _tile_images(self, map_x, map_y):
+        """The image of a map cell and of its wall overlay, None if it has
+        no overlay."""
         wall = self.is_wall
-        map_cache = TileCache(MAP_TILE_WIDTH, MAP_TILE_HEIGHT)
-        tiles = map_cache[self.tileset]
-        image = pygame.Surface((self.width*MAP_TILE_WIDTH,
-            self.height*MAP_TILE_HEIGHT))
-        overlays = {}
-        for map_y, line in enumerate(self.map):
-            for map_x, c in enumerate(line):
-                if wall(map_x, map_y):
-                    # Draw different tiles depending on neighbourhood
-                    if not wall(map_x, map_y+1):
-                        if wall(map_x+1, map_y) and wall(map_x-1, map_y):
-                            tile = 1, 2
-                        elif wall(map_x+1, map_y):
-                            tile = 0, 2
-                        elif wall(map_x-1, map_y):
-                            tile = 2, 2
-                        else:
-                            tile = 3, 2
-                    else:
-                        if wall(map_x+1, map_y+1) and wall(map_x-1, map_y+1):
-                            tile = 1, 1
-                        elif wall(map_x+1, map_y+1):
-                            tile = 0, 1
-                        elif wall(map_x-1, map_y+1):
-                            tile = 2, 1
-                        else:
-                            tile = 3, 1
-                    # Add overlays if the wall may be obscuring something
-                    if not wall(map_x, map_y-1):
-                        if wall(map_x+1, map_y) and wall(map_x-1, map_y):
-                            over = 1, 0
-                        elif wall(map_x+1, map_y):
-                            over = 0, 0
-                        elif wall(map_x-1, map_y):
-                            over = 2, 0
-                        else:
-                            over = 3, 0
-                        overlays[(map_x, map_y)] = tiles[over[0]][over[1]]
+        tiles = self._tiles
+        overlay = None
+        if wall(map_x, map_y):
+            # Draw different tiles depending on neighbourhood
+            if not wall(map_x, map_y+1):
+                if wall(map_x+1, map_y) and wall(map_x-1, map_y):
+                    tile = 1, 2
+                elif wall(map_x+1, map_y):
+                    tile = 0, 2
+                elif wall(map_x-1, map_y):
+                    tile = 2, 2
+                else:
+                    tile = 3, 2
+            else:
+                if wall(map_x+1, map_y+1) and wall(map_x-1, map_y+1):
+                    tile = 1, 1
+                elif wall(map_x+1, map_y+1):
+                    tile = 0, 1
+                elif wall(map_x-1, map_y+1):
+                    tile = 2, 1
+                else:
+                    tile = 3, 1
+            # Add overlays if the wall may be obscuring something
+            if not wall(map_x, map_y-1):
+                if wall(map_x+1, map_y) and wall(map_x-1, map_y):
+                    over = 1, 0
+                elif wall(map_x+1, map_y):
+                    over = 0, 0
+                elif wall(map_x-1, map_y):
+                    over = 2, 0
                 else:
-                    try:
-                        tile = self.key[c]['tile'].split(',')
-                        tile = int(tile[0]), int(tile[1])
-                    except (ValueError, KeyError):
-                        # Default to ground tile
-                        tile = 0, 3
-                tile_image = tiles[tile[0]][tile[1]]
-                image.blit(tile_image,
-                           (map_x*MAP_TILE_WIDTH, map_y*MAP_TILE_HEIGHT))
-        return image, overlays
+                    over = 3, 0
+                overlay = tiles[over[0]][over[1]]
+        else:
+            i = self.tiles[map_y][map_x]
+            tile = self._legend_tiles[i] if i >= 0 else None
+            if tile is None:
+                # Default to ground tile
+                tile = 0, 3
+        return tiles[tile[0]][tile[1]], overlay
+
+    def _set_overlay(self, tile, image):
+        """Give a tile an overlay with image, or none if image is None.
+        The overlay sprite of a tile is kept, only changing its image."""
+        sprite = self._overlays.get(tile)
+        if image is None:
+            if sprite is not None:
+                del self._overlays[tile]
+                sprite.kill()
+        elif sprite is None:
+            sprite = WallOverlay(tile, image)
+            self._overlays[tile] = sprite
+            self.overlays.add(sprite)
+        else:
+            sprite.image = image
 
     def draw_nav_mesh(self, screen):
         # draw the nav_mesh